@@ -0,0 +1,50 @@
+"""Compare throughput of :func:`nbdb.storage.Storage.set` with every fsync policy.
+
+Run it with ``python benchmarks/aof_fsync.py``. Sequential sets show the cost
+of a single write, concurrent sets show how well group commit batches them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from nbdb.storage import FSYNC_POLICY, Storage
+
+POLICIES: tuple[FSYNC_POLICY, ...] = ("always", "everysec", "no")
+SEQUENTIAL = 2_000
+CONCURRENT = 20_000
+
+
+async def bench(policy: FSYNC_POLICY, *, concurrent: bool) -> float:
+    """Return sets per second for given policy."""
+    count = CONCURRENT if concurrent else SEQUENTIAL
+    with tempfile.TemporaryDirectory() as directory:
+        storage = await Storage.init(
+            Path(directory) / "db.json", write_interval=False, fsync=policy
+        )
+        start = time.perf_counter()
+        if concurrent:
+            _ = await asyncio.gather(
+                *(storage.set(str(i), i) for i in range(count))
+            )
+        else:
+            for i in range(count):
+                await storage.set(str(i), i)
+        elapsed = time.perf_counter() - start
+        await storage.close()
+    return count / elapsed
+
+
+async def main() -> None:
+    for concurrent in (False, True):
+        mode = "concurrent" if concurrent else "sequential"
+        for policy in POLICIES:
+            result = await bench(policy, concurrent=concurrent)
+            print(f"{mode:>10} {policy:>8}: {result:>10.0f} sets/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
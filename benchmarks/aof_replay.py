@@ -0,0 +1,54 @@
+"""Measure how fast AOF is replayed on startup, in records per second.
+
+Run it with ``python benchmarks/aof_replay.py``. A million of single-key
+records is written with every installed codec, like after a crash with a big
+AOF, and then :func:`Storage.read() <nbdb.storage.Storage.read>` replays them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import tempfile
+from pathlib import Path
+
+from nbdb.codec import CODECS, get_codec
+from nbdb.storage import Storage
+
+RECORDS = 1_000_000
+KEYS = 10_000
+
+
+async def main() -> None:
+    for name in CODECS:
+        if name == "indexed":
+            continue  # its AOF is the same, as of its inner codec
+        if name != "json" and importlib.util.find_spec(name) is None:
+            print(f"{name:>8}: not installed")
+            continue
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "db.json"
+            codec = get_codec(name)
+            # the same content, that `set` would append
+            _ = Path(str(path) + ".log.temp").write_bytes(
+                codec.header
+                + b"".join(
+                    codec.encode_record(
+                        {f"key{i % KEYS}": {"name": f"user {i}", "age": i}}
+                    )
+                    for i in range(RECORDS)
+                )
+            )
+
+            storage = await Storage.init(path, write_interval=False, codec=name)
+            stats = storage.last_read_stats
+            print(
+                f"{name:>8}: {RECORDS / stats.seconds:>12,.0f} records/s,"
+                f" {stats.bytes_per_second / 1024 / 1024:.1f} MiB/s"
+            )
+            await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""Compare codecs by write and read time of the db file, and by its size.
+
+Run it with ``python benchmarks/compression.py``. A database of JSON
+documents is written by :func:`Storage.write() <nbdb.storage.Storage.write>`
+and read back by :func:`Storage.read() <nbdb.storage.Storage.read>` with every
+installed codec, with and without compression.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import tempfile
+import time
+from pathlib import Path
+
+from nbdb.storage import SERIALIZABLE_TYPE, Storage
+
+KEYS = 100_000
+CODECS = (
+    "json",
+    "zlib",
+    "gzip",
+    "lzma",
+    "orjson",
+    "gzip:orjson",
+    "msgpack",
+    "zlib:msgpack",
+)
+
+
+async def main() -> None:
+    data: dict[str, SERIALIZABLE_TYPE] = {
+        f"user{i}": {
+            "name": f"user {i}",
+            "age": i % 100,
+            "tags": ["admin", "editor"] if i % 10 == 0 else ["viewer"],
+            "bio": "Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+        }
+        for i in range(KEYS)
+    }
+
+    for name in CODECS:
+        library = name.rpartition(":")[2]
+        if library in {"orjson", "msgpack"} and not importlib.util.find_spec(
+            library
+        ):
+            print(f"{name:>12}: not installed")
+            continue
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "db.json"
+            storage = await Storage.init(path, write_interval=False, codec=name)
+            await storage.set_many(data)
+
+            start = time.perf_counter()
+            await storage.write()
+            write_seconds = time.perf_counter() - start
+            await storage.close()
+
+            storage = await Storage.init(path, write_interval=False)
+            read_seconds = storage.last_read_stats.seconds
+            await storage.close()
+
+            print(
+                f"{name:>12}: write {write_seconds:.3f}s,"
+                f" read {read_seconds:.3f}s,"
+                f" {path.stat().st_size / 1024 / 1024:.2f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+"""Compare peak memory of writing the db file in one piece and streamed.
+
+Run it with ``python benchmarks/snapshot_memory.py``. The old way builds the
+whole JSON document as one string, the streamed :func:`Storage.write()
+<nbdb.storage.Storage.write>` encodes it by batches of keys.
+
+Peak memory of the streamed write is about a chunk plus the biggest encoded
+value, on a 12 MiB file it measured ~2.6 MiB against ~104 MiB. Times are
+inflated a few times by :py:mod:`tracemalloc`, compare them only with each
+other.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import aiofile
+
+from nbdb.storage import Storage
+
+KEYS = 50_000
+
+
+def mib(size: int) -> str:
+    return f"{size / 1024 / 1024:>8.1f} MiB"
+
+
+async def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        storage = await Storage.init(
+            Path(directory) / "db.json", write_interval=False, fsync="no"
+        )
+        await storage.set_many(
+            {
+                f"key{i}": {"name": f"user {i}", "tags": list(range(20))}
+                for i in range(KEYS)
+            }
+        )
+        data = await storage.get_many(f"key{i}" for i in range(KEYS))
+        print(f"db file size: {mib(len(json.dumps(data, indent=2)))}")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        async with aiofile.async_open(Path(directory) / "old.json", "w") as f:
+            _ = await f.write(json.dumps(data, indent=2, ensure_ascii=False))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"   one piece: {mib(peak)} peak, {elapsed:.2f}s")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        await storage.write()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"    streamed: {mib(peak)} peak, {elapsed:.2f}s")
+
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,727 @@
+"""Log-structured storage engine, based on `Bitcask <https://riak.com/assets/bitcask-intro.pdf>`_.
+
+Unlike :class:`~nbdb.storage.Storage`, which keeps all data in memory and
+rewrites the whole db file on every write, this engine appends every change to
+a segment file and keeps in memory only where the latest value of every key
+is. So writing costs as much as the change itself, not as the whole database.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import struct
+import typing as t
+import zlib
+from pathlib import Path
+
+import aiofile
+import typing_extensions as te
+
+from nbdb.cache import CacheStats, LRUCache
+from nbdb.codec import Codec, HEADER_MAX_SIZE, get_codec, parse_header
+
+if t.TYPE_CHECKING:
+    import collections.abc as c
+
+    from nbdb.storage import FSYNC_POLICY, SERIALIZABLE_TYPE
+
+logger = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct(">IIi")
+"""Header of every record: CRC32 of the rest, key size and value size."""
+_HINT_HEADER = struct.Struct(">IQi")
+"""Header of every hint entry: key size, value offset and value size."""
+_TOMBSTONE = -1
+"""Value size of a deleted key."""
+_READ_CHUNK_SIZE = 1024 * 1024
+"""Size (in bytes) of chunks, in which segments are scanned."""
+_MERGE_BUFFER_SIZE = 1024 * 1024
+"""Size (in bytes) of chunks, in which merged segment is written."""
+_SEGMENT_NAME = re.compile(r"(\d+)\.(data|merged)")
+
+
+class _Location(t.NamedTuple):
+    """Where the latest value of a key is."""
+
+    segment: int
+    offset: int
+    """Offset of the value (not the record) in the segment."""
+    size: int
+    """Size of the encoded value."""
+
+
+class _Record(t.NamedTuple):
+    key: str
+    offset: int
+    """Offset of the value (not the record) in the segment."""
+    size: int
+    """Size of the encoded value, :data:`_TOMBSTONE` if the key was deleted."""
+    value: bytes
+
+
+def _encode_record(key: bytes, value: bytes | None) -> bytes:
+    """Encode a record, ``None`` value means that the key was deleted."""
+    header = struct.pack(
+        ">Ii", len(key), _TOMBSTONE if value is None else len(value)
+    )
+    body = header + key + (value or b"")
+    return struct.pack(">I", zlib.crc32(body)) + body
+
+
+def _record_size(key: str, value_size: int) -> int:
+    return _RECORD_HEADER.size + len(key.encode()) + max(value_size, 0)
+
+
+@t.final
+class _RecordParser:
+    """Parser of a segment, that is fed by chunks of bytes."""
+
+    def __init__(self, offset: int) -> None:
+        self._buffer = b""
+        self._offset = offset
+        """Offset of the buffer start in the segment."""
+
+    @property
+    def offset(self) -> int:
+        """Offset of the end of the last complete record."""
+        return self._offset
+
+    def feed(self, data: bytes) -> list[_Record]:
+        """Parse as many records as possible, with ``data`` appended.
+
+        Raises:
+            ValueError: If checksum of a record doesn't match.
+        """
+        buffer = self._buffer + data
+        position = 0
+        records: list[_Record] = []
+        while len(buffer) - position >= _RECORD_HEADER.size:
+            crc, key_size, value_size = _RECORD_HEADER.unpack_from(
+                buffer, position
+            )
+            end = position + _RECORD_HEADER.size + key_size + max(value_size, 0)
+            if end > len(buffer):
+                break
+            if zlib.crc32(buffer[position + 4 : end]) != crc:
+                raise ValueError(
+                    f"Checksum mismatch at offset {self._offset + position}"
+                )
+
+            key_start = position + _RECORD_HEADER.size
+            value_start = key_start + key_size
+            records.append(
+                _Record(
+                    buffer[key_start:value_start].decode(),
+                    self._offset + value_start,
+                    value_size,
+                    buffer[value_start:end],
+                )
+            )
+            position = end
+
+        self._buffer = buffer[position:]
+        self._offset += position
+        return records
+
+
+@t.final
+class BitcaskStorage:
+    """Key-value store, that appends every change to segment files.
+
+    It has the same API as :class:`~nbdb.storage.Storage`, but only keys and
+    locations of their values are kept in memory, so :func:`get` reads the
+    value from disk.
+    """
+
+    # WARNING: You should call `del` on all instances by yourself,
+    # since Python does not guarantee that `__del__` will be ever called
+    instances: t.ClassVar[list[te.Self]] = []
+
+    def __init__(
+        self,
+        path: Path | str,
+        *,
+        codec: Codec,
+        fsync: FSYNC_POLICY,
+        max_segment_size: int,
+        cache_size: int,
+    ) -> None:
+        self.instances.append(self)
+
+        self._path = Path(path)
+        self._codec = codec
+        self._fsync = fsync
+        self._max_segment_size = max_segment_size
+
+        self._keydir: dict[str, _Location] = {}
+        self._cache: LRUCache[str, SERIALIZABLE_TYPE] = LRUCache(cache_size)
+        # opened segments, their paths and codecs, that wrote them
+        self._segments: dict[int, aiofile.AIOFile] = {}
+        self._paths: dict[int, Path] = {}
+        self._codecs: dict[int, Codec] = {}
+        # how many bytes every segment has and how many of them are not used
+        # by any key anymore, this is what `merge` gets rid of
+        self._sizes: dict[int, int] = {}
+        self._dead: dict[int, int] = {}
+
+        self._active_id = 0
+        self._lock = asyncio.Lock()
+        self._merge_lock = asyncio.Lock()
+        self._unsynced = False
+        # segments, that were merged, are closed only after all reads from
+        # them are finished
+        self._reads = 0
+        self._retired: list[aiofile.AIOFile] = []
+
+        self._path.mkdir(parents=True, exist_ok=True)
+
+        self._merge_loop_task: asyncio.Task[te.Never] | None = None
+        self._fsync_loop_task: asyncio.Task[te.Never] | None = None
+
+    @classmethod
+    async def init(
+        cls,
+        path: Path | str,
+        *,
+        codec: str | Codec = "json",
+        fsync: FSYNC_POLICY = "always",
+        max_segment_size: int = 64 * 1024 * 1024,
+        cache_size: int = 32 * 1024 * 1024,
+        merge_interval: int | t.Literal[False] = 5 * 60,
+        merge_threshold: float = 0.5,
+    ) -> te.Self:
+        """Python doesn't have async init methods, so we have to use this.
+
+        Arguments:
+            path:
+                Path to a directory, that is allocated entirely to the
+                database. It is created if it doesn't exist.
+            codec:
+                How values are serialized, see ``codec`` in
+                :func:`Storage.init() <nbdb.storage.Storage.init>`.
+            fsync:
+                When segments are synced to disk, see ``fsync`` in
+                :func:`Storage.init() <nbdb.storage.Storage.init>`.
+            max_segment_size:
+                Active segment is closed and a new one is started, when it
+                grows above this size in bytes.
+            cache_size:
+                Recently read values are cached in memory, until their total
+                size (as encoded on disk) exceeds this many bytes. Set to
+                ``0`` to disable the cache. See :attr:`cache_stats`.
+            merge_interval:
+                How often (in seconds) we check whether old segments should be
+                merged, set to ``False`` to disable background merging.
+            merge_threshold:
+                Old segments are merged, when at least this part of them is
+                not used by any key anymore (it was overwritten or deleted).
+        """
+        instance = cls(
+            path,
+            codec=get_codec(codec) if isinstance(codec, str) else codec,
+            fsync=fsync,
+            max_segment_size=max_segment_size,
+            cache_size=cache_size,
+        )
+        await instance.read()
+
+        if merge_interval:
+            instance._merge_loop_task = asyncio.create_task(
+                instance._merge_loop(merge_interval, merge_threshold)
+            )
+        if fsync == "everysec":
+            instance._fsync_loop_task = asyncio.create_task(
+                instance._fsync_loop()
+            )
+
+        return instance
+
+    async def read(self) -> None:
+        """Build keydir from segments on disk.
+
+        Segments, that have a hint file, are not scanned, keydir is loaded
+        from the hint. This method is called on initialization, you should
+        never call it by yourself.
+        """
+        for segment in self._segments.values():
+            await segment.close()
+        self._keydir, self._segments, self._codecs = {}, {}, {}
+        self._paths = {}
+        self._cache.clear()
+        self._sizes, self._dead = {}, {}
+
+        segments = self._list_segments()
+        merged = [
+            segment_id
+            for segment_id, path in segments.items()
+            if path.suffix == ".merged"
+        ]
+        if merged:
+            # everything before the last merged segment was merged into it,
+            # files are left only if we crashed right after the merge
+            for segment_id in [i for i in segments if i < max(merged)]:
+                self._unlink_segment(segments.pop(segment_id))
+        for leftover in self._path.glob("*.temp"):
+            leftover.unlink()
+
+        for segment_id, path in segments.items():
+            hint_path = path.with_suffix(".hint")
+            if hint_path.exists():
+                await self._load_hint(segment_id, path, hint_path)
+            else:
+                await self._scan_segment(
+                    segment_id, path, last=segment_id == max(segments)
+                )
+                # segment will never be changed again
+                await self._write_hint(segment_id, hint_path)
+
+        # never append to segments from the previous run
+        self._active_id = max(segments, default=-1) + 1
+
+    def _list_segments(self) -> dict[int, Path]:
+        """Return all segment files, sorted by their ID."""
+        segments: dict[int, Path] = {}
+        for path in self._path.iterdir():
+            match = _SEGMENT_NAME.fullmatch(path.name)
+            if match is not None:
+                segments[int(match[1])] = path
+        return dict(sorted(segments.items()))
+
+    def _unlink_segment(self, path: Path) -> None:
+        path.unlink()
+        path.with_suffix(".hint").unlink(missing_ok=True)
+
+    async def _open_segment(self, segment_id: int, path: Path) -> Codec:
+        """Open segment for reading and detect its codec."""
+        segment = aiofile.AIOFile(path, "rb")
+        _ = await segment.open()
+        self._segments[segment_id] = segment
+        self._paths[segment_id] = path
+        codec, _ = parse_header(await segment.read_bytes(HEADER_MAX_SIZE))
+        self._codecs[segment_id] = codec
+        self._sizes[segment_id] = path.stat().st_size
+        self._dead[segment_id] = 0
+        return codec
+
+    async def _load_hint(
+        self, segment_id: int, path: Path, hint_path: Path
+    ) -> None:
+        """Load keydir entries of a segment from its hint file."""
+        _ = await self._open_segment(segment_id, path)
+        async with aiofile.async_open(hint_path, "rb") as f:
+            data = t.cast(bytes, await f.read())
+
+        position = 0
+        while position < len(data):
+            key_size, offset, size = _HINT_HEADER.unpack_from(data, position)
+            position += _HINT_HEADER.size
+            key = data[position : position + key_size].decode()
+            position += key_size
+            self._apply(key, _Location(segment_id, offset, size))
+
+    async def _scan_segment(
+        self, segment_id: int, path: Path, *, last: bool
+    ) -> None:
+        """Load keydir entries of a segment by reading it entirely.
+
+        If the last segment ends with a broken record (we crashed in the
+        middle of a write), it is truncated.
+
+        Raises:
+            ValueError: If any other segment is broken.
+        """
+        codec = await self._open_segment(segment_id, path)
+        parser = _RecordParser(len(codec.header))
+        try:
+            async for records in self._read_records(segment_id, parser):
+                for record in records:
+                    self._apply(
+                        record.key,
+                        _Location(segment_id, record.offset, record.size),
+                    )
+        except ValueError:
+            if not last:
+                raise
+
+        if parser.offset != self._sizes[segment_id]:
+            if not last:
+                raise ValueError(f"Segment {path} ends with a broken record")
+            logger.warning(
+                "Segment %s ends with a broken record, truncating it", path
+            )
+            async with aiofile.async_open(path, "r+b") as f:
+                await f.file.truncate(parser.offset)
+            self._sizes[segment_id] = parser.offset
+
+    async def _read_records(
+        self, segment_id: int, parser: _RecordParser
+    ) -> c.AsyncIterator[list[_Record]]:
+        """Read records of a segment in chunks."""
+        segment = self._segments[segment_id]
+        offset = parser.offset
+        while True:
+            chunk = await segment.read_bytes(_READ_CHUNK_SIZE, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield parser.feed(chunk)
+
+    async def _write_hint(self, segment_id: int, hint_path: Path) -> None:
+        """Write hint file with all keys, that are in the segment.
+
+        Deleted keys are included too, as they must be deleted from older
+        segments on load.
+        """
+        parser = _RecordParser(len(self._codecs[segment_id].header))
+        entries: list[bytes] = []
+        async for records in self._read_records(segment_id, parser):
+            for record in records:
+                key = record.key.encode()
+                entries.append(
+                    _HINT_HEADER.pack(len(key), record.offset, record.size)
+                    + key
+                )
+
+        temp_path = hint_path.with_suffix(".hint.temp")
+        async with aiofile.async_open(temp_path, "wb") as f:
+            _ = await f.write(b"".join(entries))
+        _ = temp_path.replace(hint_path)
+
+    def _apply(self, key: str, location: _Location) -> None:
+        """Put location of the key into keydir and count dead bytes."""
+        self._cache.pop(key)
+        old = self._keydir.pop(key, None)
+        if old is not None:
+            self._dead[old.segment] += _record_size(key, old.size)
+        if location.size == _TOMBSTONE:
+            # tombstone is useless after all older segments are merged
+            self._dead[location.segment] += _record_size(key, location.size)
+        else:
+            self._keydir[key] = location
+
+    @property
+    def cache_stats(self) -> CacheStats:
+        """Hits, misses and size of the value cache."""
+        return self._cache.stats
+
+    async def get(self, key: str) -> SERIALIZABLE_TYPE:
+        """Get value of the key, reading it from disk if it isn't cached.
+
+        Cached values are shared between calls, so you must not modify them
+        in place.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+
+        location = self._keydir[key]
+        # merge may forget the segment while we are reading from it
+        codec = self._codecs[location.segment]
+        self._reads += 1
+        try:
+            data = await self._segments[location.segment].read_bytes(
+                location.size, location.offset
+            )
+        finally:
+            self._reads -= 1
+            if not self._reads and self._retired:
+                retired, self._retired = self._retired, []
+                for segment in retired:
+                    await segment.close()
+
+        value = codec.decode(data)
+        # the key may be changed while we were reading
+        if self._keydir.get(key) is location:
+            self._cache.put(key, value, location.size)
+        return value
+
+    async def get_many(
+        self, keys: c.Iterable[str]
+    ) -> dict[str, SERIALIZABLE_TYPE]:
+        """Get values of many keys at once.
+
+        Keys that don't exist are silently skipped, so the result may contain
+        less keys than you asked for.
+        """
+        return {key: await self.get(key) for key in keys if key in self._keydir}
+
+    async def set(self, key: str, value: SERIALIZABLE_TYPE) -> None:
+        """Set a key to value.
+
+        Setting a value to ``None`` deletes the key.
+
+        Raises:
+            KeyError: If you try to delete a key, that doesn't exist.
+        """
+        await self.set_many({key: value})
+
+    async def set_many(self, data: c.Mapping[str, SERIALIZABLE_TYPE]) -> None:
+        """Set many keys at once, they are appended to the segment in one write.
+
+        Same as in :func:`set`, ``None`` value deletes the key.
+
+        Raises:
+            KeyError:
+                If you try to delete a key, that doesn't exist. Nothing is
+                changed in this case.
+        """
+        for key, value in data.items():
+            if value is None and key not in self._keydir:
+                raise KeyError(key)
+        if not data:
+            return
+
+        await self._append(
+            [
+                (key, None if value is None else self._codec.encode(value))
+                for key, value in data.items()
+            ]
+        )
+
+    async def delete_many(self, keys: c.Iterable[str]) -> int:
+        """Delete many keys at once, keys that don't exist are silently skipped.
+
+        Returns:
+            How many keys were actually deleted.
+        """
+        changes: list[tuple[str, bytes | None]] = [
+            (key, None) for key in dict.fromkeys(keys) if key in self._keydir
+        ]
+        if changes:
+            await self._append(changes)
+        return len(changes)
+
+    async def _append(self, changes: list[tuple[str, bytes | None]]) -> None:
+        """Append records to the active segment and update keydir."""
+        async with self._lock:
+            segment_id = self._active_id
+            if segment_id not in self._segments:
+                await self._create_active()
+            offset = self._sizes[segment_id]
+
+            chunks: list[bytes] = []
+            locations: list[tuple[str, _Location]] = []
+            for key, value in changes:
+                record = _encode_record(key.encode(), value)
+                chunks.append(record)
+                locations.append(
+                    (
+                        key,
+                        _Location(
+                            segment_id,
+                            offset + len(record) - len(value or b""),
+                            _TOMBSTONE if value is None else len(value),
+                        ),
+                    )
+                )
+                offset += len(record)
+
+            segment = self._segments[segment_id]
+            _ = await segment.write_bytes(
+                b"".join(chunks), self._sizes[segment_id]
+            )
+            if self._fsync == "always":
+                await segment.fdsync()
+            else:
+                self._unsynced = True
+
+            self._sizes[segment_id] = offset
+            for key, location in locations:
+                self._apply(key, location)
+
+            if offset >= self._max_segment_size:
+                await self._rotate()
+
+    async def _create_active(self) -> None:
+        """Create a new active segment.
+
+        Must be called only while holding ``_lock``.
+        """
+        segment_id = self._active_id
+        path = self._path / f"{segment_id:010d}.data"
+        segment = aiofile.AIOFile(path, "w+b")
+        _ = await segment.open()
+        _ = await segment.write_bytes(self._codec.header)
+        self._segments[segment_id] = segment
+        self._paths[segment_id] = path
+        self._codecs[segment_id] = self._codec
+        self._sizes[segment_id] = len(self._codec.header)
+        self._dead[segment_id] = 0
+
+    async def _rotate(self) -> None:
+        """Make active segment immutable and start a new one.
+
+        Must be called only while holding ``_lock``.
+        """
+        segment_id = self._active_id
+        self._active_id += 1
+        if segment_id not in self._segments:
+            return  # nothing was written to it
+
+        await self._segments[segment_id].fdsync()
+        self._unsynced = False
+        await self._write_hint(
+            segment_id, self._path / f"{segment_id:010d}.hint"
+        )
+
+    async def merge(self) -> None:
+        """Merge all immutable segments into one, leaving only live values.
+
+        Active segment is made immutable first, so everything, that was
+        written before the call, is merged. Changes are not blocked during
+        the merge.
+        """
+        async with self._merge_lock:
+            async with self._lock:
+                await self._rotate()
+                # reserve ID, that is higher than any merged segment, but
+                # lower than active one
+                merged_id = self._active_id
+                self._active_id += 1
+
+            inputs = [i for i in self._segments if i < merged_id]
+            if not inputs:
+                return
+
+            temp_path = self._path / f"{merged_id:010d}.merged.temp"
+            moved: list[tuple[str, _Location, _Location]] = []
+            merged = aiofile.AIOFile(temp_path, "w+b")
+            _ = await merged.open()
+            try:
+                offset = await merged.write_bytes(self._codec.header)
+                buffer: list[bytes] = []
+                buffered = 0
+                for segment_id in inputs:
+                    codec = self._codecs[segment_id]
+                    parser = _RecordParser(len(codec.header))
+                    async for records in self._read_records(segment_id, parser):
+                        for record in records:
+                            old = _Location(
+                                segment_id, record.offset, record.size
+                            )
+                            if self._keydir.get(record.key) != old:
+                                continue  # overwritten or deleted
+
+                            value = record.value
+                            if codec.header != self._codec.header:
+                                value = self._codec.encode(codec.decode(value))
+                            encoded = _encode_record(record.key.encode(), value)
+                            buffer.append(encoded)
+                            buffered += len(encoded)
+                            moved.append(
+                                (
+                                    record.key,
+                                    old,
+                                    _Location(
+                                        merged_id,
+                                        offset + buffered - len(value),
+                                        len(value),
+                                    ),
+                                )
+                            )
+                            if buffered >= _MERGE_BUFFER_SIZE:
+                                offset += await merged.write_bytes(
+                                    b"".join(buffer), offset
+                                )
+                                buffer, buffered = [], 0
+                offset += await merged.write_bytes(b"".join(buffer), offset)
+                await merged.fdsync()
+            except BaseException:
+                await merged.close()
+                temp_path.unlink()
+                raise
+
+            path = self._path / f"{merged_id:010d}.merged"
+            # nothing is awaited from here, so no one can see half-updated
+            # keydir
+            _ = temp_path.replace(path)
+            self._segments[merged_id] = merged
+            # the file was opened under the temporary name
+            self._paths[merged_id] = path
+            self._codecs[merged_id] = self._codec
+            self._sizes[merged_id] = offset
+            self._dead[merged_id] = 0
+            for key, old, new in moved:
+                if self._keydir.get(key) == old:
+                    self._keydir[key] = new
+                else:  # changed while we were merging
+                    self._dead[merged_id] += _record_size(key, new.size)
+            for segment_id in inputs:
+                self._retired.append(self._segments.pop(segment_id))
+                self._unlink_segment(self._paths.pop(segment_id))
+                del self._codecs[segment_id]
+                del self._sizes[segment_id]
+                del self._dead[segment_id]
+
+            await self._write_hint(merged_id, path.with_suffix(".hint"))
+            if not self._reads:
+                retired, self._retired = self._retired, []
+                for segment in retired:
+                    await segment.close()
+
+        logger.debug(
+            "Merged %d segments of %s into %s", len(inputs), self._path, path
+        )
+
+    def _should_merge(self, threshold: float) -> bool:
+        """Check whether enough of immutable segments is dead."""
+        immutable = [i for i in self._sizes if i < self._active_id]
+        size = sum(self._sizes[i] for i in immutable)
+        dead = sum(self._dead[i] for i in immutable)
+        return size > 0 and dead >= size * threshold
+
+    async def _merge_loop(self, interval: float, threshold: float) -> te.Never:
+        """Call :func:`merge` every ``interval`` seconds, if it is needed."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self._should_merge(threshold):
+                    await self.merge()
+            except Exception as exception:
+                logger.exception("Error during merge!", exc_info=exception)
+
+    async def _fsync_loop(self) -> te.Never:
+        """Sync active segment every second, used with ``everysec`` policy."""
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await self.write()
+            except Exception as exception:
+                logger.exception("Error during fsync!", exc_info=exception)
+
+    async def write(self) -> None:
+        """Sync active segment to disk.
+
+        Everything is written to disk immediately, so this only matters if
+        ``fsync`` is not ``"always"``. Unlike :func:`Storage.write()
+        <nbdb.storage.Storage.write>`, this costs as much as the changes
+        since the last sync, not as the whole database.
+        """
+        async with self._lock:
+            segment = self._segments.get(self._active_id)
+            if segment is not None and self._unsynced:
+                await segment.fdsync()
+            self._unsynced = False
+
+    async def close(self) -> None:
+        """Stop background tasks, sync and close all segments.
+
+        The storage must not be used after this call.
+        """
+        for task in (self._merge_loop_task, self._fsync_loop_task):
+            if task is not None:
+                _ = task.cancel()
+                _ = await asyncio.gather(task, return_exceptions=True)
+
+        async with self._lock:
+            segments = [*self._segments.values(), *self._retired]
+            self._segments, self._retired = {}, []
+            for segment in segments:
+                await segment.close()  # also syncs the file
+
+    def __del__(self) -> None:
+        for task in (self._merge_loop_task, self._fsync_loop_task):
+            if task is not None:
+                _ = task.cancel()
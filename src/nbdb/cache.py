@@ -0,0 +1,91 @@
+"""Cache of decoded values, bounded by their size in bytes."""
+
+from __future__ import annotations
+
+import collections
+import typing as t
+
+K = t.TypeVar("K")
+V = t.TypeVar("V")
+
+
+class CacheStats(t.NamedTuple):
+    """Statistics of :class:`LRUCache`."""
+
+    hits: int
+    misses: int
+    size: int
+    """Total size of cached values in bytes."""
+    max_size: int
+    items: int
+    """How many values are cached."""
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@t.final
+class LRUCache(t.Generic[K, V]):
+    """Least recently used cache, bounded by total size of values.
+
+    Size of every value is given by the caller, usually it is the size of the
+    encoded value, because the real size of Python objects is expensive to
+    compute. ``None`` values can't be cached, because :func:`get` returns
+    ``None`` on miss.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._items: collections.OrderedDict[K, tuple[V, int]] = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            self._hits,
+            self._misses,
+            self._size,
+            self._max_size,
+            len(self._items),
+        )
+
+    def get(self, key: K) -> V | None:
+        """Return cached value and mark it as recently used."""
+        item = self._items.get(key)
+        if item is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: K, value: V, size: int) -> None:
+        """Cache the value, evicting least recently used ones if needed.
+
+        Values, that are bigger than the whole cache, are not cached.
+        """
+        self.pop(key)
+        if size > self._max_size:
+            return
+
+        self._items[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self._size -= evicted
+
+    def pop(self, key: K) -> None:
+        """Forget the value, if it is cached."""
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._size = 0
@@ -0,0 +1,1013 @@
+"""Codecs, that are used to serialize the db file and AOF records.
+
+The default codec is human-readable JSON. Faster codecs are optional and work
+only if their library is installed.
+"""
+
+from __future__ import annotations
+
+import abc
+import codecs
+import importlib
+import itertools
+import json
+import lzma
+import mmap
+import re
+import struct
+import typing as t
+import zlib
+from json.scanner import make_scanner
+
+import typing_extensions as te
+
+if t.TYPE_CHECKING:
+    import collections.abc as c
+    from pathlib import Path
+
+    from nbdb.storage import SERIALIZABLE_TYPE
+
+HEADER_PREFIX = b"#nbdb:"
+"""Files, that were written by a non-JSON codec, start with this prefix,
+followed by the name of the codec and a newline."""
+HEADER_MAX_SIZE = 64
+"""Maximum size (in bytes) of the header, including the newline."""
+
+_WRITE_BUFFER_SIZE = 64 * 1024
+"""Approximate size (in characters) of chunks, in which db file is written."""
+_WHITESPACE_CHARS = " \t\n\r"
+_WHITESPACE = re.compile(f"[{_WHITESPACE_CHARS}]*")
+_NUMBER_CHARS = re.compile(r"[0-9.eE+-]*")
+
+_INDEX_ENTRY = struct.Struct(">IQQ")
+"""Entry of the index: key size, value offset and value size."""
+_INDEX_TRAILER = struct.Struct(">QQ8s")
+"""End of indexed snapshot: index offset, number of keys and magic."""
+_INDEX_MAGIC = b"nbdbidx1"
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+"""Makes :py:mod:`zlib` to write and read gzip format."""
+
+_ITEMS: te.TypeAlias = "list[tuple[str, SERIALIZABLE_TYPE]]"
+# either new values of keys or an operation, like `incr`
+_RECORD: te.TypeAlias = (
+    "c.Mapping[str, SERIALIZABLE_TYPE] | list[SERIALIZABLE_TYPE]"
+)
+
+
+class Decoder(abc.ABC):
+    """Incremental decoder, that is fed by chunks of bytes."""
+
+    @property
+    @abc.abstractmethod
+    def pending(self) -> int:
+        """How many bytes (or characters) are waiting for the rest of data."""
+
+    @abc.abstractmethod
+    def feed(self, data: bytes, *, eof: bool) -> list[t.Any]:
+        """Decode as many items as possible, with ``data`` appended.
+
+        ``eof`` must be ``True`` for the last chunk (which may be empty), if
+        something is left undecoded at this point, the file is broken.
+        """
+
+
+class _Compressor(t.Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+    def flush(self) -> bytes: ...
+
+
+class _Decompressor(t.Protocol):
+    @property
+    def eof(self) -> bool: ...
+    @property
+    def unused_data(self) -> bytes: ...
+    def decompress(self, data: bytes, /) -> bytes: ...
+
+
+@t.final
+class LazyValue:
+    """Encoded value, that is decoded only when it is needed."""
+
+    __slots__ = ("codec", "data")
+
+    def __init__(self, codec: Codec, data: bytes | memoryview) -> None:
+        self.codec = codec
+        self.data = data
+
+    def decode(self) -> SERIALIZABLE_TYPE:
+        return self.codec.decode(bytes(self.data))
+
+
+def resolve(value: SERIALIZABLE_TYPE | LazyValue) -> SERIALIZABLE_TYPE:
+    """Decode the value, if it is lazy."""
+    return value.decode() if isinstance(value, LazyValue) else value
+
+
+class Codec(abc.ABC):
+    """Serializer of the db file and AOF records.
+
+    The db file is written by :func:`encode_snapshot` and read by
+    :func:`snapshot_decoder`, AOF records are written one by one with
+    :func:`encode_record` and read by :func:`record_decoder`. By default
+    records are separated by newlines, so :func:`encode` must not produce
+    them.
+    """
+
+    name: t.ClassVar[str]
+    """Name of the codec, that is written to the file header."""
+
+    @abc.abstractmethod
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes: ...
+
+    @abc.abstractmethod
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE: ...
+
+    @property
+    def header(self) -> bytes:
+        """Header of files, that were written by this codec."""
+        return HEADER_PREFIX + self.name.encode() + b"\n"
+
+    def encode_snapshot(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> c.Iterator[bytes]:
+        """Encode the db file in chunks, including the header."""
+        yield self.header
+        yield self.encode({key: resolve(value) for key, value in data.items()})
+
+    def snapshot_decoder(self) -> Decoder:
+        """Return decoder of the db file (without header), which yields pairs."""
+        return _WholeSnapshotDecoder(self)
+
+    def lazy_snapshot_decoder(self) -> Decoder:
+        """Same as :func:`snapshot_decoder`, but values are :class:`LazyValue`.
+
+        By default values are decoded and then encoded back one by one, so
+        only the encoded values are kept.
+        """
+        return _LazySnapshotDecoder(self, self.snapshot_decoder())
+
+    def encode_record(self, record: _RECORD) -> bytes:
+        """Encode a single AOF record, including its separator."""
+        return b"\n" + self.encode(record)
+
+    def record_decoder(self) -> Decoder:
+        """Return decoder of AOF (without header), which yields records."""
+        return _LineRecordDecoder(self)
+
+    def decode_many(self, data: list[bytes]) -> list[SERIALIZABLE_TYPE]:
+        """Decode many values at once, used to replay AOF."""
+        decode = self.decode
+        return [decode(item) for item in data]
+
+    def encode_block(self, data: bytes) -> bytes:
+        """Prepare encoded records, that are appended to AOF at once.
+
+        Most codecs write records as is, compressing ones compress every
+        block separately.
+        """
+        return data
+
+
+@t.final
+class JsonCodec(Codec):
+    """Human-readable JSON, the default codec.
+
+    Files, that were written by this codec, don't have a header, so they are
+    plain JSON.
+    """
+
+    name = "json"
+
+    def __init__(self, *, indent: int | str | None = 2) -> None:
+        self.indent = indent
+
+    @property
+    @te.override
+    def header(self) -> bytes:
+        return b""
+
+    @te.override
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes:
+        return json.dumps(value).encode()
+
+    @te.override
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE:
+        return json.loads(data)
+
+    @te.override
+    def decode_many(self, data: list[bytes]) -> list[SERIALIZABLE_TYPE]:
+        # a single call of the C decoder is much faster than one per item
+        return json.loads(b"[" + b",".join(data) + b"]")
+
+    @te.override
+    def encode_snapshot(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> c.Iterator[bytes]:
+        """Encode the db file in chunks.
+
+        Keys are encoded by batches, every batch as a whole dict by
+        :py:func:`json.dumps`, so the encoder is created once per batch, not
+        per key. Batch size is adapted, so every chunk is about
+        :data:`_WRITE_BUFFER_SIZE`. So we never hold the whole encoded
+        database in memory, only about a chunk plus the biggest encoded
+        value. Output is the same as of :py:func:`json.dumps` with our
+        ``indent``, because a batch is indented the same way as the
+        top-level dict.
+        """
+        if not data:
+            yield json.dumps(data, indent=self.indent).encode()
+            return
+
+        # a batch is `{` + items + `}`, or `\n}` with indent
+        end = -1 if self.indent is None else -2
+        items = iter(data.items())
+        prefix = "{"
+        separator = ", " if self.indent is None else ","
+        batch_size = 1
+        while True:
+            batch = {
+                key: resolve(value)
+                for key, value in itertools.islice(items, batch_size)
+            }
+            if not batch:
+                break
+            encoded = json.dumps(batch, indent=self.indent, ensure_ascii=False)
+            yield (prefix + encoded[1:end]).encode()
+            prefix = separator
+            batch_size = max(
+                1,
+                min(
+                    batch_size * 2,
+                    batch_size * _WRITE_BUFFER_SIZE // len(encoded),
+                ),
+            )
+
+        yield ("}" if self.indent is None else "\n}").encode()
+
+    @te.override
+    def snapshot_decoder(self) -> Decoder:
+        return _JsonSnapshotDecoder()
+
+    @te.override
+    def lazy_snapshot_decoder(self) -> Decoder:
+        # the original text of every value is kept, no need to encode it
+        return _JsonSnapshotDecoder(lazy_codec=self)
+
+
+@t.final
+class OrjsonCodec(Codec):
+    """Compact JSON, encoded by `orjson <https://github.com/ijl/orjson>`_.
+
+    Much faster than :class:`JsonCodec`, but integers must fit into 64 bits.
+    """
+
+    name = "orjson"
+
+    def __init__(self) -> None:
+        self._orjson = _import_optional("orjson")
+
+    @te.override
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes:
+        return t.cast(bytes, self._orjson.dumps(value))
+
+    @te.override
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE:
+        return t.cast("SERIALIZABLE_TYPE", self._orjson.loads(data))
+
+    @te.override
+    def decode_many(self, data: list[bytes]) -> list[SERIALIZABLE_TYPE]:
+        return t.cast(
+            "list[SERIALIZABLE_TYPE]",
+            self._orjson.loads(b"[" + b",".join(data) + b"]"),
+        )
+
+
+@t.final
+class MsgpackCodec(Codec):
+    """Binary `MessagePack <https://msgpack.org/>`_ format.
+
+    Records are not separated by newlines, because MessagePack objects know
+    their own size.
+    """
+
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        self._msgpack = _import_optional("msgpack")
+
+    @te.override
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes:
+        return t.cast(bytes, self._msgpack.packb(value))
+
+    @te.override
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE:
+        return t.cast("SERIALIZABLE_TYPE", self._msgpack.unpackb(data))
+
+    @te.override
+    def encode_record(self, record: _RECORD) -> bytes:
+        return self.encode(record)
+
+    @te.override
+    def record_decoder(self) -> Decoder:
+        return _MsgpackRecordDecoder(
+            # no limit on size of a single record
+            self._msgpack.Unpacker(max_buffer_size=0)
+        )
+
+
+@t.final
+class IndexedCodec(Codec):
+    """Binary db file with an index, values are encoded by another codec.
+
+    The file consists of encoded values, one after another, followed by an
+    index of ``(key, offset, size)`` entries and a trailer, which points to
+    the index. Index is at the end, so the file can be written in one pass.
+
+    On read, the file is memory-mapped, and only the index is parsed, so
+    opening the database costs as much as the number of keys, and every
+    value is decoded only on the first access (see :class:`LazyValue`).
+    Values, that are never read, cost only page cache.
+
+    AOF records are encoded by the inner codec.
+    """
+
+    name = "indexed"
+
+    def __init__(self, codec: Codec | None = None) -> None:
+        self.codec = JsonCodec(indent=None) if codec is None else codec
+
+    @property
+    @te.override
+    def header(self) -> bytes:
+        return HEADER_PREFIX + f"{self.name}:{self.codec.name}\n".encode()
+
+    @te.override
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes:
+        return self.codec.encode(value)
+
+    @te.override
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE:
+        return self.codec.decode(data)
+
+    @te.override
+    def decode_many(self, data: list[bytes]) -> list[SERIALIZABLE_TYPE]:
+        return self.codec.decode_many(data)
+
+    @te.override
+    def encode_record(self, record: _RECORD) -> bytes:
+        return self.codec.encode_record(record)
+
+    @te.override
+    def record_decoder(self) -> Decoder:
+        return self.codec.record_decoder()
+
+    @te.override
+    def encode_snapshot(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> c.Iterator[bytes]:
+        header = self.header
+        yield header
+
+        offset = len(header)
+        index: list[bytes] = []
+        buffer: list[bytes] = []
+        size = 0
+        for key, value in data.items():
+            if (
+                isinstance(value, LazyValue)
+                and value.codec.header == self.codec.header
+            ):
+                encoded = bytes(value.data)  # no need to decode it
+            else:
+                encoded = self.codec.encode(resolve(value))
+            encoded_key = key.encode()
+            index.append(
+                _INDEX_ENTRY.pack(len(encoded_key), offset, len(encoded))
+                + encoded_key
+            )
+            offset += len(encoded)
+
+            buffer.append(encoded)
+            size += len(encoded)
+            if size >= _WRITE_BUFFER_SIZE:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+
+        buffer.extend(index)
+        buffer.append(_INDEX_TRAILER.pack(offset, len(index), _INDEX_MAGIC))
+        yield b"".join(buffer)
+
+    @te.override
+    def snapshot_decoder(self) -> Decoder:
+        return _IndexedSnapshotDecoder(self)
+
+    @te.override
+    def lazy_snapshot_decoder(self) -> Decoder:
+        return _IndexedSnapshotDecoder(self)  # its values are always lazy
+
+    def load(self, path: Path) -> dict[str, SERIALIZABLE_TYPE | LazyValue]:
+        """Memory-map the db file and parse its index.
+
+        Raises:
+            ValueError: If the file is broken.
+        """
+        with path.open("rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # the file stays mapped, until all values are decoded or deleted
+        return self.parse_index(memoryview(mapped))
+
+    def parse_index(
+        self, data: memoryview
+    ) -> dict[str, SERIALIZABLE_TYPE | LazyValue]:
+        """Parse index of the whole db file, including the header.
+
+        Raises:
+            ValueError: If the file is broken.
+        """
+        if len(data) < len(self.header) + _INDEX_TRAILER.size:
+            raise ValueError("Indexed snapshot is too small")
+        index_offset, count, magic = _INDEX_TRAILER.unpack_from(
+            data, len(data) - _INDEX_TRAILER.size
+        )
+        if magic != _INDEX_MAGIC:
+            raise ValueError("Indexed snapshot doesn't end with the trailer")
+
+        codec = self.codec
+        unpack = _INDEX_ENTRY.unpack_from
+        entry_size = _INDEX_ENTRY.size
+        items: dict[str, SERIALIZABLE_TYPE | LazyValue] = {}
+        position = index_offset
+        for _ in range(count):
+            key_size, offset, size = unpack(data, position)
+            position += entry_size
+            key = bytes(data[position : position + key_size]).decode()
+            position += key_size
+            items[key] = LazyValue(codec, data[offset : offset + size])
+        return items
+
+
+class CompressedCodec(Codec, abc.ABC):
+    """Base of codecs, that compress output of another codec.
+
+    The db file is compressed as a single stream, chunk by chunk, so neither
+    compressed nor uncompressed file is held in memory. AOF can't be a single
+    stream, because it is appended by many processes over time, so every
+    block of records (see :func:`~Codec.encode_block`) is compressed as
+    a separate stream, and streams follow each other.
+
+    The header is not compressed and contains name of the inner codec, for
+    example ``#nbdb:gzip:msgpack``, so compression is detected on read.
+    """
+
+    def __init__(self, codec: Codec | None = None) -> None:
+        self.codec: Codec = JsonCodec(indent=None) if codec is None else codec
+
+    @abc.abstractmethod
+    def _compressor(self) -> _Compressor: ...
+
+    @abc.abstractmethod
+    def _decompressor(self) -> _Decompressor: ...
+
+    @property
+    @te.override
+    def header(self) -> bytes:
+        inner = self.codec.header[len(HEADER_PREFIX) : -1] or b"json"
+        return HEADER_PREFIX + self.name.encode() + b":" + inner + b"\n"
+
+    @te.override
+    def encode(self, value: SERIALIZABLE_TYPE) -> bytes:
+        return self.codec.encode(value)
+
+    @te.override
+    def decode(self, data: bytes) -> SERIALIZABLE_TYPE:
+        return self.codec.decode(data)
+
+    @te.override
+    def decode_many(self, data: list[bytes]) -> list[SERIALIZABLE_TYPE]:
+        return self.codec.decode_many(data)
+
+    @te.override
+    def encode_record(self, record: _RECORD) -> bytes:
+        return self.codec.encode_record(record)
+
+    @te.override
+    def encode_block(self, data: bytes) -> bytes:
+        if not data:
+            return data
+        compressor = self._compressor()
+        return compressor.compress(self.codec.encode_block(data)) + (
+            compressor.flush()
+        )
+
+    @te.override
+    def encode_snapshot(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> c.Iterator[bytes]:
+        yield self.header
+
+        compressor = self._compressor()
+        # the header of the inner codec is replaced by ours
+        skip = len(self.codec.header)
+        for chunk in self.codec.encode_snapshot(data):
+            compressed = compressor.compress(chunk[skip:])
+            skip = max(skip - len(chunk), 0)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    @te.override
+    def snapshot_decoder(self) -> Decoder:
+        return _DecompressingDecoder(
+            self.codec.snapshot_decoder(), self._decompressor
+        )
+
+    @te.override
+    def lazy_snapshot_decoder(self) -> Decoder:
+        return _DecompressingDecoder(
+            self.codec.lazy_snapshot_decoder(), self._decompressor
+        )
+
+    @te.override
+    def record_decoder(self) -> Decoder:
+        return _DecompressingDecoder(
+            self.codec.record_decoder(), self._decompressor
+        )
+
+
+@t.final
+class ZlibCodec(CompressedCodec):
+    """Another codec, compressed by :py:mod:`zlib`."""
+
+    name = "zlib"
+
+    def __init__(self, codec: Codec | None = None, *, level: int = -1) -> None:
+        super().__init__(codec)
+        self.level = level
+
+    @te.override
+    def _compressor(self) -> _Compressor:
+        return zlib.compressobj(self.level)
+
+    @te.override
+    def _decompressor(self) -> _Decompressor:
+        return zlib.decompressobj()
+
+
+@t.final
+class GzipCodec(CompressedCodec):
+    """Another codec, compressed to :py:mod:`gzip` format.
+
+    Same as :class:`ZlibCodec`, but the db file can be unpacked by
+    ``gunzip`` (after the header line is removed).
+    """
+
+    name = "gzip"
+
+    def __init__(self, codec: Codec | None = None, *, level: int = -1) -> None:
+        super().__init__(codec)
+        self.level = level
+
+    @te.override
+    def _compressor(self) -> _Compressor:
+        return zlib.compressobj(self.level, wbits=_GZIP_WBITS)
+
+    @te.override
+    def _decompressor(self) -> _Decompressor:
+        return zlib.decompressobj(wbits=_GZIP_WBITS)
+
+
+@t.final
+class LzmaCodec(CompressedCodec):
+    """Another codec, compressed by :py:mod:`lzma`.
+
+    Compresses better than :class:`ZlibCodec`, but is a few times slower.
+    """
+
+    name = "lzma"
+
+    def __init__(self, codec: Codec | None = None, *, preset: int = 6) -> None:
+        super().__init__(codec)
+        self.preset = preset
+
+    @te.override
+    def _compressor(self) -> _Compressor:
+        return lzma.LZMACompressor(preset=self.preset)
+
+    @te.override
+    def _decompressor(self) -> _Decompressor:
+        return lzma.LZMADecompressor()
+
+
+CODECS: dict[str, type[Codec]] = {
+    codec.name: codec
+    for codec in (
+        JsonCodec,
+        OrjsonCodec,
+        MsgpackCodec,
+        IndexedCodec,
+        ZlibCodec,
+        GzipCodec,
+        LzmaCodec,
+    )
+}
+"""All available codecs by their name."""
+
+
+def get_codec(name: str) -> Codec:
+    """Return codec by its name, with default options.
+
+    ``"indexed"`` and compressing codecs may be followed by the name of the
+    codec, that they wrap, for example ``"indexed:msgpack"`` or
+    ``"gzip:orjson"``. By default they wrap compact JSON.
+
+    Raises:
+        ValueError: If there is no codec with this name.
+        ImportError: If the library of the codec is not installed.
+    """
+    name, _, inner = name.partition(":")
+    wrapper = CODECS.get(name)
+    if (
+        inner
+        and wrapper is not None
+        and issubclass(wrapper, (IndexedCodec, CompressedCodec))
+    ):
+        return wrapper(get_codec(inner))
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown codec {name!r}, available are: {', '.join(CODECS)}"
+        ) from None
+
+
+def parse_header(data: bytes) -> tuple[Codec, int]:
+    """Find out, which codec wrote a file, by its beginning.
+
+    Arguments:
+        data: At least :data:`HEADER_MAX_SIZE` first bytes of the file.
+
+    Returns:
+        The codec and size of the header, files without header are JSON.
+
+    Raises:
+        ValueError: If the header is broken or the codec is unknown.
+        ImportError: If the library of the codec is not installed.
+    """
+    if not data.startswith(HEADER_PREFIX):
+        return JsonCodec(), 0
+
+    end = data.find(b"\n", 0, HEADER_MAX_SIZE)
+    if end == -1:
+        raise ValueError("Broken file header, newline not found")
+    return get_codec(data[len(HEADER_PREFIX) : end].decode()), end + 1
+
+
+def _import_optional(module: str) -> t.Any:
+    """Import library of an optional codec."""
+    try:
+        return importlib.import_module(module)
+    except ImportError as exception:
+        raise ImportError(
+            f"{module} is not installed, install it to use this codec"
+        ) from exception
+
+
+@t.final
+class _WholeSnapshotDecoder(Decoder):
+    """Decoder of the db file, that decodes it at once at the end."""
+
+    def __init__(self, codec: Codec) -> None:
+        self._codec = codec
+        self._chunks: list[bytes] = []
+        self._size = 0
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._size
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> _ITEMS:
+        self._chunks.append(data)
+        self._size += len(data)
+        if not eof:
+            return []
+
+        data, self._chunks, self._size = b"".join(self._chunks), [], 0
+        if not data:
+            return []
+        decoded = self._codec.decode(data)
+        if not isinstance(decoded, dict):
+            # broken file, not a wrong argument
+            raise ValueError("The db file must contain a mapping")  # noqa: TRY004
+        return list(decoded.items())
+
+
+@t.final
+class _LazySnapshotDecoder(Decoder):
+    """Wrapper of the db file decoder, that encodes values back."""
+
+    def __init__(self, codec: Codec, decoder: Decoder) -> None:
+        self._codec = codec
+        self._decoder = decoder
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._decoder.pending
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[tuple[str, LazyValue]]:
+        codec = self._codec
+        encode = codec.encode
+        return [
+            (key, LazyValue(codec, encode(value)))
+            for key, value in self._decoder.feed(data, eof=eof)
+        ]
+
+
+@t.final
+class _DecompressingDecoder(Decoder):
+    """Decoder, that decompresses data before passing it to another one.
+
+    Data may consist of many compressed streams, one after another.
+    """
+
+    def __init__(
+        self, decoder: Decoder, decompressor: c.Callable[[], _Decompressor]
+    ) -> None:
+        self._decoder = decoder
+        self._new_decompressor = decompressor
+        self._decompressor = decompressor()
+        # whether the current stream was started, but not finished yet
+        self._in_stream = False
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._decoder.pending
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[t.Any]:
+        chunks: list[bytes] = []
+        while data:
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except (zlib.error, lzma.LZMAError) as exception:
+                raise ValueError(
+                    f"Broken compressed stream: {exception}"
+                ) from exception
+            if not self._decompressor.eof:
+                self._in_stream = True
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._new_decompressor()
+            self._in_stream = False
+        if eof and self._in_stream:
+            raise ValueError("Compressed stream is cut in the middle")
+        return self._decoder.feed(b"".join(chunks), eof=eof)
+
+
+@t.final
+class _IndexedSnapshotDecoder(Decoder):
+    """Decoder of indexed db file, that isn't memory-mapped."""
+
+    def __init__(self, codec: IndexedCodec) -> None:
+        self._codec = codec
+        self._chunks: list[bytes] = [codec.header]
+        self._size = 0
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._size
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[t.Any]:
+        self._chunks.append(data)
+        self._size += len(data)
+        if not eof:
+            return []
+
+        data, self._chunks, self._size = b"".join(self._chunks), [], 0
+        return list(self._codec.parse_index(memoryview(data)).items())
+
+
+@t.final
+class _LineRecordDecoder(Decoder):
+    """Decoder of AOF records, that are separated by newlines."""
+
+    def __init__(self, codec: Codec) -> None:
+        self._codec = codec
+        self._tail = b""
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return len(self._tail)
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[_RECORD]:
+        lines = (self._tail + data).split(b"\n")
+        # the last line may be cut in half
+        self._tail = b"" if eof else lines.pop()
+        return t.cast(
+            "list[_RECORD]",
+            self._codec.decode_many(
+                # first line is always empty, because it is easier this way
+                [line for line in lines if line]
+            ),
+        )
+
+
+@t.final
+class _MsgpackRecordDecoder(Decoder):
+    """Decoder of AOF records, that are written one after another."""
+
+    def __init__(self, unpacker: t.Any) -> None:
+        self._unpacker = unpacker
+        self._fed = 0
+        # `tell` also counts bytes of a half-decoded record
+        self._decoded = 0
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._fed - self._decoded
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[_RECORD]:
+        self._unpacker.feed(data)
+        self._fed += len(data)
+        records: list[_RECORD] = []
+        for record in self._unpacker:
+            records.append(record)
+            self._decoded = t.cast(int, self._unpacker.tell())
+        if eof and self.pending:
+            raise ValueError("AOF ends with an incomplete record")
+        return records
+
+
+@t.final
+class _JsonSnapshotDecoder(Decoder):
+    """Decoder of the JSON db file, that yields pairs as soon as possible.
+
+    If ``lazy_codec`` is given, values are yielded as :class:`LazyValue` with
+    their original text.
+    """
+
+    def __init__(self, *, lazy_codec: Codec | None = None) -> None:
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._parser = _ObjectStreamParser(raw=lazy_codec is not None)
+        self._lazy_codec = lazy_codec
+
+    @property
+    @te.override
+    def pending(self) -> int:
+        return self._parser.pending
+
+    @te.override
+    def feed(self, data: bytes, *, eof: bool) -> list[t.Any]:
+        items = self._parser.feed(self._utf8.decode(data, final=eof), eof=eof)
+        codec = self._lazy_codec
+        if codec is None:
+            return items
+        return [
+            (key, LazyValue(codec, t.cast(str, value).encode()))
+            for key, value in items
+        ]
+
+
+@t.final
+class _ObjectStreamParser:
+    """Parser of a top-level JSON object, that is fed by chunks of text.
+
+    Every complete ``key: value`` pair is returned as soon as it is parsed,
+    and only the unparsed tail of the text is kept. If ``raw`` is ``True``,
+    values are returned as their original text.
+    """
+
+    _START, _FIRST, _ITEM, _SEPARATOR, _END = range(5)
+
+    def __init__(self, *, raw: bool = False) -> None:
+        # the same C scanner, that is used by `json.loads`
+        self._scan = make_scanner(t.cast(t.Any, json.JSONDecoder()))
+        self._buffer = ""
+        self._state = self._START
+        self._raw = raw
+
+    @property
+    def pending(self) -> int:
+        """How many characters are waiting for the rest of their value."""
+        return len(self._buffer)
+
+    def feed(
+        self, text: str, *, eof: bool
+    ) -> list[tuple[str, SERIALIZABLE_TYPE]]:
+        """Parse as many pairs as possible, with ``text`` appended.
+
+        Raises:
+            json.JSONDecodeError: If the text is not a valid JSON object.
+        """
+        buffer = self._buffer + text
+        length = len(buffer)
+        position = 0
+        state = self._state
+        skip = _WHITESPACE.match
+        items: list[tuple[str, SERIALIZABLE_TYPE]] = []
+
+        while True:
+            if position < length and buffer[position] in _WHITESPACE_CHARS:
+                position = skip(buffer, position).end()  # pyright: ignore[reportOptionalMemberAccess]
+            if position == length:
+                break
+
+            if state == self._START:
+                if buffer[position] != "{":
+                    raise json.JSONDecodeError(
+                        "Expecting '{'", buffer, position
+                    )
+                position += 1
+                state = self._FIRST
+            elif state == self._FIRST and buffer[position] == "}":
+                position += 1
+                state = self._END
+            elif state in (self._FIRST, self._ITEM):
+                item = self._decode_item(buffer, position, eof=eof)
+                if item is None:
+                    break  # wait for more text
+                key, value, position = item
+                items.append((key, value))
+                state = self._SEPARATOR
+            elif state == self._SEPARATOR:
+                if buffer[position] not in ",}":
+                    raise json.JSONDecodeError(
+                        "Expecting ',' delimiter", buffer, position
+                    )
+                state = self._ITEM if buffer[position] == "," else self._END
+                position += 1
+            else:
+                raise json.JSONDecodeError("Extra data", buffer, position)
+
+        self._buffer = buffer[position:]
+        self._state = state
+        if eof and state not in (self._START, self._END):
+            raise json.JSONDecodeError("Unexpected end of file", buffer, length)
+        return items
+
+    def _decode_item(
+        self, buffer: str, position: int, *, eof: bool
+    ) -> tuple[str, SERIALIZABLE_TYPE, int] | None:
+        """Decode ``key: value`` pair, starting at ``position``.
+
+        Returns:
+            Key, value and position after the value, or ``None`` if the pair
+            is not complete yet.
+        """
+        length = len(buffer)
+        value: object = None
+        error: json.JSONDecodeError | None = None
+        if buffer[position] != '"':
+            raise json.JSONDecodeError(
+                "Expecting property name enclosed in double quotes",
+                buffer,
+                position,
+            )
+        try:
+            key, position = self._scan(buffer, position)
+            if position < length and buffer[position] in _WHITESPACE_CHARS:
+                position = _WHITESPACE.match(buffer, position).end()  # pyright: ignore[reportOptionalMemberAccess]
+            if position < length and buffer[position] == ":":
+                start = _WHITESPACE.match(buffer, position + 1).end()  # pyright: ignore[reportOptionalMemberAccess]
+                # the value is still parsed, to find where it ends
+                value, position = self._scan(buffer, start)
+                if self._raw:
+                    value = buffer[start:position]
+            elif position < length or eof:
+                # raised outside of `try`, so it is not mistaken for a cut pair
+                error = json.JSONDecodeError(
+                    "Expecting ':' delimiter", buffer, position
+                )
+            else:
+                return None
+        except StopIteration as exception:
+            # nothing to decode at this position, usually end of the text
+            if eof:
+                raise json.JSONDecodeError(
+                    "Expecting value", buffer, t.cast(int, exception.value)
+                ) from None
+            return None
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            return None  # the pair may be cut in half
+        else:
+            if error is not None:
+                raise error
+
+        # a number at the end of the text may be cut in half too, then the
+        # scanner accepts only its beginning (``1`` out of ``1.``)
+        if not eof and _NUMBER_CHARS.match(buffer, position).end() == length:  # pyright: ignore[reportOptionalMemberAccess]
+            return None
+        return t.cast(str, key), t.cast("SERIALIZABLE_TYPE", value), position
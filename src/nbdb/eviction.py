@@ -0,0 +1,178 @@
+"""Approximate eviction of keys, when :class:`~nbdb.storage.Storage` is over its limits.
+
+Same as in Redis, nothing here is exact, so bookkeeping costs O(1) per
+change. Memory usage is estimated as number of keys multiplied by average
+size of a key with its value, and the average is learned from values, that
+are set or sampled. Victims are picked from a few random keys, not from all
+of them.
+"""
+
+from __future__ import annotations
+
+import random
+import sys
+import time
+import typing as t
+
+import typing_extensions as te
+
+from nbdb.codec import LazyValue
+
+if t.TYPE_CHECKING:
+    import collections.abc as c
+
+    from nbdb.storage import SERIALIZABLE_TYPE
+
+EVICTION_POLICY: te.TypeAlias = (
+    't.Literal["allkeys-lru", "allkeys-lfu", "volatile-ttl"]'
+)
+"""Which keys are evicted first, see ``eviction_policy`` in :func:`Storage.init() <nbdb.storage.Storage.init>`."""
+
+_LFU_INIT = 5
+"""Frequency counter of new keys, so they aren't evicted right away."""
+_LFU_LOG_FACTOR = 10
+"""How fast frequency counter saturates, same as ``lfu-log-factor`` in Redis."""
+_LFU_DECAY_MINUTES = 1
+"""Frequency counter is decremented every this many minutes without access."""
+_SIZE_SAMPLES = 100
+"""How many random keys are measured, to estimate the average size initially."""
+_SIZE_SMOOTHING = 0.01
+"""Weight of every new measured value in the average size."""
+
+
+def estimate_size(value: SERIALIZABLE_TYPE | LazyValue) -> int:
+    """Return rough size of the value in memory, including nested values."""
+    if isinstance(value, LazyValue):
+        return sys.getsizeof(value) + sys.getsizeof(value.data)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in t.cast("list[SERIALIZABLE_TYPE]", value):
+            size += estimate_size(item)
+    return size
+
+
+@t.final
+class Evictor:
+    """Track accesses to keys and pick keys to evict.
+
+    Keys are sampled from a list, because Python dicts can't return a random
+    key. Deleted keys are not removed from it, they are just skipped, and the
+    list is rebuilt, when they become the majority, so its size stays
+    proportional to the number of keys.
+    """
+
+    def __init__(self, policy: EVICTION_POLICY, *, samples: int) -> None:
+        if samples < 1:
+            raise ValueError(
+                f"Number of samples must be positive, not {samples}"
+            )
+        self.policy: EVICTION_POLICY = policy
+        self._samples = samples
+        # the last access (LRU), or minutes of the last decay and frequency
+        # counter packed into one number (LFU), same as in Redis
+        self._access: dict[str, int] = {}
+        self._clock = 0
+        self._keys: list[str] = []
+        self._key_size = 0.0
+
+    @property
+    def key_size(self) -> float:
+        """Estimated average size of a key with its value in bytes."""
+        return self._key_size
+
+    def reset(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        """Start tracking from scratch, after the data was read."""
+        self._access = {}
+        self._keys = list(data)
+        sample = random.sample(self._keys, min(len(self._keys), _SIZE_SAMPLES))
+        self._key_size = (
+            sum(sys.getsizeof(key) + estimate_size(data[key]) for key in sample)
+            / len(sample)
+            if sample
+            else 0.0
+        )
+
+    def add(
+        self, key: str, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        """Register a new key, that is not in ``data`` yet."""
+        self._compact(data)
+        self._keys.append(key)
+
+    def _compact(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        """Rebuild the list of keys, if it is mostly deleted keys."""
+        if len(self._keys) > 2 * len(data) + self._samples:
+            self._keys = list(data)
+
+    def remove(self, key: str) -> None:
+        """Forget accesses of a deleted key."""
+        _ = self._access.pop(key, None)
+
+    def measure(self, key: str, value: SERIALIZABLE_TYPE | LazyValue) -> None:
+        """Update the average size with a value, that was set or sampled."""
+        size = sys.getsizeof(key) + estimate_size(value)
+        if not self._key_size:
+            self._key_size = size
+        else:
+            self._key_size += (size - self._key_size) * _SIZE_SMOOTHING
+
+    def touch(self, key: str) -> None:
+        """Record an access to the key."""
+        if self.policy == "allkeys-lru":
+            self._clock += 1
+            self._access[key] = self._clock
+        elif self.policy == "allkeys-lfu":
+            counter = self._frequency(key)
+            # logarithmic counter, that fits into 8 bits, see
+            # https://redis.io/docs/latest/develop/reference/eviction/
+            if counter < 255 and random.random() < 1 / (
+                max(counter - _LFU_INIT, 0) * _LFU_LOG_FACTOR + 1
+            ):
+                counter += 1
+            self._access[key] = _minutes() << 8 | counter
+
+    def _frequency(self, key: str) -> int:
+        """Return frequency counter of the key, decayed by the time since the last access."""
+        packed = self._access.get(key)
+        if packed is None:
+            return _LFU_INIT
+        periods = (_minutes() - (packed >> 8)) // _LFU_DECAY_MINUTES
+        return max((packed & 0xFF) - periods, 0)
+
+    def pick(
+        self,
+        data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue],
+        excluded: c.Container[str],
+    ) -> str | None:
+        """Pick the least recently or frequently used key out of a few random ones.
+
+        Returns:
+            ``None`` if there is nothing to evict.
+        """
+        self._compact(data)
+        candidates: list[str] = []
+        # give up, if almost everything is excluded or already deleted
+        for _ in range(self._samples * 4):
+            if len(candidates) == self._samples or not self._keys:
+                break
+            key = random.choice(self._keys)
+            if key in data and key not in excluded:
+                candidates.append(key)
+                self.measure(key, data[key])
+        if not candidates:
+            return None
+
+        if self.policy == "allkeys-lfu":
+            return min(candidates, key=self._frequency)
+        return min(candidates, key=lambda key: self._access.get(key, 0))
+
+
+def _minutes() -> int:
+    return int(time.monotonic() // 60)
@@ -0,0 +1,273 @@
+"""Storage, that splits keys between a few independent :class:`~nbdb.storage.Storage` instances.
+
+:class:`~nbdb.storage.Storage` rewrites the whole db file on every write, so
+one frequently changed key makes every write as expensive as the whole
+database. Here keys are split by their hash between shards, every shard has
+its own db file, AOF and background writing, so a change makes only its
+shard dirty, and only dirty shards are written.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import re
+import typing as t
+import zlib
+from pathlib import Path
+
+import typing_extensions as te
+
+from nbdb.storage import RESERVED_PREFIX, Storage
+
+if t.TYPE_CHECKING:
+    import collections.abc as c
+
+    from nbdb.storage import SERIALIZABLE_TYPE
+
+_SHARD_NAME = re.compile(r"shard-(\d+)\.json")
+
+
+@t.final
+class ShardedStorage:
+    """Key-value store, that splits keys between a few :class:`~nbdb.storage.Storage` shards."""
+
+    def __init__(self, path: Path | str, shards: c.Sequence[Storage]) -> None:
+        self._path = Path(path)
+        self._shards = shards
+
+    @classmethod
+    async def init(
+        cls,
+        path: Path | str,
+        *,
+        shards: int = 8,
+        **kwargs: t.Any,
+    ) -> te.Self:
+        """Python doesn't have async init methods, so we have to use this.
+
+        Arguments:
+            path:
+                Path to a directory, that is allocated entirely to the
+                database. It is created if it doesn't exist.
+            shards:
+                How many shards keys are split between. It can't be changed
+                after the database was created.
+            kwargs:
+                Passed to :func:`Storage.init() <nbdb.storage.Storage.init>`
+                of every shard, so every shard writes itself by its own
+                schedule, for example after ``write_interval``.
+
+        Raises:
+            ValueError: If the database was created with another number of shards.
+        """
+        if shards < 1:
+            raise ValueError(f"Number of shards must be positive, not {shards}")
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        existing = [
+            int(match[1])
+            for file in path.iterdir()
+            if (match := _SHARD_NAME.fullmatch(file.name))
+        ]
+        if existing and max(existing) + 1 != shards:
+            raise ValueError(
+                f"Database in {path} has {max(existing) + 1} shards,"
+                f" but {shards} were requested"
+            )
+
+        return cls(
+            path,
+            await asyncio.gather(
+                *(
+                    Storage.init(path / f"shard-{i}.json", **kwargs)
+                    for i in range(shards)
+                )
+            ),
+        )
+
+    @property
+    def shards(self) -> c.Sequence[Storage]:
+        """Underlying storages, keys are split between them by :func:`shard_of`."""
+        return self._shards
+
+    def shard_of(self, key: str) -> Storage:
+        """Return shard, that stores the key.
+
+        CRC32 is used instead of :py:func:`hash`, because the latter is
+        randomized between runs.
+        """
+        return self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+
+    def _split(self, keys: c.Iterable[str]) -> dict[Storage, list[str]]:
+        """Group keys by their shards."""
+        groups: dict[Storage, list[str]] = {}
+        for key in keys:
+            groups.setdefault(self.shard_of(key), []).append(key)
+        return groups
+
+    @property
+    def pending_changes(self) -> int:
+        """How many changes were made since the last write of their shards."""
+        return sum(shard.pending_changes for shard in self._shards)
+
+    async def read(self) -> None:
+        """Read all shards, see :func:`Storage.read() <nbdb.storage.Storage.read>`."""
+        _ = await asyncio.gather(*(shard.read() for shard in self._shards))
+
+    async def write(self, *, only_changed: bool = True) -> None:
+        """Write shards concurrently.
+
+        Arguments:
+            only_changed:
+                If ``True``, shards without :attr:`pending_changes` are
+                skipped, so writing costs only as much as the changed shards.
+        """
+        _ = await asyncio.gather(
+            *(
+                shard.write()
+                for shard in self._shards
+                if shard.pending_changes or not only_changed
+            )
+        )
+
+    async def close(self) -> None:
+        """Close all shards, see :func:`Storage.close() <nbdb.storage.Storage.close>`."""
+        _ = await asyncio.gather(*(shard.close() for shard in self._shards))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.shard_of(key)
+
+    async def set(
+        self, key: str, value: SERIALIZABLE_TYPE, *, ttl: float | None = None
+    ) -> None:
+        """Set a key to value.
+
+        Setting a value to ``None`` deletes the key. See
+        :func:`Storage.set() <nbdb.storage.Storage.set>` for ``ttl``.
+
+        Raises:
+            KeyError: If you try to delete a key, that doesn't exist.
+        """
+        await self.shard_of(key).set(key, value, ttl=ttl)
+
+    async def set_many(
+        self,
+        data: c.Mapping[str, SERIALIZABLE_TYPE],
+        *,
+        ttl: float | None = None,
+    ) -> None:
+        """Set many keys at once, same as :func:`Storage.set_many() <nbdb.storage.Storage.set_many>`.
+
+        Every shard applies its part of changes in one step, but changes in
+        different shards are independent, so after a crash only part of them
+        may be replayed from AOF.
+
+        Raises:
+            KeyError:
+                If you try to delete a key, that doesn't exist. Nothing is
+                changed in this case.
+            ValueError:
+                If a key starts with ``#nbdb:``, which is reserved. Nothing is
+                changed in this case too.
+        """
+        # checked before any shard is changed, same as in `Storage.set_many`
+        for key, value in data.items():
+            if value is None and key not in self:
+                raise KeyError(key)
+            if key.startswith(RESERVED_PREFIX):
+                raise ValueError(f"Key {key!r} is reserved")
+
+        _ = await asyncio.gather(
+            *(
+                shard.set_many({key: data[key] for key in keys}, ttl=ttl)
+                for shard, keys in self._split(data).items()
+            )
+        )
+
+    async def get(self, key: str) -> SERIALIZABLE_TYPE:
+        return await self.shard_of(key).get(key)
+
+    async def expire(self, key: str, ttl: float | None) -> bool:
+        """See :func:`Storage.expire() <nbdb.storage.Storage.expire>`."""
+        return await self.shard_of(key).expire(key, ttl)
+
+    def ttl(self, key: str) -> float | None:
+        """See :func:`Storage.ttl() <nbdb.storage.Storage.ttl>`."""
+        return self.shard_of(key).ttl(key)
+
+    def version(self, key: str) -> int:
+        """See :func:`Storage.version() <nbdb.storage.Storage.version>`.
+
+        Versions are assigned by every shard independently, so they can be
+        compared only between versions of the same key.
+        """
+        return self.shard_of(key).version(key)
+
+    async def get_with_version(self, key: str) -> tuple[SERIALIZABLE_TYPE, int]:
+        """See :func:`Storage.get_with_version() <nbdb.storage.Storage.get_with_version>`."""
+        return await self.shard_of(key).get_with_version(key)
+
+    async def compare_and_set(
+        self, key: str, expected_version: int, value: SERIALIZABLE_TYPE
+    ) -> bool:
+        """See :func:`Storage.compare_and_set() <nbdb.storage.Storage.compare_and_set>`."""
+        return await self.shard_of(key).compare_and_set(
+            key, expected_version, value
+        )
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        """See :func:`Storage.incr() <nbdb.storage.Storage.incr>`."""
+        return await self.shard_of(key).incr(key, amount)
+
+    async def decr(self, key: str, amount: int = 1) -> int:
+        """See :func:`Storage.decr() <nbdb.storage.Storage.decr>`."""
+        return await self.shard_of(key).decr(key, amount)
+
+    async def append_to_list(self, key: str, *values: SERIALIZABLE_TYPE) -> int:
+        """See :func:`Storage.append_to_list() <nbdb.storage.Storage.append_to_list>`."""
+        return await self.shard_of(key).append_to_list(key, *values)
+
+    async def merge_dict(
+        self, key: str, data: c.Mapping[str, SERIALIZABLE_TYPE]
+    ) -> None:
+        """See :func:`Storage.merge_dict() <nbdb.storage.Storage.merge_dict>`."""
+        await self.shard_of(key).merge_dict(key, data)
+
+    async def set_path(
+        self, key: str, pointer: str, value: SERIALIZABLE_TYPE
+    ) -> None:
+        """See :func:`Storage.set_path() <nbdb.storage.Storage.set_path>`."""
+        await self.shard_of(key).set_path(key, pointer, value)
+
+    async def delete_path(self, key: str, pointer: str) -> None:
+        """See :func:`Storage.delete_path() <nbdb.storage.Storage.delete_path>`."""
+        await self.shard_of(key).delete_path(key, pointer)
+
+    async def get_many(
+        self, keys: c.Iterable[str]
+    ) -> dict[str, SERIALIZABLE_TYPE]:
+        """Get values of many keys at once.
+
+        Keys that don't exist are silently skipped, so the result may contain
+        less keys than you asked for.
+        """
+        result: dict[str, SERIALIZABLE_TYPE] = {}
+        for shard, shard_keys in self._split(keys).items():
+            result.update(await shard.get_many(shard_keys))
+        return result
+
+    async def delete_many(self, keys: c.Iterable[str]) -> int:
+        """Delete many keys at once, keys that don't exist are silently skipped.
+
+        Returns:
+            How many keys were actually deleted.
+        """
+        return sum(
+            await asyncio.gather(
+                *(
+                    shard.delete_many(shard_keys)
+                    for shard, shard_keys in self._split(keys).items()
+                )
+            )
+        )
@@ -1,16 +1,36 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import collections.abc as c
+import contextlib
+import gc
+import heapq
 import logging
+import re
+import sys
+import time
 import typing as t
 from pathlib import Path
 
 import aiofile
 import typing_extensions as te
 
+from nbdb.cache import CacheStats, LRUCache
+from nbdb.codec import (
+    Codec,
+    Decoder,
+    HEADER_MAX_SIZE,
+    IndexedCodec,
+    JsonCodec,
+    LazyValue,
+    get_codec,
+    parse_header,
+    resolve,
+)
+from nbdb.eviction import EVICTION_POLICY, Evictor
+
 if t.TYPE_CHECKING:
-    import collections.abc as c
+    import types
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +39,246 @@ SERIALIZABLE_TYPE: te.TypeAlias = "str | int | JSON_TYPE | None"
 JSON_TYPE: te.TypeAlias = (
     "c.Mapping[str, SERIALIZABLE_TYPE] | c.Sequence[SERIALIZABLE_TYPE]"
 )
+FSYNC_POLICY: te.TypeAlias = 't.Literal["always", "everysec", "no"]'
+"""When AOF is synced to disk, see ``fsync`` in :func:`Storage.init`."""
+_RECORD: te.TypeAlias = (
+    "c.Mapping[str, SERIALIZABLE_TYPE] | list[SERIALIZABLE_TYPE]"
+)
+"""AOF record, either new values of keys or an operation, see :func:`_apply_op`."""
+
+_WRITE_LOOP_TICK = 1.0
+"""How often (in seconds) background writing checks whether it should write."""
+_READ_CHUNK_SIZE = 1024 * 1024
+"""Size (in bytes) of chunks, in which db file and AOF are read."""
+RESERVED_PREFIX = "#nbdb:"
+"""Keys with this prefix are reserved for metadata and can't be set."""
+_VERSIONS_KEY = RESERVED_PREFIX + "versions"
+"""Key of coalesced AOF records with versions of keys, see :func:`_split_record`."""
+_VERSION_KEY = RESERVED_PREFIX + "version"
+"""Key of AOF record with its explicit version, and of the db file and deltas with the last version, see :func:`Storage.version`."""
+_EXPIRES_KEY = RESERVED_PREFIX + "expires"
+"""Key of AOF record, the db file and deltas with deadlines of keys, see ``ttl`` in :func:`Storage.set`."""
+_EXPIRE_RETRY_DELAY = 1.0
+"""How long (in seconds) background expiry waits after an error."""
+_EXPIRE_BATCH_SIZE = 1000
+"""How many keys are expired at once, before yielding to the event loop."""
+
+
+class ReadStats(t.NamedTuple):
+    """Statistics of the last :func:`Storage.read`."""
+
+    bytes: int
+    """Size of the db file and AOF."""
+    keys: int
+    """How many keys were loaded."""
+    seconds: float
+    """How long the read took."""
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+class ConflictError(Exception):
+    """Watched key was changed by somebody else, see :func:`Storage.transaction`."""
+
+    def __init__(self, key: str) -> None:
+        super().__init__(f"Watched key {key!r} was changed")
+        self.key: str = key
+
+
+class MemoryStats(t.NamedTuple):
+    """Memory usage of values, see :attr:`Storage.memory_stats`."""
+
+    keys: int
+    lazy_values: int
+    """How many values are kept encoded, until they are read."""
+    lazy_bytes: int
+    """Total size of encoded values."""
+    cache: CacheStats
+    """Statistics of the cache of decoded values."""
+    estimated_bytes: int = 0
+    """Estimated size of keys and values, only with ``max_memory``, see :func:`Storage.init`."""
+    evicted_keys: int = 0
+    """How many keys were evicted since the storage was created."""
+
+
+def _apply_op(
+    value: SERIALIZABLE_TYPE, op: list[SERIALIZABLE_TYPE]
+) -> SERIALIZABLE_TYPE:
+    """Apply operation record to the value, ``None`` means a missing key.
+
+    Operation is ``[name, key, argument]``, it is written to AOF instead of
+    the resulting value, see :func:`Storage.incr` and others. It may have
+    an explicit version as the fourth item, see :func:`_split_record`.
+
+    Raises:
+        KeyError: If a path doesn't exist.
+        TypeError: If the operation can't be applied to this value.
+        ValueError: If the operation is unknown.
+    """
+    name, key, argument = op[:3]
+    if name == "incr":
+        value = 0 if value is None else value
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise TypeError(f"Value of {key!r} is not an integer")
+        return value + t.cast(int, argument)
+    if name == "append":
+        value = [] if value is None else value
+        if isinstance(value, str) or not isinstance(value, c.Sequence):
+            raise TypeError(f"Value of {key!r} is not a list")
+        return [*value, *t.cast("list[SERIALIZABLE_TYPE]", argument)]
+    if name == "merge":
+        value = {} if value is None else value
+        if not isinstance(value, c.Mapping):
+            raise TypeError(f"Value of {key!r} is not a mapping")
+        return {**value, **t.cast("dict[str, SERIALIZABLE_TYPE]", argument)}
+    if name in ("set_path", "delete_path"):
+        if value is None:
+            raise KeyError(key)
+        if name == "set_path":
+            pointer, new_value = t.cast("list[t.Any]", argument)
+        else:
+            pointer, new_value = argument, None
+        return _change_path(
+            value,
+            _parse_pointer(t.cast(str, pointer)),
+            new_value,
+            delete=name == "delete_path",
+        )
+    raise ValueError(f"Unknown operation {name!r}")
+
+
+def _split_record(
+    record: c.Mapping[str, SERIALIZABLE_TYPE], version: int
+) -> tuple[
+    c.Mapping[str, SERIALIZABLE_TYPE],
+    c.Mapping[str, int | None] | None,
+    c.Mapping[str, int] | None,
+    int,
+]:
+    """Return changes of AOF record, new deadlines and versions of keys, and version of the record.
+
+    Usually every record is the next version after ``version``, which is the
+    version of the previous record, so versions aren't written to AOF at all.
+    But coalesced and rewritten records replace many changes, so they store
+    the version explicitly under :data:`_VERSION_KEY`. Keys of a coalesced
+    record were changed at different times, so versions of those, that
+    differ from the record version, are stored under :data:`_VERSIONS_KEY`.
+
+    Deadlines are in milliseconds since the epoch, ``None`` means that the
+    key doesn't expire anymore.
+    """
+    if _VERSION_KEY not in record and _EXPIRES_KEY not in record:
+        return record, None, None, version + 1
+    explicit = record.get(_VERSION_KEY)
+    return (
+        {
+            key: value
+            for key, value in record.items()
+            if not key.startswith(RESERVED_PREFIX)
+        },
+        t.cast("c.Mapping[str, int | None] | None", record.get(_EXPIRES_KEY)),
+        t.cast("c.Mapping[str, int] | None", record.get(_VERSIONS_KEY)),
+        version + 1 if explicit is None else t.cast(int, explicit),
+    )
+
+
+def _now_ms() -> int:
+    """Return current time in milliseconds since the epoch, used for deadlines."""
+    return time.time_ns() // 1_000_000
+
+
+def _log_deletion_failure(future: asyncio.Future[None]) -> None:
+    if not future.cancelled() and (exception := future.exception()) is not None:
+        logger.error("Couldn't write deleted keys to AOF", exc_info=exception)
+
+
+def _parse_pointer(pointer: str) -> list[str]:
+    """Split `JSON pointer <https://datatracker.ietf.org/doc/html/rfc6901>`_.
+
+    Raises:
+        ValueError: If the pointer doesn't start with ``/``.
+    """
+    if not pointer:
+        return []
+    if not pointer.startswith("/"):
+        raise ValueError(f"JSON pointer must start with '/', got {pointer!r}")
+    return [
+        part.replace("~1", "/").replace("~0", "~")
+        for part in pointer[1:].split("/")
+    ]
+
+
+def _change_path(
+    document: SERIALIZABLE_TYPE,
+    parts: list[str],
+    value: SERIALIZABLE_TYPE,
+    *,
+    delete: bool,
+) -> SERIALIZABLE_TYPE:
+    """Return copy of the document, with value at the path set or deleted.
+
+    Only containers on the path are copied, not the whole document, because
+    the original may be serialized in another thread right now.
+
+    Raises:
+        KeyError: If the path doesn't exist (except of its last part).
+        TypeError: If something on the path is not a container.
+        ValueError: If a list index is invalid.
+    """
+    if not parts:
+        return value
+    part, rest = parts[0], parts[1:]
+
+    if isinstance(document, c.Mapping):
+        mapping = dict(document)
+        if part not in mapping and (rest or delete):
+            raise KeyError(part)
+        if rest:
+            mapping[part] = _change_path(
+                mapping[part], rest, value, delete=delete
+            )
+        elif delete:
+            del mapping[part]
+        else:
+            mapping[part] = value
+        return mapping
+
+    if isinstance(document, str) or not isinstance(document, c.Sequence):
+        raise TypeError(f"Can't get {part!r} of {type(document).__name__}")
+    items = list(document)
+    # `-` is the end of the list, the same as in JSON Patch
+    if part == "-":
+        index = len(items)
+    elif part.isdigit() and (part == "0" or not part.startswith("0")):
+        index = int(part)
+    else:
+        raise ValueError(f"Invalid list index {part!r}")
+    if index > len(items) or (index == len(items) and (rest or delete)):
+        raise KeyError(part)
+
+    if rest:
+        items[index] = _change_path(items[index], rest, value, delete=delete)
+    elif delete:
+        del items[index]
+    elif index == len(items):
+        items.append(value)
+    else:
+        items[index] = value
+    return items
+
+
+@contextlib.contextmanager
+def _gc_paused() -> c.Iterator[None]:
+    """Disable cyclic garbage collector inside the block."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
 @t.final
@@ -29,20 +289,103 @@ class Storage:
     # since Python does not guarantee that `__del__` will be ever called
     instances: t.ClassVar[list[te.Self]] = []
 
-    def __init__(self, path: Path | str, *, indent: int | None) -> None:
+    def __init__(
+        self,
+        path: Path | str,
+        *,
+        codec: Codec,
+        fsync: FSYNC_POLICY,
+        coalesce_window: float,
+        serialize_in_thread: bool,
+        lazy_values: bool,
+        value_cache_size: int,
+        max_deltas: int,
+        max_memory: int | None = None,
+        max_keys: int | None = None,
+        evictor: Evictor | None = None,
+    ) -> None:
         self.instances.append(self)
 
-        self._data: dict[str, SERIALIZABLE_TYPE] = {}
+        # values of indexed db file (or of any db file, if `lazy_values` is
+        # set) are decoded on first access
+        self._data: dict[str, SERIALIZABLE_TYPE | LazyValue] = {}
+        self._lazy_values = lazy_values
+        self._value_cache: LRUCache[LazyValue, SERIALIZABLE_TYPE] = LRUCache(
+            value_cache_size
+        )
+        # version of every changed key and the last assigned version, keys,
+        # that weren't changed since the read, have `_base_version`, see
+        # `version`
+        self._versions: dict[str, int] = {}
+        self._version = 0
+        self._base_version = 0
+        # version before the first record of AOF, see `_split_record`
+        self._aof_base_version = 0
+        # deadlines of keys with TTL, in milliseconds since the epoch, and
+        # a min-heap of them; outdated heap entries are skipped, see
+        # `_expire_batch`
+        self._expires: dict[str, int] = {}
+        self._expiry_heap: list[tuple[int, str]] = []
+        # wakes up background expiry, when an earlier deadline is added
+        self._expiry_wakeup = asyncio.Event()
+        # limits of the storage, keys are evicted by `evictor` when they are
+        # exceeded, see `_make_room`
+        self._max_memory = max_memory
+        self._max_keys = max_keys
+        self._evictor = evictor
+        self._evicted = 0
         self._path = Path(path)
         self._tempfile = Path(str(self._path) + ".temp")
         # Append Only File, see https://redis.io/docs/latest/operate/oss_and_stack/management/persistence/
         self._aof_path = Path(str(self._path) + ".log.temp")
-        self._indent = indent
+        # AOF segment, that is being written to the db file right now, new
+        # records go to a fresh `_aof_path`
+        self._old_aof_path = Path(str(self._path) + ".log.old.temp")
+        # AOF, that is being rewritten, see `rewrite_aof`
+        self._new_aof_path = Path(str(self._path) + ".log.new.temp")
+        self._codec = codec
+        self._fsync = fsync
+        self._serialize_in_thread = serialize_in_thread
+        self._write_lock = asyncio.Lock()
+        # how many changes were made since the last successful `write`
+        self._changes = 0
+        self._last_write_changes = 0
+        self._last_write_time = time.monotonic()
+        self._last_read_stats = ReadStats(0, 0, 0.0)
+        # size of AOF after the last rewrite, `0` if it wasn't rewritten since
+        # the last write
+        self._aof_base_size = 0
+        # delta checkpoints, that were written after the db file, see `write`
+        self._max_deltas = max_deltas
+        self._deltas: list[Path] = []
+        self._next_delta = 0
+        # keys, that were changed since the last checkpoint
+        self._dirty: set[str] = set()
+        # the db file is broken, so the next write can't be a delta
+        self._full_write_needed = False
 
         # ensure that the db file exists
         self._path.touch(exist_ok=True)
 
-        self._write_loop_task: asyncio.Task[te.Never] = None  # pyright: ignore[reportAttributeAccessIssue]
+        self._write_loop_task: asyncio.Task[te.Never] | None = None
+
+        # AOF is kept open for the whole lifetime of the storage, records are
+        # queued by `_append_command` and written in batches by `_aof_writer`
+        self._aof_file: aiofile.FileIOWrapperBase | None = None
+        self._aof_lock = asyncio.Lock()
+        self._aof_queue: list[tuple[bytes, asyncio.Future[None]]] = []
+        self._aof_writer_task: asyncio.Task[None] | None = None
+        # whether something was written to AOF since the last fsync
+        self._aof_unsynced = False
+        self._fsync_loop_task: asyncio.Task[te.Never] | None = None
+        self._expire_loop_task: asyncio.Task[None] | None = None
+        # changes, that wait for the end of coalescing window, with last
+        # value and deadline of every key, see `_append_command`
+        self._coalesce_window = coalesce_window
+        self._coalesced: dict[str, SERIALIZABLE_TYPE] = {}
+        self._coalesced_expires: dict[str, int | None] = {}
+        self._coalesced_futures: list[asyncio.Future[None]] = []
+        self._coalesce_task: asyncio.Task[None] | None = None
 
     @classmethod
     async def init(
@@ -50,7 +393,22 @@ class Storage:
         path: Path | str,
         *,
         write_interval: int | t.Literal[False] = 5 * 60,
-        indent: int | None = 2,
+        save_points: c.Iterable[tuple[float, int]] = (),
+        aof_max_size: int | None = None,
+        aof_rewrite_percentage: int | None = None,
+        aof_rewrite_min_size: int = 1024 * 1024,
+        indent: int | str | None = 2,
+        codec: str | Codec = "json",
+        fsync: FSYNC_POLICY = "always",
+        coalesce_window: float = 0,
+        serialize_in_thread: bool = True,
+        lazy_values: bool = False,
+        value_cache_size: int = 32 * 1024 * 1024,
+        max_deltas: int = 0,
+        max_memory: int | None = None,
+        max_keys: int | None = None,
+        eviction_policy: EVICTION_POLICY = "allkeys-lru",
+        eviction_samples: int = 5,
     ) -> te.Self:
         """Python doesn't have async init methods, so we have to use this.
 
@@ -61,18 +419,153 @@ class Storage:
                 temp files near the db for technical reasons.
             write_interval:
                 How often we should write to database in seconds? Set to ``False``
-                to disable automatic writing at all.
+                to disable automatic writing by time. Nothing is written if
+                there were no changes since the last write.
+            save_points:
+                Additional triggers for background writing, works the same as
+                ``save`` in Redis. Every item is ``(seconds, changes)``, the
+                database is written if at least ``changes`` changes were made
+                and at least ``seconds`` passed since the last write. For
+                example, ``[(60, 1000)]`` means "write if 1000 keys were
+                changed during the last minute".
+            aof_max_size:
+                If it is not ``None``, the database is also written when AOF
+                grows above this size in bytes. This keeps replay on startup
+                fast after a burst of writes.
+            aof_rewrite_percentage:
+                If it is not ``None``, AOF is compacted in background by
+                :func:`rewrite_aof` when it grows by this many percents since
+                the last rewrite (or since the last write), works the same as
+                ``auto-aof-rewrite-percentage`` in Redis. This is much cheaper
+                than writing the whole database if only a few keys are
+                changed over and over.
+            aof_rewrite_min_size:
+                AOF is never rewritten, while it is smaller than this many
+                bytes, same as ``auto-aof-rewrite-min-size`` in Redis.
             indent:
                 If it is not ``None``, data in database file will be pretty
                 printed with that indent level. Value is directly passed to
-                :py:func:`json.dump`.
+                :py:func:`json.dump`. Only used by the ``"json"`` codec.
+            codec:
+                How the db file and AOF are serialized, either a name of
+                a codec (``"json"``, ``"orjson"``, ``"msgpack"`` or
+                ``"indexed"``, see :class:`~nbdb.codec.IndexedCodec`) or
+                a :class:`~nbdb.codec.Codec` instance. Any codec can be
+                compressed by prefixing it with ``"zlib:"``, ``"gzip:"`` or
+                ``"lzma:"``, see :class:`~nbdb.codec.CompressedCodec`. Only ``"json"`` is
+                human-readable, other codecs are faster, but the ``orjson``
+                and ``msgpack`` libraries must be installed separately. Every file records which codec
+                wrote it, so you can switch codecs at any time, old files are
+                still read correctly.
+            fsync:
+                When AOF should be synced to disk, works the same as
+                ``appendfsync`` in Redis.
+
+                - ``"always"``: every :func:`set` waits until its record is
+                  synced to disk (using ``fdatasync``, like Redis does, which
+                  skips metadata like modification time, but not file size).
+                  The slowest, but nothing can be lost.
+                - ``"everysec"``: AOF is synced (also with ``fdatasync``) once
+                  per second in background, so you can lose at most one
+                  second of writes.
+                - ``"no"``: leave it to the OS, which usually flushes data
+                  every 30 seconds on Linux. The fastest option.
+            coalesce_window:
+                If it is positive, changes are collected for this many
+                seconds before they are written to AOF, and only the last
+                value of every key is written. This saves a lot of AOF
+                writes (and fsyncs) for keys, that are changed many times per
+                second. :func:`set` still waits until its change is written,
+                so it takes up to this much longer.
+            serialize_in_thread:
+                If ``True``, :func:`write` serializes the database in a
+                separate thread, so it doesn't block the event loop. It works
+                on a shallow copy of the data, so you must not modify values
+                returned by :func:`get` in place.
+            lazy_values:
+                If ``True``, values from the db file are kept encoded and
+                decoded on every :func:`get`, which saves a lot of memory if
+                big values are rarely read. Values, that were changed after
+                the last write, are still kept decoded. See
+                :attr:`memory_stats`.
+            value_cache_size:
+                When ``lazy_values`` is set, recently decoded values are
+                cached, until their total encoded size exceeds this many
+                bytes. Set to ``0`` to disable the cache.
+            max_deltas:
+                If it is positive, :func:`write` writes only keys, that were
+                changed since the previous write, to a separate delta file,
+                so its cost depends on the number of changes, not on the
+                size of the database. When there are this many delta files,
+                or they grow bigger than the db file, the next write folds
+                them into the db file.
+            max_memory:
+                If it is not ``None``, keys are evicted, when keys and
+                values take more than this many bytes, like ``maxmemory``
+                in Redis. Memory usage is estimated from sizes of a few
+                values (see :attr:`memory_stats`), so it is approximate.
+            max_keys:
+                If it is not ``None``, keys are evicted, when there are more
+                than this many of them.
+            eviction_policy:
+                Which keys are evicted, same as ``maxmemory-policy`` in
+                Redis. ``"allkeys-lru"`` evicts the least recently used
+                keys, ``"allkeys-lfu"`` the least frequently used ones, and
+                ``"volatile-ttl"`` only keys with TTL, that expire first (see
+                ``ttl`` in :func:`set`). If there is nothing to evict, the
+                limits are exceeded.
+            eviction_samples:
+                LRU and LFU are approximate, the victim is the best one out
+                of this many random keys, same as ``maxmemory-samples`` in
+                Redis. More samples are more precise, but slower.
         """
-        instance = cls(path, indent=indent)
+        instance = cls(
+            path,
+            codec=JsonCodec(indent=indent)
+            if codec == "json"
+            else get_codec(codec)
+            if isinstance(codec, str)
+            else codec,
+            fsync=fsync,
+            coalesce_window=coalesce_window,
+            serialize_in_thread=serialize_in_thread,
+            lazy_values=lazy_values,
+            value_cache_size=value_cache_size,
+            max_deltas=max_deltas,
+            max_memory=max_memory,
+            max_keys=max_keys,
+            evictor=Evictor(eviction_policy, samples=eviction_samples)
+            if max_memory is not None or max_keys is not None
+            else None,
+        )
         await instance.read()
 
-        if write_interval:
+        save_points = tuple(save_points)
+        for seconds, changes in save_points:
+            if seconds < 0 or changes < 1:
+                raise ValueError(
+                    f"Invalid save point ({seconds}, {changes}), seconds must"
+                    " be non-negative and changes must be positive"
+                )
+
+        if (
+            write_interval
+            or save_points
+            or aof_max_size is not None
+            or aof_rewrite_percentage is not None
+        ):
             instance._write_loop_task = asyncio.create_task(
-                instance._write_loop(write_interval)
+                instance._write_loop(
+                    write_interval or None,
+                    save_points=save_points,
+                    aof_max_size=aof_max_size,
+                    aof_rewrite_percentage=aof_rewrite_percentage,
+                    aof_rewrite_min_size=aof_rewrite_min_size,
+                )
+            )
+        if fsync == "everysec":
+            instance._fsync_loop_task = asyncio.create_task(
+                instance._fsync_loop()
             )
 
         return instance
@@ -83,7 +576,18 @@ class Storage:
         This method is usually called only on initialization, but if you added
         some data to the file manually, you can call this method to sync
         in-memory state with what is written on disk.
+
+        The db file is parsed incrementally, key by key, so we never hold the
+        whole file in memory. Files of the ``"indexed"`` codec are
+        memory-mapped instead, and their values are decoded on the first
+        access. Delta files (see ``max_deltas`` in :func:`init`) are applied
+        on top of the db file, and AOF on top of them. Keys, that expired
+        meanwhile (see ``ttl`` in :func:`set`), are deleted at the end. See
+        :attr:`last_read_stats` for how long it took.
         """
+        start = time.perf_counter()
+        read_bytes = 0
+
         path = self._path
         if self._tempfile.exists():
             logger.warning(
@@ -91,95 +595,1526 @@ class Storage:
             )
             path = self._tempfile
 
-        if path.exists():
-            async with aiofile.async_open(path, "r") as f:
-                content = t.cast(str, await f.read())
-                if content != "":
-                    self._data = json.loads(content)
-                else:
-                    self._data = {}
-        else:
+        # decoded data can't have reference cycles, but the garbage collector
+        # still walks through all new objects every few thousands of them,
+        # which makes decoding a few times slower
+        with _gc_paused():
+            self._changes = 0
             self._data = {}
+            self._versions = {}
+            self._version = 0
+            self._expires = {}
+            self._dirty = set()
+            self._value_cache.clear()
+            if path.exists():
+                read_bytes += path.stat().st_size
+                codec = await self._file_codec(path)
+                if isinstance(codec, IndexedCodec):
+                    self._data = codec.load(path)
+                else:
+                    async for items in self._decode_file(
+                        path,
+                        lambda codec: codec.lazy_snapshot_decoder()
+                        if self._lazy_values
+                        else codec.snapshot_decoder(),
+                    ):
+                        self._data.update(items)
+
+            if _VERSION_KEY in self._data:
+                self._version = t.cast(
+                    int, resolve(self._data.pop(_VERSION_KEY))
+                )
+            if _EXPIRES_KEY in self._data:
+                self._expires = t.cast(
+                    "dict[str, int]", resolve(self._data.pop(_EXPIRES_KEY))
+                )
+
+            read_bytes += await self._read_deltas(folded=path == self._tempfile)
+            # all loaded keys get the last version, as we don't know when they
+            # were changed; `or 1` is for files written by hand
+            if self._data:
+                self._version = self._version or 1
+            self._base_version = self._version
+
+            # old segment is left only if the last write has failed
+            for aof_path in (self._old_aof_path, self._aof_path):
+                self._aof_base_version = self._version
+                if not aof_path.exists():
+                    continue
+                read_bytes += aof_path.stat().st_size
+
+                async for records in self._decode_file(
+                    aof_path, lambda codec: codec.record_decoder()
+                ):
+                    self._apply_records(records)
+
+        # new records are appended to AOF, so it must be written by our codec
+        if (
+            self._aof_path.exists()
+            and (await self._file_codec(self._aof_path)).header
+            != self._codec.header
+        ):
+            async with self._aof_lock:
+                await self._close_aof()
+                await self._recode_aof()
+
+        self._expiry_heap = [
+            (deadline, key) for key, deadline in self._expires.items()
+        ]
+        heapq.heapify(self._expiry_heap)
+        now = _now_ms()
+        self._remove_expired(
+            [key for key, deadline in self._expires.items() if deadline <= now]
+        )
+        if self._expiry_heap:
+            self._wake_expiry()
+        if self._evictor is not None:
+            self._evictor.reset(self._data)
+            self._evict()
+
+        self._last_read_stats = stats = ReadStats(
+            read_bytes, len(self._data), time.perf_counter() - start
+        )
+        logger.info(
+            "Read %d keys (%d bytes) from %s in %.3fs (%.0f bytes/s)",
+            stats.keys,
+            stats.bytes,
+            path,
+            stats.seconds,
+            stats.bytes_per_second,
+        )
 
-        if self._aof_path.exists():
-            async with aiofile.AIOFile(self._aof_path, "r") as aof:
-                async for line in aiofile.LineReader(aof):
-                    if line == "\n":
-                        # first line is always empty, because it is easier
-                        # this way
+    async def _read_deltas(self, *, folded: bool) -> int:
+        """Apply delta files in order they were written.
+
+        Delta files are renamed to ``.folded`` before they are folded into
+        the db file, and deleted after that. So if the db file was written
+        successfully, folded deltas are already in it, otherwise (``folded``
+        is ``True``) they must be applied to the old db file too.
+
+        Returns:
+            Total size of applied delta files.
+        """
+        pattern = re.compile(
+            re.escape(self._path.name) + r"\.delta\.(\d+)(\.folded|\.temp)?"
+        )
+        deltas: list[tuple[int, Path]] = []
+        for path in self._path.parent.iterdir():
+            match = pattern.fullmatch(path.name)
+            if match is None:
+                continue
+            # unfinished delta or already folded one
+            if match[2] == ".temp" or (match[2] and not folded):
+                path.unlink()
+            else:
+                deltas.append((int(match[1]), path))
+        deltas.sort()
+
+        read_bytes = 0
+        data = self._data
+        for _, path in deltas:
+            read_bytes += path.stat().st_size
+            # deadlines of changed keys are replaced, even if they are missing
+            expires: dict[str, int] = {}
+            async for items in self._decode_file(
+                path, lambda codec: codec.snapshot_decoder()
+            ):
+                for key, value in items:
+                    if key == _VERSION_KEY:
+                        self._version = t.cast(int, resolve(value))
                         continue
+                    if key == _EXPIRES_KEY:
+                        expires = t.cast("dict[str, int]", resolve(value))
+                        continue
+                    if value is None:
+                        _ = data.pop(key, None)
+                    else:
+                        data[key] = value
+                    _ = self._expires.pop(key, None)
+            self._expires.update(expires)
 
-                    for key, value in t.cast(
-                        dict[str, SERIALIZABLE_TYPE], json.loads(line)
-                    ).items():
-                        await self.set(key, value, _replay=True)
+        self._deltas = [path for _, path in deltas]
+        self._next_delta = deltas[-1][0] + 1 if deltas else 0
+        self._full_write_needed = folded
+        return read_bytes
 
-    async def write(self) -> None:
-        """Save changes on disk.
+    def _delta_path(self, number: int) -> Path:
+        return Path(f"{self._path}.delta.{number}")
+
+    @property
+    def last_read_stats(self) -> ReadStats:
+        """Statistics of the last :func:`read`, useful to plan cold starts."""
+        return self._last_read_stats
 
-        You can also manually call this method whenever you want.
+    @property
+    def memory_stats(self) -> MemoryStats:
+        """How many values are kept encoded, see ``lazy_values`` in :func:`init`.
+
+        This walks through all values, so it is not free for big databases.
         """
-        if self._path.exists():
-            _ = self._path.rename(self._tempfile)
+        lazy_values = lazy_bytes = 0
+        for value in self._data.values():
+            if isinstance(value, LazyValue):
+                lazy_values += 1
+                lazy_bytes += len(value.data)
+        return MemoryStats(
+            len(self._data),
+            lazy_values,
+            lazy_bytes,
+            self._value_cache.stats,
+            round(len(self._data) * self._evictor.key_size)
+            if self._evictor is not None and self._max_memory is not None
+            else 0,
+            self._evicted,
+        )
 
-        async with aiofile.async_open(self._path, "w") as f:
+    async def _decode_file(
+        self,
+        path: Path,
+        decoder: c.Callable[[Codec], Decoder],
+        *,
+        size: int | None = None,
+    ) -> c.AsyncIterator[list[t.Any]]:
+        """Decode the db file or AOF, that was written by any codec.
+
+        Codec is picked by the file header, see :func:`~nbdb.codec.parse_header`.
+        Decoded items are yielded in batches, one batch per read chunk.
+
+        The file is read in chunks of :data:`_READ_CHUNK_SIZE` bytes, and only
+        the part that wasn't decoded yet is kept in memory. If an item doesn't
+        fit into the buffer, the next read is as big as the whole buffer, so
+        decoding of huge items is still linear.
+
+        If ``size`` is set, only that many first bytes of the file are
+        decoded.
+
+        Raises:
+            ValueError:
+                If the file is broken (:py:exc:`json.JSONDecodeError` is also
+                a :py:exc:`ValueError`).
+            ImportError: If the codec of the file is not installed.
+        """
+        left = sys.maxsize if size is None else size
+        async with aiofile.async_open(path, "rb") as f:
+            chunk = t.cast(bytes, await f.read(min(HEADER_MAX_SIZE, left)))
+            left -= len(chunk)
+            codec, header_size = parse_header(chunk)
+            parser = decoder(codec)
+            chunk = chunk[header_size:]
+
+            while True:
+                # read ahead, to know whether the current chunk is the last
+                next_chunk = (
+                    t.cast(
+                        bytes,
+                        await f.read(
+                            min(max(_READ_CHUNK_SIZE, parser.pending), left)
+                        ),
+                    )
+                    if left
+                    else b""
+                )
+                left -= len(next_chunk)
+                eof = not next_chunk
+                yield parser.feed(chunk, eof=eof)
+                if eof:
+                    return
+                chunk = next_chunk
+
+    async def _file_codec(self, path: Path) -> Codec:
+        """Return codec, that wrote the file."""
+        async with aiofile.async_open(path, "rb") as f:
+            return parse_header(t.cast(bytes, await f.read(HEADER_MAX_SIZE)))[0]
+
+    async def _read_aof(self, path: Path) -> list[_RECORD]:
+        """Read all records of the AOF segment."""
+        return [
+            record
+            async for records in self._decode_file(
+                path, lambda codec: codec.record_decoder()
+            )
+            for record in records
+        ]
+
+    async def _recode_aof(self) -> None:
+        """Rewrite AOF with our codec, after the codec was changed.
+
+        Must be called only while holding ``_aof_lock``, with closed AOF.
+        """
+        records = await self._read_aof(self._aof_path)
+        async with aiofile.async_open(self._new_aof_path, "wb") as f:
             _ = await f.write(
-                json.dumps(self._data, indent=self._indent, ensure_ascii=False)
+                self._codec.header
+                + self._codec.encode_block(
+                    b"".join(self._codec.encode_record(r) for r in records)
+                )
             )
+        _ = self._new_aof_path.replace(self._aof_path)
+
+    @property
+    def pending_changes(self) -> int:
+        """How many changes were made since the last :func:`write`.
+
+        Every changed key counts as one change, replayed AOF records count too,
+        because they are not in the database file yet.
+        """
+        return self._changes
+
+    @property
+    def last_write_changes(self) -> int:
+        """How many changes were persisted by the last :func:`write`."""
+        return self._last_write_changes
+
+    async def write(self, *, full: bool = False) -> None:
+        """Save changes on disk.
+
+        You can also manually call this method whenever you want. The
+        database is written even if nothing has changed, background writing
+        skips it in this case. See also :attr:`pending_changes` and
+        :attr:`last_write_changes`.
+
+        If ``max_deltas`` is set in :func:`init`, only changed keys are
+        written to a new delta file, unless it is time to fold deltas into
+        the db file or ``full`` is ``True``.
+        """
+        async with self._write_lock:
+            delta = not full and self._should_write_delta()
+            data, changes = await self._rotate_aof(delta=delta)
+            self._aof_base_size = 0
+
+            try:
+                if delta:
+                    await self._write_delta(data)
+                else:
+                    await self._write_full(data)
+            except BaseException:
+                # the old AOF segment is kept, but the next write must still
+                # include these changes
+                if delta:
+                    self._dirty.update(
+                        key
+                        for key in data
+                        if not key.startswith(RESERVED_PREFIX)
+                    )
+                else:
+                    self._full_write_needed = True
+                raise
+
+            if self._old_aof_path.exists():
+                self._old_aof_path.unlink()
+
+        # changes that were made during the write are not persisted yet
+        self._changes -= changes
+        self._last_write_changes = changes
+        self._last_write_time = time.monotonic()
+        logger.debug("Wrote %d changes to %s", changes, self._path)
+
+    def _should_write_delta(self) -> bool:
+        """Whether the next write can be a delta, instead of the whole db file."""
+        if not self._max_deltas or self._full_write_needed:
+            return False
+        if len(self._deltas) >= self._max_deltas:
+            return False
+        # reading many small deltas is fine, but not if they outweigh the base
+        deltas_size = sum(path.stat().st_size for path in self._deltas)
+        return not self._path.exists() or (
+            deltas_size < self._path.stat().st_size
+        )
+
+    async def _write_full(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        """Write the whole db file, and fold delta files into it."""
+        # if tempfile exists, the last write has failed and the db file
+        # is broken, so we must not overwrite the tempfile with it
+        if self._path.exists() and not self._tempfile.exists():
+            _ = self._path.rename(self._tempfile)
+
+        self._deltas = [
+            path
+            if path.suffix == ".folded"
+            else path.rename(path.with_name(path.name + ".folded"))
+            for path in self._deltas
+        ]
+
+        await self._write_snapshot(self._path, data)
 
-        if self._aof_path.exists():
-            self._aof_path.unlink()
         if self._tempfile.exists():
             self._tempfile.unlink()
+        for path in self._deltas:
+            path.unlink()
+        self._deltas = []
+        self._full_write_needed = False
+
+    async def _write_delta(
+        self, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        """Write changed keys to a new delta file, ``None`` means deletion."""
+        path = self._delta_path(self._next_delta)
+        temp = Path(str(path) + ".temp")
+        await self._write_snapshot(temp, data)
+        _ = temp.replace(path)
+        self._deltas.append(path)
+        self._next_delta += 1
+
+    async def _write_snapshot(
+        self, path: Path, data: c.Mapping[str, SERIALIZABLE_TYPE | LazyValue]
+    ) -> None:
+        async with aiofile.async_open(path, "wb") as f:
+            chunks = self._codec.encode_snapshot(data)
+            while True:
+                if self._serialize_in_thread:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                else:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                _ = await f.write(chunk)
+
+    async def _rotate_aof(
+        self, *, delta: bool = False
+    ) -> tuple[dict[str, SERIALIZABLE_TYPE | LazyValue], int]:
+        """Take a point-in-time copy of data and start a fresh AOF segment.
+
+        Everything that was changed before the copy ends up in the old
+        segment (``_old_aof_path``), everything after it goes to the fresh
+        one. So while :func:`write` writes the copy, new changes are neither
+        blocked nor lost, and the old segment can be deleted after the write.
+
+        If ``delta`` is ``True``, only keys, that were changed since the last
+        write, are copied, deleted ones are ``None``. The last version is
+        added under :data:`_VERSION_KEY`, and deadlines of copied keys under
+        :data:`_EXPIRES_KEY`, if any of them has one.
+
+        Returns:
+            The copy of data and number of changes in it.
+        """
+        async with self._aof_lock:
+            # this must be done without any `await` in between, so the copy
+            # and the queued records are consistent with each other
+            if delta:
+                data = {key: self._data.get(key) for key in self._dirty}
+                expires = {
+                    key: self._expires[key]
+                    for key in self._dirty
+                    if key in self._expires
+                }
+            else:
+                data = dict(self._data)
+                expires = dict(self._expires)
+            # versions of keys aren't stored, it is enough to know, that they
+            # are not bigger than this one
+            data[_VERSION_KEY] = self._version
+            if expires:
+                data[_EXPIRES_KEY] = t.cast(
+                    "dict[str, SERIALIZABLE_TYPE]", expires
+                )
+            self._aof_base_version = self._version
+            self._dirty = set()
+            changes = self._changes
+            batch, self._aof_queue = self._aof_queue, []
+
+            if batch:
+                await self._write_aof_batch(batch)
+            await self._close_aof()
+
+            if self._aof_path.exists():
+                if self._old_aof_path.exists():
+                    # the last write has failed, so we have to keep both; the
+                    # old segment may be written by another codec
+                    records = await self._read_aof(self._aof_path)
+                    codec = await self._file_codec(self._old_aof_path)
+                    async with aiofile.async_open(
+                        self._old_aof_path, "ab"
+                    ) as dst:
+                        _ = await dst.write(
+                            codec.encode_block(
+                                b"".join(
+                                    codec.encode_record(r) for r in records
+                                )
+                            )
+                        )
+                    self._aof_path.unlink()
+                else:
+                    _ = self._aof_path.rename(self._old_aof_path)
+
+        return data, changes
+
+    async def rewrite_aof(self) -> None:
+        """Compact AOF, leaving only the latest value of every changed key.
 
-    async def _write_loop(self, interval: int) -> te.Never:
-        """Call :func:`.write` every N seconds.
+        This is the same as ``BGREWRITEAOF`` in Redis. Only the part of AOF,
+        that was written before the call, is compacted, new records are
+        appended to the old AOF meanwhile and copied to the compacted one at
+        the end, which then atomically replaces the old one. So :func:`set`
+        isn't blocked by the rewrite, except for the final copying. Can't run
+        at the same time as :func:`write`.
+        """
+        async with self._write_lock:
+            if not self._aof_path.exists():
+                return
+
+            async with self._aof_lock:
+                batch, self._aof_queue = self._aof_queue, []
+                if batch:
+                    await self._write_aof_batch(batch)
+                size = self._aof_size()
+
+            latest: dict[str, SERIALIZABLE_TYPE] = {}
+            # records are compacted, so their versions are written explicitly
+            versions: dict[str, int] = {}
+            # set without TTL clears the deadline, so only deadlines, that
+            # were set after the last change of the key, are kept
+            deadlines: dict[str, int | None] = {}
+            version = self._aof_base_version
+            # operations on keys, that weren't set in this part of AOF, their
+            # values are in the db file, so the operations are kept as is
+            ops: dict[str, list[list[SERIALIZABLE_TYPE]]] = {}
+            with _gc_paused():
+                async for records in self._decode_file(
+                    self._aof_path,
+                    lambda codec: codec.record_decoder(),
+                    size=size,
+                ):
+                    for record in t.cast("list[_RECORD]", records):
+                        if isinstance(record, list):
+                            key = t.cast(str, record[1])
+                            version = (
+                                t.cast(int, record[3])
+                                if len(record) > 3
+                                else version + 1
+                            )
+                            if key in latest:
+                                latest[key] = _apply_op(latest[key], record)
+                                versions[key] = version
+                            else:
+                                ops.setdefault(key, []).append(
+                                    [*record[:3], version]
+                                )
+                            continue
+                        changes, expires, key_versions, version = _split_record(
+                            record, version
+                        )
+                        # `None` is kept, the key may exist in the db file
+                        latest.update(changes)
+                        for key in changes:
+                            versions[key] = (
+                                key_versions.get(key, version)
+                                if key_versions
+                                else version
+                            )
+                            _ = ops.pop(key, None)
+                            _ = deadlines.pop(key, None)
+                        if expires:
+                            deadlines.update(expires)
+
+            if self._serialize_in_thread:
+                content = await asyncio.to_thread(
+                    self._encode_compacted,
+                    latest,
+                    versions,
+                    deadlines,
+                    ops,
+                    version,
+                )
+            else:
+                content = self._encode_compacted(
+                    latest, versions, deadlines, ops, version
+                )
+            async with aiofile.async_open(self._new_aof_path, "wb") as f:
+                _ = await f.write(content)
+
+            async with self._aof_lock:
+                batch, self._aof_queue = self._aof_queue, []
+                if batch:
+                    await self._write_aof_batch(batch)
+                await self._close_aof()
+
+                # copy records, that were appended during the rewrite
+                async with aiofile.async_open(self._aof_path, "rb") as src:
+                    _ = src.seek(size)
+                    tail = t.cast(bytes, await src.read())
+                async with aiofile.async_open(self._new_aof_path, "ab") as f:
+                    _ = await f.write(tail)
+                _ = self._new_aof_path.replace(self._aof_path)
+                self._aof_base_size = self._aof_size()
+
+        logger.debug(
+            "Rewrote AOF of %s from %d to %d bytes",
+            self._path,
+            size,
+            self._aof_base_size,
+        )
+
+    def _encode_compacted(
+        self,
+        latest: dict[str, SERIALIZABLE_TYPE],
+        versions: dict[str, int],
+        deadlines: dict[str, int | None],
+        ops: dict[str, list[list[SERIALIZABLE_TYPE]]],
+        version: int,
+    ) -> bytes:
+        """Encode rewritten AOF, including the header.
+
+        Keys, that were changed by the same record, are put into one record
+        again, together with their deadlines. The last record has only
+        ``version`` and deadlines of keys, that weren't changed, so records,
+        that were appended during the rewrite, continue from it.
+        """
+        groups: dict[int, dict[str, SERIALIZABLE_TYPE]] = {}
+        for key, value in latest.items():
+            groups.setdefault(versions[key], {})[key] = value
+        deadlines = dict(deadlines)
+
+        records: list[_RECORD] = []
+        for key_version, group in sorted(groups.items()):
+            record: dict[str, SERIALIZABLE_TYPE] = {
+                **group,
+                _VERSION_KEY: key_version,
+            }
+            expires = {
+                key: deadlines.pop(key) for key in group if key in deadlines
+            }
+            if expires:
+                record[_EXPIRES_KEY] = expires
+            records.append(record)
+        records.extend(op for key_ops in ops.values() for op in key_ops)
+        last: dict[str, SERIALIZABLE_TYPE] = {_VERSION_KEY: version}
+        if deadlines:
+            last[_EXPIRES_KEY] = deadlines
+        records.append(last)
+
+        return self._codec.header + self._codec.encode_block(
+            b"".join(self._codec.encode_record(record) for record in records)
+        )
+
+    async def close(self) -> None:
+        """Stop background tasks, flush queued AOF records and close the AOF.
+
+        This doesn't call :func:`write`, data that is not in the database file
+        yet is replayed from AOF on next :func:`read`. The storage must not be
+        used after this call.
+        """
+        for task in (
+            self._write_loop_task,
+            self._fsync_loop_task,
+            self._expire_loop_task,
+            self._coalesce_task,
+        ):
+            if task is not None:
+                _ = task.cancel()
+                _ = await asyncio.gather(task, return_exceptions=True)
+        self._flush_coalesced()
+
+        if self._aof_writer_task is not None:
+            _ = await asyncio.gather(
+                self._aof_writer_task, return_exceptions=True
+            )
+
+        async with self._aof_lock:
+            if self._aof_file is not None and self._aof_unsynced:
+                await self._aof_file.flush()
+            await self._close_aof()
+
+    async def _write_loop(
+        self,
+        interval: float | None,
+        *,
+        save_points: c.Sequence[tuple[float, int]] = (),
+        aof_max_size: int | None = None,
+        aof_rewrite_percentage: int | None = None,
+        aof_rewrite_min_size: int = 0,
+    ) -> te.Never:
+        """Call :func:`.write` when any of triggers fires.
+
+        Triggers are checked every second (or more often if ``interval`` is
+        shorter), see :func:`init` for their description.
 
         Arguments:
             interval: How long we wait between every write.
+            save_points: Redis-like ``(seconds, changes)`` triggers.
+            aof_max_size: Write if AOF is bigger than this many bytes.
+            aof_rewrite_percentage:
+                Call :func:`rewrite_aof` if AOF grew by this many percents.
+            aof_rewrite_min_size: But only if AOF is at least this big.
         """
+        # on start, write immediately to get rid of replayed AOF
+        force = True
         while True:
             try:
-                await self.write()
-            except Exception as exception:  # noqa: PERF203
+                if self._changes and (
+                    force
+                    or self._should_write(interval, save_points, aof_max_size)
+                ):
+                    await self.write()
+                elif (
+                    aof_rewrite_percentage is not None
+                    and self._should_rewrite_aof(
+                        aof_rewrite_percentage, aof_rewrite_min_size
+                    )
+                ):
+                    await self.rewrite_aof()
+                force = False
+            except Exception as exception:
                 # stop working after if the task got canceled
                 if isinstance(exception, asyncio.CancelledError):
-                    await self.write()  # but ensure we won't lose data
+                    if self._changes:
+                        await self.write()  # but ensure we won't lose data
                     raise exception  # noqa: TRY201
 
                 logger.exception("Error during write!", exc_info=exception)
+
+            await asyncio.sleep(
+                _WRITE_LOOP_TICK
+                if interval is None
+                else min(_WRITE_LOOP_TICK, interval)
+            )
+
+    def _should_write(
+        self,
+        interval: float | None,
+        save_points: c.Sequence[tuple[float, int]],
+        aof_max_size: int | None,
+    ) -> bool:
+        """Check triggers of :func:`_write_loop`, assuming there are changes."""
+        elapsed = time.monotonic() - self._last_write_time
+        if interval is not None and elapsed >= interval:
+            return True
+        if any(
+            elapsed >= seconds and self._changes >= changes
+            for seconds, changes in save_points
+        ):
+            return True
+        return aof_max_size is not None and self._aof_size() >= aof_max_size
+
+    def _should_rewrite_aof(self, percentage: int, min_size: int) -> bool:
+        """Check whether AOF grew enough to be rewritten."""
+        size = self._aof_size()
+        return size >= min_size and size * 100 >= self._aof_base_size * (
+            100 + percentage
+        )
+
+    def _aof_size(self) -> int:
+        """Return size of AOF in bytes, ``0`` if it doesn't exist."""
+        try:
+            return self._aof_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    async def _append_command(self, record: _RECORD) -> None:
+        """Handle AOF logic on every change.
+
+        Arguments:
+            record:
+                Mapping of changed keys to their new values, ``None`` means
+                that the key was deleted, or an operation (see
+                :func:`_apply_op`). It is written as a single line.
+
+        The record is only queued here, actual writing is done by
+        :func:`_aof_writer`, which coalesces all records that were queued
+        while it was busy into a single write. This coroutine returns only
+        after the batch with our record was written.
+
+        With ``coalesce_window``, the record is merged with other ones, that
+        were made during the window, and they are queued together by
+        :func:`_flush_coalesced`.
+        """
+        await self._queue_command(record)
+
+    def _queue_command(self, record: _RECORD) -> asyncio.Future[None]:
+        """Same as :func:`_append_command`, but doesn't wait for the write.
+
+        Returns:
+            Future, that is resolved when the record is written.
+        """
+        future: asyncio.Future[None] = (
+            asyncio.get_running_loop().create_future()
+        )
+        # operations are coalesced by their resulting values, see `_run_op`
+        if self._coalesce_window and not isinstance(record, list):
+            changes, expires, _, _ = _split_record(record, 0)
+            self._coalesced.update(changes)
+            # set without TTL clears the deadline
+            for key in changes:
+                _ = self._coalesced_expires.pop(key, None)
+            if expires:
+                self._coalesced_expires.update(expires)
+            self._coalesced_futures.append(future)
+            if self._coalesce_task is None or self._coalesce_task.done():
+                self._coalesce_task = asyncio.create_task(
+                    self._coalesce_timer()
+                )
+        else:
+            self._queue_record(self._codec.encode_record(record), future)
+
+        return future
+
+    def _queue_record(self, data: bytes, future: asyncio.Future[None]) -> None:
+        """Queue encoded AOF record, ``future`` is resolved when it is written."""
+        self._aof_queue.append((data, future))
+
+        if self._aof_writer_task is None or self._aof_writer_task.done():
+            self._aof_writer_task = asyncio.create_task(self._aof_writer())
+
+    async def _coalesce_timer(self) -> None:
+        """Queue coalesced changes, when the window ends."""
+        await asyncio.sleep(self._coalesce_window)
+        self._flush_coalesced()
+
+    def _flush_coalesced(self) -> None:
+        """Queue coalesced changes as a single AOF record.
+
+        This is synchronous, so nothing can be lost if the timer is cancelled.
+        """
+        record, futures = self._coalesced, self._coalesced_futures
+        expires = self._coalesced_expires
+        self._coalesced, self._coalesced_futures = {}, []
+        self._coalesced_expires = {}
+        if not futures:
+            return
+
+        def resolve(written: asyncio.Future[None]) -> None:
+            for future in futures:
+                if future.done():
+                    continue
+                if written.cancelled():
+                    _ = future.cancel()
+                elif (exception := written.exception()) is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(None)
+
+        written: asyncio.Future[None] = (
+            asyncio.get_running_loop().create_future()
+        )
+        written.add_done_callback(resolve)
+        # one record replaces many changes, so its version can't be implied,
+        # and keys, that were changed earlier, have their own versions
+        key_versions = {
+            key: self._versions[key]
+            for key in record
+            if key in self._versions and self._versions[key] != self._version
+        }
+        record[_VERSION_KEY] = self._version
+        if key_versions:
+            record[_VERSIONS_KEY] = t.cast(
+                "dict[str, SERIALIZABLE_TYPE]", key_versions
+            )
+        if expires:
+            record[_EXPIRES_KEY] = expires
+        self._queue_record(self._codec.encode_record(record), written)
+
+    async def _aof_writer(self) -> None:
+        """Write queued AOF records in batches, until the queue is empty."""
+        batch: list[tuple[bytes, asyncio.Future[None]]] = []
+        try:
+            while self._aof_queue:
+                async with self._aof_lock:
+                    # take the batch only after acquiring the lock, so
+                    # everything that was queued while we waited goes into
+                    # the same write
+                    batch, self._aof_queue = self._aof_queue, []
+                    if batch:
+                        await self._write_aof_batch(batch)
+        except asyncio.CancelledError:
+            # don't let anybody wait forever for a record, that won't be
+            # written
+            batch, self._aof_queue = batch + self._aof_queue, []
+            for _, future in batch:
+                _ = future.cancel()
+            raise
+
+    async def _write_aof_batch(
+        self, batch: list[tuple[bytes, asyncio.Future[None]]]
+    ) -> None:
+        """Write a batch of AOF records and resolve their futures.
+
+        Must be called only while holding ``_aof_lock``.
+        """
+        try:
+            aof = await self._open_aof()
+            _ = await aof.write(
+                self._codec.encode_block(
+                    b"".join(record for record, _ in batch)
+                )
+            )
+            if self._fsync == "always":
+                await aof.flush()
             else:
-                await asyncio.sleep(interval)
+                self._aof_unsynced = True
+        except Exception as exception:  # noqa: BLE001
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exception)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def _wake_expiry(self) -> None:
+        """Start background expiry, or wake it up to check the earliest deadline."""
+        if self._expire_loop_task is None or self._expire_loop_task.done():
+            self._expire_loop_task = asyncio.create_task(self._expire_loop())
+        else:
+            self._expiry_wakeup.set()
+
+    async def _expire_loop(self) -> None:
+        """Delete keys, whose TTL is over, in background.
+
+        This is the active part of expiry, keys are also checked when they
+        are accessed, see :func:`_check_expired`. The task sleeps until the
+        earliest deadline, and stops when there are no deadlines anymore, so
+        it costs nothing if TTL is never used. :func:`_wake_expiry` starts it
+        again.
+        """
+        while True:
+            self._expiry_wakeup.clear()
+            try:
+                delay = self._expire_batch()
+            except Exception as exception:
+                logger.exception("Error during expiry!", exc_info=exception)
+                delay = _EXPIRE_RETRY_DELAY
+            if delay is None:
+                return
+            with contextlib.suppress(asyncio.TimeoutError):
+                _ = await asyncio.wait_for(self._expiry_wakeup.wait(), delay)
+
+    def _expire_batch(self) -> float | None:
+        """Delete keys, whose deadline has passed.
+
+        Deadlines are taken from the min-heap, so keys without TTL or with
+        a later deadline are never touched. Heap entries, that are outdated
+        (the key was changed or got another TTL), are skipped, and the heap
+        is rebuilt when they become the majority. At most
+        :data:`_EXPIRE_BATCH_SIZE` keys are deleted at once, so a mass expiry
+        doesn't block the event loop.
+
+        Returns:
+            How long to wait before the next batch, ``None`` if there are no
+            deadlines.
+        """
+        heap, now = self._expiry_heap, _now_ms()
+        expired: list[str] = []
+        while heap and heap[0][0] <= now and len(expired) < _EXPIRE_BATCH_SIZE:
+            deadline, key = heapq.heappop(heap)
+            if self._expires.get(key) == deadline:
+                expired.append(key)
+        self._remove_expired(expired)
+        # outdated entries on top would wake us up for nothing
+        while heap and self._expires.get(heap[0][1]) != heap[0][0]:
+            _ = heapq.heappop(heap)
+
+        if len(heap) > 2 * len(self._expires) + _EXPIRE_BATCH_SIZE:
+            self._expiry_heap = heap = [
+                (deadline, key) for key, deadline in self._expires.items()
+            ]
+            heapq.heapify(heap)
+
+        if len(expired) == _EXPIRE_BATCH_SIZE:
+            return 0
+        if not heap:
+            return None
+        # earlier deadlines, that are added meanwhile, wake us up
+        return max(heap[0][0] - now, 0) / 1000
+
+    def _check_expired(self, key: str) -> None:
+        """Delete the key, if its TTL is over.
+
+        This is the lazy part of expiry, it is done on every access, so
+        expired keys are never returned, even if :func:`_expire_loop` didn't
+        get to them yet.
+        """
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= _now_ms():
+            self._remove_expired([key])
+
+    def _remove_expired(self, keys: c.Collection[str]) -> None:
+        """Delete expired keys, see :func:`_delete_in_background`."""
+        if keys:
+            self._delete_in_background(keys)
+            logger.debug("Expired %d keys of %s", len(keys), self._path)
+
+    def _make_room(self, data: c.Mapping[str, SERIALIZABLE_TYPE]) -> None:
+        """Evict keys, so the changes fit into ``max_memory`` and ``max_keys``.
+
+        This is called before the changes are applied, same as Redis evicts
+        keys before executing a command, so the changed keys are never
+        evicted by their own change.
+        """
+        evictor = self._evictor
+        if evictor is None:
+            return
+
+        new_keys = 0
+        for key, value in data.items():
+            if value is None:
+                evictor.remove(key)
+                continue
+            if key not in self._data:
+                evictor.add(key, self._data)
+                new_keys += 1
+            evictor.touch(key)
+            if self._max_memory is not None:
+                evictor.measure(key, value)
+        self._evict(data, new_keys=new_keys)
+
+    def _evict(
+        self, protected: c.Iterable[str] = (), *, new_keys: int = 0
+    ) -> None:
+        """Evict keys, until there is enough room for ``new_keys`` more.
+
+        Keys are picked by ``eviction_policy``, see :func:`init`.
+        """
+        evictor = self._evictor
+        if evictor is None:
+            return
+        limit = sys.maxsize if self._max_keys is None else self._max_keys
+        if self._max_memory is not None and evictor.key_size:
+            limit = min(limit, int(self._max_memory // evictor.key_size))
+        excess = len(self._data) + new_keys - limit
+        if excess <= 0:
+            return
 
-    async def _append_command(self, key: str, value: SERIALIZABLE_TYPE) -> None:
-        """Handle AOF logic on every :func:`set`."""
-        async with aiofile.async_open(self._aof_path, "a") as f:
-            _ = await f.write("\n" + json.dumps({key: value}))
+        victims: list[str] = []
+        excluded = set(protected)
+        while len(victims) < excess:
+            key = (
+                self._pick_expiring(excluded)
+                if evictor.policy == "volatile-ttl"
+                else evictor.pick(self._data, excluded)
+            )
+            if key is None:
+                logger.warning(
+                    "%s is over its limits, but nothing can be evicted",
+                    self._path,
+                )
+                break
+            victims.append(key)
+            excluded.add(key)
+
+        if victims:
+            self._delete_in_background(victims)
+            self._evicted += len(victims)
+            logger.debug("Evicted %d keys of %s", len(victims), self._path)
+
+    def _pick_expiring(self, excluded: c.Container[str]) -> str | None:
+        """Pick the key, that expires first, for ``volatile-ttl`` policy.
+
+        Unlike other policies, this is exact, because deadlines are already
+        in a min-heap, see :func:`_expire_batch`.
+        """
+        heap = self._expiry_heap
+        skipped: list[tuple[int, str]] = []
+        key = None
+        while heap:
+            deadline, candidate = heapq.heappop(heap)
+            if self._expires.get(candidate) != deadline:
+                continue
+            if candidate in excluded:
+                skipped.append((deadline, candidate))
+                continue
+            key = candidate
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return key
+
+    def _delete_in_background(self, keys: c.Collection[str]) -> None:
+        """Delete keys, without waiting for AOF, used by expiry and eviction.
+
+        Deletion is written to AOF as usual, because on replay we can't know
+        whether later changes were made before or after the key was deleted.
+        """
+        record: dict[str, SERIALIZABLE_TYPE] = dict.fromkeys(keys)
+        self._apply_record(record)
+        self._queue_command(record).add_done_callback(_log_deletion_failure)
+        if self._evictor is not None:
+            for key in keys:
+                self._evictor.remove(key)
+
+    async def _fsync_loop(self) -> te.Never:
+        """Sync AOF to disk every second, used with ``everysec`` fsync policy.
+
+        Syncing is done with ``fdatasync``, same as with ``always`` policy.
+        """
+        while True:
+            await asyncio.sleep(1)
+            try:
+                async with self._aof_lock:
+                    if self._aof_file is not None and self._aof_unsynced:
+                        await self._aof_file.flush()
+                        self._aof_unsynced = False
+            except Exception as exception:
+                logger.exception("Error during AOF fsync!", exc_info=exception)
+
+    async def _open_aof(self) -> aiofile.FileIOWrapperBase:
+        """Return opened AOF, open it if it isn't opened yet.
+
+        Must be called only while holding ``_aof_lock``.
+        """
+        if self._aof_file is None:
+            self._aof_file = await aiofile.async_open(self._aof_path, "ab")
+            if not self._aof_size():
+                _ = await self._aof_file.write(self._codec.header)
+        return self._aof_file
+
+    async def _close_aof(self) -> None:
+        """Close AOF if it is opened.
+
+        Must be called only while holding ``_aof_lock``.
+        """
+        if self._aof_file is not None:
+            aof, self._aof_file = self._aof_file, None
+            await aof.close()  # also syncs the file
+            self._aof_unsynced = False
+
+    def _apply_record(self, record: c.Mapping[str, SERIALIZABLE_TYPE]) -> None:
+        """Apply changes from AOF record to in-memory data.
+
+        ``None`` value means that the key must be deleted.
+        """
+        self._apply_records((record,))
+
+    def _apply_records(self, records: c.Iterable[_RECORD]) -> None:
+        """Apply many AOF records at once, used to replay AOF.
+
+        Same as :func:`_apply_record`, but without per-record overhead.
+        """
+        data = self._data
+        versions = self._versions
+        version = self._version
+        deadlines = self._expires
+        heap = self._expiry_heap
+        earliest = heap[0][0] if heap else None
+        dirty = self._dirty if self._max_deltas else None
+        changes = 0
+        for record in records:
+            if isinstance(record, list):
+                key = t.cast(str, record[1])
+                data[key] = _apply_op(resolve(data.get(key)), record)
+                version = (
+                    t.cast(int, record[3]) if len(record) > 3 else version + 1
+                )
+                versions[key] = version
+                if dirty is not None:
+                    dirty.add(key)
+                changes += 1
+                continue
+
+            changed, expires, key_versions, version = _split_record(
+                record, version
+            )
+            for key, value in changed.items():
+                if value is None:
+                    _ = data.pop(key, None)
+                    _ = versions.pop(key, None)
+                else:
+                    data[key] = value
+                    versions[key] = (
+                        key_versions.get(key, version)
+                        if key_versions
+                        else version
+                    )
+            if dirty is not None:
+                dirty.update(changed)
+            changes += len(changed)
+
+            # set without TTL clears the deadline, operations keep it
+            if deadlines:
+                for key in changed:
+                    _ = deadlines.pop(key, None)
+            if expires:
+                for key, deadline in expires.items():
+                    if deadline is None:
+                        _ = deadlines.pop(key, None)
+                    else:
+                        deadlines[key] = deadline
+                        heapq.heappush(heap, (deadline, key))
+                if dirty is not None:
+                    dirty.update(expires)
+        self._version = version
+        self._changes += changes
+        if heap and heap[0][0] != earliest:
+            self._wake_expiry()
 
     async def set(
-        self, key: str, value: SERIALIZABLE_TYPE, *, _replay: bool = False
+        self, key: str, value: SERIALIZABLE_TYPE, *, ttl: float | None = None
     ) -> None:
         """Set a key to value.
 
+        Setting a value to ``None`` deletes the key.
+
         Arguments:
-            _replay:
-                If ``True``, we won't do AOF stuff. This is used when we replay
-                operations from AOF.
+            ttl:
+                If it is not ``None``, the key is deleted after this many
+                seconds, see :func:`expire`. Otherwise the previous TTL of
+                the key is removed, same as in Redis.
+
+        Raises:
+            KeyError: If you try to delete a key, that doesn't exist.
         """
-        task = None
-        if not _replay:
-            task = asyncio.create_task(self._append_command(key, value))
+        await self.set_many({key: value}, ttl=ttl)
 
-        if value is None:
-            del self._data[key]
-        else:
-            self._data[key] = value
+    async def set_many(
+        self,
+        data: c.Mapping[str, SERIALIZABLE_TYPE],
+        *,
+        ttl: float | None = None,
+    ) -> None:
+        """Set many keys at once.
+
+        All changes are applied in one step and written to AOF as a single
+        record, so this is much faster than calling :func:`set` in a loop.
+        Same as in :func:`set`, ``None`` value deletes the key, and ``ttl``
+        applies to all set keys.
+
+        Raises:
+            KeyError:
+                If you try to delete a key, that doesn't exist. Nothing is
+                changed in this case.
+            ValueError: If a key starts with ``#nbdb:``, which is reserved.
+        """
+        for key, value in data.items():
+            if value is None and key not in self:
+                raise KeyError(key)
+            if key.startswith(RESERVED_PREFIX):
+                raise ValueError(f"Key {key!r} is reserved")
+
+        record = dict(data)
+        if not record:
+            return
+        if ttl is not None:
+            record[_EXPIRES_KEY] = dict.fromkeys(
+                (key for key, value in data.items() if value is not None),
+                _now_ms() + round(ttl * 1000),
+            )
 
-        if task is not None:
-            _ = await asyncio.gather(task)
+        self._make_room(data)
+        self._apply_record(record)
+        await self._append_command(record)
+
+    async def expire(self, key: str, ttl: float | None) -> bool:
+        """Delete the key after ``ttl`` seconds, ``None`` removes its TTL.
+
+        Deadlines are stored in the db file and AOF, so they survive
+        restarts. Expired keys are deleted in background, and are never
+        returned, even if they weren't deleted yet.
+
+        Returns:
+            Whether the key exists.
+        """
+        if key not in self:
+            return False
+
+        record: dict[str, SERIALIZABLE_TYPE] = {
+            _EXPIRES_KEY: {
+                key: None if ttl is None else _now_ms() + round(ttl * 1000)
+            }
+        }
+        self._apply_record(record)
+        await self._append_command(record)
+        return True
+
+    def ttl(self, key: str) -> float | None:
+        """Return how many seconds are left until the key expires.
+
+        Returns:
+            ``None`` if the key has no TTL.
+
+        Raises:
+            KeyError: If the key doesn't exist.
+        """
+        if key not in self:
+            raise KeyError(key)
+        deadline = self._expires.get(key)
+        return None if deadline is None else (deadline - _now_ms()) / 1000
+
+    def __contains__(self, key: str) -> bool:
+        if self._expires:
+            self._check_expired(key)
+        return key in self._data
 
     async def get(self, key: str) -> SERIALIZABLE_TYPE:
-        return self._data[key]
+        return self._get(key)
+
+    def version(self, key: str) -> int:
+        """Return version of the key, ``0`` if it doesn't exist.
+
+        Every change of the key gives it a new version, that is bigger than
+        any version before (even of other keys), so a version is never
+        reused for another value, also after restarts. Only the last version
+        is stored in the db file, so after a restart, all keys, that weren't
+        changed since the last write, have that version. This may make
+        :func:`compare_and_set` fail once, but never succeed wrongly.
+        """
+        if self._expires:
+            self._check_expired(key)
+        if key not in self._data:
+            return 0
+        return self._versions.get(key, self._base_version)
+
+    async def get_with_version(self, key: str) -> tuple[SERIALIZABLE_TYPE, int]:
+        """Return value of the key together with its version.
+
+        Raises:
+            KeyError: If the key doesn't exist.
+        """
+        return self._get(key), self._versions.get(key, self._base_version)
+
+    async def compare_and_set(
+        self, key: str, expected_version: int, value: SERIALIZABLE_TYPE
+    ) -> bool:
+        """Set the key, only if it wasn't changed since it had ``expected_version``.
+
+        This allows concurrent read-modify-write without locks, just retry
+        until it succeeds:
+
+        .. code:: python
+
+            while True:
+                value, version = await storage.get_with_version("counter")
+                if await storage.compare_and_set("counter", version, value + 1):
+                    break
+
+        Version ``0`` means that the key must not exist. Same as in
+        :func:`set`, ``None`` value deletes the key, and the TTL of the key is
+        removed.
+
+        Returns:
+            Whether the key was set.
+        """
+        if self.version(key) != expected_version:
+            return False
+        await self.set(key, value)
+        return True
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        """Increment integer value of the key, missing key is ``0``.
+
+        Like all operations below, this is atomic, and AOF records only the
+        operation, not the whole resulting value.
+
+        Returns:
+            The new value.
+
+        Raises:
+            TypeError: If the value is not an integer.
+        """
+        return t.cast(int, await self._run_op(["incr", key, amount]))
+
+    async def decr(self, key: str, amount: int = 1) -> int:
+        """Decrement integer value of the key, same as :func:`incr`."""
+        return await self.incr(key, -amount)
+
+    async def append_to_list(self, key: str, *values: SERIALIZABLE_TYPE) -> int:
+        """Append values to the list, missing key is an empty list.
+
+        Returns:
+            Length of the new list.
+
+        Raises:
+            TypeError: If the value is not a list.
+        """
+        value = await self._run_op(["append", key, list(values)])
+        return len(t.cast("list[SERIALIZABLE_TYPE]", value))
+
+    async def merge_dict(
+        self, key: str, data: c.Mapping[str, SERIALIZABLE_TYPE]
+    ) -> None:
+        """Update the mapping with ``data``, missing key is an empty mapping.
+
+        Raises:
+            TypeError: If the value is not a mapping.
+        """
+        _ = await self._run_op(["merge", key, dict(data)])
+
+    async def set_path(
+        self, key: str, pointer: str, value: SERIALIZABLE_TYPE
+    ) -> None:
+        """Set a nested value, ``pointer`` is a `JSON pointer <https://datatracker.ietf.org/doc/html/rfc6901>`_.
+
+        For example, ``await storage.set_path("key", "/a/b/0", 1)`` sets the
+        first item of list ``b`` in mapping ``a``. The last part of the path
+        may be missing, ``-`` appends to a list. Only the path and the new
+        value are written to AOF.
+
+        Raises:
+            KeyError: If the key or the path doesn't exist.
+            TypeError: If something on the path is not a container.
+            ValueError: If the pointer is invalid.
+        """
+        _ = await self._run_op(["set_path", key, [pointer, value]])
+
+    async def delete_path(self, key: str, pointer: str) -> None:
+        """Delete a nested value, see :func:`set_path`.
+
+        Raises:
+            KeyError: If the key or the path doesn't exist.
+            TypeError: If something on the path is not a container.
+            ValueError: If the pointer is invalid.
+        """
+        if not pointer:
+            raise ValueError("Use `delete_many` to delete the whole value")
+        _ = await self._run_op(["delete_path", key, pointer])
+
+    async def _run_op(self, op: list[SERIALIZABLE_TYPE]) -> SERIALIZABLE_TYPE:
+        """Apply the operation and write it to AOF.
+
+        Raises:
+            ValueError: If the key is reserved, see :func:`set_many`.
+        """
+        key = t.cast(str, op[1])
+        if key.startswith(RESERVED_PREFIX):
+            raise ValueError(f"Key {key!r} is reserved")
+        value = _apply_op(self._get(key) if key in self else None, op)
+        record = {key: value}
+        self._make_room(record)
+        if key in self._expires:
+            # unlike `set`, operations keep TTL of the key
+            record[_EXPIRES_KEY] = {key: self._expires[key]}
+        self._apply_record(record)
+        # operations can't be merged with other changes, so the resulting
+        # value is coalesced instead
+        await self._append_command(record if self._coalesce_window else op)
+        return value
+
+    async def get_many(
+        self, keys: c.Iterable[str]
+    ) -> dict[str, SERIALIZABLE_TYPE]:
+        """Get values of many keys at once.
+
+        Keys that don't exist are silently skipped, so the result may contain
+        less keys than you asked for.
+        """
+        return {key: self._get(key) for key in keys if key in self}
+
+    def _get(self, key: str) -> SERIALIZABLE_TYPE:
+        """Return value of the key, decode it if it wasn't decoded yet."""
+        if self._expires:
+            self._check_expired(key)
+        value = self._data[key]
+        if self._evictor is not None:
+            self._evictor.touch(key)
+        if not isinstance(value, LazyValue):
+            return value
+        if not self._lazy_values:
+            decoded = self._data[key] = value.decode()
+            return decoded
+
+        # cached by the lazy value itself, so a changed key never hits
+        # the old value
+        decoded = self._value_cache.get(value)
+        if decoded is None:
+            decoded = value.decode()
+            self._value_cache.put(value, decoded, len(value.data))
+        return decoded
+
+    async def delete_many(self, keys: c.Iterable[str]) -> int:
+        """Delete many keys at once, written to AOF as a single record.
+
+        Keys that don't exist are silently skipped.
+
+        Returns:
+            How many keys were actually deleted.
+        """
+        record: dict[str, SERIALIZABLE_TYPE] = dict.fromkeys(
+            key for key in keys if key in self
+        )
+        if not record:
+            return 0
+
+        self._make_room(record)
+        self._apply_record(record)
+        await self._append_command(record)
+        return len(record)
+
+    def transaction(self, *, watch: c.Iterable[str] = ()) -> Transaction:
+        """Start a transaction, that applies many changes atomically.
+
+        Changes are buffered and applied only at the end of ``async with``
+        block, in one step, and written to AOF as a single record, so other
+        coroutines never see half of them. If the block raises, nothing is
+        applied.
+
+        .. code:: python
+
+            async with storage.transaction(watch=["balance"]) as tx:
+                balance = await storage.get("balance")
+                tx.set("balance", balance - 10)
+                tx.set("history", [...])
+
+        Arguments:
+            watch:
+                Keys, that must not be changed by anybody else between this
+                call and the end of the transaction, works the same as
+                ``WATCH`` in Redis. Otherwise :class:`ConflictError` is raised
+                at the end and nothing is applied, so you can retry. Changes
+                are detected by :func:`version`.
+        """
+        return Transaction(self, {key: self.version(key) for key in watch})
+
+    async def _commit(
+        self,
+        changes: c.Mapping[str, SERIALIZABLE_TYPE],
+        watched: c.Mapping[str, int],
+    ) -> None:
+        """Apply changes of transaction, see :func:`transaction`.
+
+        Raises:
+            ConflictError: If a watched key was changed.
+        """
+        for key, version in watched.items():
+            if self.version(key) != version:
+                raise ConflictError(key)
+
+        record = {
+            key: value
+            for key, value in changes.items()
+            if value is not None or key in self
+        }
+        # there is no `await` before the record is applied
+        await self.set_many(record)
 
     def __del__(self) -> None:
-        _ = self._write_loop_task.cancel()
+        for task in (
+            self._write_loop_task,
+            self._fsync_loop_task,
+            self._expire_loop_task,
+            self._coalesce_task,
+        ):
+            if task is not None:
+                _ = task.cancel()
+
+
+@t.final
+class Transaction:
+    """Buffer of changes, that are applied atomically, see :func:`Storage.transaction`."""
+
+    def __init__(
+        self,
+        storage: Storage,
+        watched: c.Mapping[str, int],
+    ) -> None:
+        self._storage = storage
+        self._watched = watched
+        self._changes: dict[str, SERIALIZABLE_TYPE] = {}
+
+    def set(self, key: str, value: SERIALIZABLE_TYPE) -> None:
+        """Set a key to value, ``None`` deletes the key."""
+        self._changes[key] = value
+
+    def delete(self, key: str) -> None:
+        """Delete a key, if it doesn't exist, this is skipped."""
+        self._changes[key] = None
+
+    async def __aenter__(self) -> te.Self:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        if exc_type is None:
+            await self._storage._commit(self._changes, self._watched)  # pyright: ignore[reportPrivateUsage]
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import asyncio
+import collections.abc as c
+import json
+import typing as t
+
+import pytest
+import typing_extensions as te
+
+from nbdb.bitcask import BitcaskStorage
+from nbdb.storage import SERIALIZABLE_TYPE
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from faker import Faker
+
+STORAGE_FACTORY_RETURN_TYPE: te.TypeAlias = t.Callable[
+    [], c.Awaitable[BitcaskStorage]
+]
+
+
+@pytest.fixture
+async def storage_factory(
+    tmp_path: Path,
+) -> c.AsyncIterator[STORAGE_FACTORY_RETURN_TYPE]:
+    storages: list[BitcaskStorage] = []
+
+    async def factory(
+        path: Path | None = None,
+        *args: t.Any,
+        **kwargs: t.Any,
+    ) -> BitcaskStorage:
+        kwargs.setdefault("merge_interval", False)
+        storage = await BitcaskStorage.init(path or tmp_path, *args, **kwargs)
+        storages.append(storage)
+        return storage
+
+    yield factory
+
+    for storage in storages:
+        await storage.close()
+
+
+@pytest.fixture
+async def storage(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> BitcaskStorage:
+    return await storage_factory()
+
+
+async def test_simple_storage(storage: BitcaskStorage, faker: Faker) -> None:
+    data = {
+        faker.pystr(): t.cast(SERIALIZABLE_TYPE, json.loads(faker.json()))
+        for _ in range(10)
+    }
+    await storage.set_many(data)
+
+    for key, value in data.items():
+        assert await storage.get(key) == value
+    assert await storage.get_many([*data, "missing"]) == data
+
+
+async def test_delete(storage: BitcaskStorage, faker: Faker) -> None:
+    key, key2 = faker.pystr(), faker.pystr()
+    await storage.set_many({key: 1, key2: 2})
+
+    await storage.set(key, None)
+    assert await storage.delete_many([key2, "missing"]) == 1
+
+    with pytest.raises(KeyError):
+        _ = await storage.get(key)
+    with pytest.raises(KeyError):
+        await storage.set(key2, None)
+
+
+async def test_reopen(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path, faker: Faker
+) -> None:
+    storage = t.cast(
+        BitcaskStorage,
+        await storage_factory(max_segment_size=256),  # pyright: ignore[reportCallIssue]
+    )
+    data = {faker.pystr(): faker.pystr() for _ in range(50)}
+    for key, value in data.items():
+        await storage.set(key, value)
+    deleted = next(iter(data))
+    await storage.set(deleted, None)
+    del data[deleted]
+    await storage.close()
+    assert len(list(tmp_path.glob("*.data"))) > 1
+
+    # hint files are used for all segments, except the last one
+    storage2 = await storage_factory()
+    assert await storage2.get_many([*data, deleted]) == data
+    assert len(list(tmp_path.glob("*.hint"))) == len(
+        list(tmp_path.glob("*.data"))
+    )
+
+
+async def test_broken_tail_is_truncated(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path
+) -> None:
+    storage = await storage_factory()
+    await storage.set("a", 1)
+    await storage.set("b", 2)
+    await storage.close()
+
+    # crash in the middle of the last write
+    (segment,) = tmp_path.glob("*.data")
+    _ = segment.write_bytes(segment.read_bytes()[:-3])
+
+    storage2 = await storage_factory()
+    assert await storage2.get_many(["a", "b"]) == {"a": 1}
+
+
+async def test_merge(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path, faker: Faker
+) -> None:
+    storage = t.cast(
+        BitcaskStorage,
+        await storage_factory(max_segment_size=256),  # pyright: ignore[reportCallIssue]
+    )
+    key, deleted = faker.pystr(), faker.pystr()
+    await storage.set(deleted, "deleted")
+    for i in range(100):
+        await storage.set(key, i)
+    await storage.set(deleted, None)
+    size = sum(path.stat().st_size for path in tmp_path.glob("*.data"))
+
+    await storage.merge()
+    await storage.set(key, "after merge")
+
+    (merged,) = tmp_path.glob("*.merged")
+    assert merged.stat().st_size < size
+    assert await storage.get(key) == "after merge"
+
+    storage2 = await storage_factory()
+    assert await storage2.get_many([key, deleted]) == {key: "after merge"}
+
+
+async def test_merge_twice(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path
+) -> None:
+    storage = await storage_factory()
+    await storage.set("a", 1)
+    await storage.merge()
+    await storage.set("a", 2)
+    await storage.merge()
+
+    assert len(list(tmp_path.glob("*.merged"))) == 1
+    assert not list(tmp_path.glob("*.temp"))
+    assert await storage.get("a") == 2
+    storage2 = await storage_factory()
+    assert await storage2.get("a") == 2
+
+
+async def test_read_during_merge(
+    storage: BitcaskStorage, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    await storage.set("a", 1)
+    location = storage._keydir["a"]  # pyright: ignore[reportPrivateUsage]
+    segment = storage._segments[location.segment]  # pyright: ignore[reportPrivateUsage]
+    read_bytes = segment.read_bytes
+    merged = asyncio.Event()
+
+    async def slow_read_bytes(size: int, offset: int = 0) -> bytes:
+        if (size, offset) == (location.size, location.offset):
+            _ = await merged.wait()
+        return await read_bytes(size, offset)
+
+    monkeypatch.setattr(segment, "read_bytes", slow_read_bytes)
+    read = asyncio.create_task(storage.get("a"))
+    await asyncio.sleep(0)  # start reading
+    await storage.merge()
+    merged.set()
+
+    assert await read == 1
+
+
+async def test_changes_during_merge(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(
+        BitcaskStorage,
+        await storage_factory(max_segment_size=256),  # pyright: ignore[reportCallIssue]
+    )
+    data = {faker.pystr(): faker.pystr() for _ in range(50)}
+    await storage.set_many(data)
+
+    async def change() -> None:
+        for key in data:
+            await storage.set(key, "changed")
+            await asyncio.sleep(0)
+
+    _ = await asyncio.gather(storage.merge(), change())
+
+    assert await storage.get_many(data) == dict.fromkeys(data, "changed")
+    storage2 = await storage_factory()
+    assert await storage2.get_many(data) == dict.fromkeys(data, "changed")
+
+
+async def test_crash_after_merge(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path
+) -> None:
+    storage = await storage_factory()
+    await storage.set("a", 1)
+    await storage.set("b", 2)
+    await storage.close()
+    old = {path: path.read_bytes() for path in tmp_path.iterdir()}
+
+    storage2 = await storage_factory()
+    await storage2.set("a", None)
+    await storage2.merge()
+    await storage2.close()
+    # old segments are left, as if we crashed before deleting them
+    for path, content in old.items():
+        _ = path.write_bytes(content)
+
+    storage3 = await storage_factory()
+    assert await storage3.get_many(["a", "b"]) == {"b": 2}
+    assert not any(path.exists() for path in old)
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack"])
+async def test_codec(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, codec: str
+) -> None:
+    _ = pytest.importorskip(codec)
+    storage = t.cast(BitcaskStorage, await storage_factory(codec=codec))  # pyright: ignore[reportCallIssue]
+    await storage.set("a", {"b": ["c", 1]})
+    await storage.close()
+
+    # old segments are still read by their own codec
+    storage2 = await storage_factory()
+    assert await storage2.get("a") == {"b": ["c", 1]}
+    await storage2.merge()
+    assert await storage2.get("a") == {"b": ["c", 1]}
+
+
+async def test_cache(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(
+        BitcaskStorage,
+        await storage_factory(cache_size=100),  # pyright: ignore[reportCallIssue]
+    )
+    key, key2 = faker.pystr(), faker.pystr()
+    await storage.set_many({key: "a" * 40, key2: "b" * 40})
+
+    assert await storage.get(key) == "a" * 40
+    assert await storage.get(key) == "a" * 40
+    assert storage.cache_stats[:2] == (1, 1)
+
+    # doesn't fit together with `key`, so `key` is evicted
+    await storage.set(key2, "c" * 80)
+    assert await storage.get(key2) == "c" * 80
+    assert storage.cache_stats.items == 1
+    assert storage.cache_stats.size <= 100
+    assert await storage.get(key) == "a" * 40
+    assert storage.cache_stats[:2] == (1, 3)
+
+
+async def test_cache_is_invalidated(storage: BitcaskStorage) -> None:
+    await storage.set("a", 1)
+    assert await storage.get("a") == 1
+
+    await storage.set("a", 2)
+    assert await storage.get("a") == 2
+    await storage.set("a", None)
+    with pytest.raises(KeyError):
+        _ = await storage.get("a")
+
+
+async def test_cache_skips_stale_reads(storage: BitcaskStorage) -> None:
+    await storage.set("a", 1)
+
+    read = asyncio.create_task(storage.get("a"))
+    await asyncio.sleep(0)  # start reading
+    await storage.set("a", 2)
+
+    assert await read == 1
+    assert await storage.get("a") == 2
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from nbdb.cache import LRUCache
+
+
+def test_lru_cache() -> None:
+    cache: LRUCache[str, int] = LRUCache(10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    assert cache.get("a") == 1  # `b` is the least recently used now
+
+    cache.put("c", 3, 4)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    stats = cache.stats
+    assert (stats.hits, stats.misses, stats.size, stats.items) == (3, 1, 8, 2)
+    assert stats.hit_rate == 0.75
+
+
+def test_lru_cache_too_big_value() -> None:
+    cache: LRUCache[str, int] = LRUCache(10)
+    cache.put("a", 1, 4)
+
+    cache.put("a", 2, 11)
+
+    assert cache.get("a") is None
+    assert cache.stats.size == 0
+
+
+def test_lru_cache_pop() -> None:
+    cache: LRUCache[str, int] = LRUCache(10)
+    cache.put("a", 1, 4)
+
+    cache.pop("a")
+    cache.pop("b")
+
+    assert cache.get("a") is None
+    assert cache.stats.size == 0
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import typing as t
+
+import pytest
+
+from nbdb.codec import (
+    CODECS,
+    Codec,
+    IndexedCodec,
+    JsonCodec,
+    LazyValue,
+    get_codec,
+    parse_header,
+    resolve,
+)
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from nbdb.storage import SERIALIZABLE_TYPE
+
+
+@pytest.fixture(params=list(CODECS))
+def codec(request: pytest.FixtureRequest) -> Codec:
+    name = t.cast(str, request.param)
+    if name not in {"json", "indexed"}:
+        _ = pytest.importorskip(name)
+    return get_codec(name)
+
+
+def test_parse_header(codec: Codec) -> None:
+    parsed, size = parse_header(codec.header + b"{}")
+
+    assert parsed.name == codec.name
+    assert size == len(codec.header)
+
+
+def test_json_has_no_header() -> None:
+    assert JsonCodec().header == b""
+    assert parse_header(b'{"#nbdb:abc": 1}')[1] == 0
+
+
+def test_broken_header() -> None:
+    with pytest.raises(ValueError, match="newline not found"):
+        _ = parse_header(b"#nbdb:" + b"a" * 100)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+def test_records(codec: Codec, chunk_size: int) -> None:
+    records: list[dict[str, SERIALIZABLE_TYPE]] = [
+        {"a": 1},
+        {"b": None, "c": "line\nbreak"},
+        {"d": {"e": [1, 2, {"f": "g"}]}},
+    ]
+    data = codec.encode_block(
+        b"".join(codec.encode_record(record) for record in records)
+    )
+
+    decoder = codec.record_decoder()
+    decoded: list[t.Any] = []
+    for i in range(0, len(data), chunk_size):
+        decoded += decoder.feed(data[i : i + chunk_size], eof=False)
+    decoded += decoder.feed(b"", eof=True)
+
+    assert decoded == records
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+def test_snapshot(codec: Codec, chunk_size: int) -> None:
+    data: dict[str, SERIALIZABLE_TYPE] = {
+        "a": 1,
+        "ключ": ["значення", None, {"b": "c"}],
+    }
+    encoded = b"".join(codec.encode_snapshot(data))
+    parsed, size = parse_header(encoded)
+    encoded = encoded[size:]
+
+    decoder = parsed.snapshot_decoder()
+    decoded: list[t.Any] = []
+    for i in range(0, len(encoded), chunk_size):
+        decoded += decoder.feed(encoded[i : i + chunk_size], eof=False)
+    decoded += decoder.feed(b"", eof=True)
+
+    assert {key: resolve(value) for key, value in decoded} == data
+
+
+def test_lazy_snapshot(codec: Codec) -> None:
+    data: dict[str, SERIALIZABLE_TYPE] = {"a": 1, "b": [None, {"c": "d"}]}
+    encoded = b"".join(codec.encode_snapshot(data))
+    parsed, size = parse_header(encoded)
+
+    decoded = parsed.lazy_snapshot_decoder().feed(encoded[size:], eof=True)
+
+    assert all(isinstance(value, LazyValue) for _, value in decoded)
+    assert {key: resolve(value) for key, value in decoded} == data
+
+
+def test_incomplete_record(codec: Codec) -> None:
+    data = codec.encode_block(codec.encode_record({"a": "b"}))
+
+    with pytest.raises(ValueError):  # noqa: PT011
+        _ = codec.record_decoder().feed(data[:-1], eof=True)
+
+
+@pytest.mark.parametrize("inner", ["json", "msgpack"])
+def test_indexed_load(tmp_path: Path, inner: str) -> None:
+    if inner != "json":
+        _ = pytest.importorskip(inner)
+    codec = get_codec(f"indexed:{inner}")
+    assert isinstance(codec, IndexedCodec)
+    data: dict[str, SERIALIZABLE_TYPE] = {
+        "a": [1, 2],
+        "b": {"c": None},
+        "d": "",
+    }
+    path = tmp_path / "db"
+    _ = path.write_bytes(b"".join(codec.encode_snapshot(data)))
+
+    loaded = codec.load(path)
+
+    assert all(isinstance(value, LazyValue) for value in loaded.values())
+    assert {key: resolve(value) for key, value in loaded.items()} == data
+
+
+@pytest.mark.parametrize("name", ["zlib", "gzip", "lzma"])
+def test_compressed_blocks(name: str) -> None:
+    codec = get_codec(f"{name}:json")
+    assert codec.header == f"#nbdb:{name}:json\n".encode()
+    # every block is a separate stream, so AOF can be appended later
+    data = codec.encode_block(
+        codec.encode_record({"a": 1})
+    ) + codec.encode_block(codec.encode_record({"b": 2}))
+
+    assert codec.record_decoder().feed(data, eof=True) == [{"a": 1}, {"b": 2}]
+    with pytest.raises(ValueError, match="Broken compressed stream"):
+        _ = codec.record_decoder().feed(data + b"garbage", eof=True)
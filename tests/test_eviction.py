@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import sys
+
+import pytest
+
+from nbdb.eviction import Evictor, estimate_size
+
+
+def test_estimate_size() -> None:
+    assert estimate_size("a" * 1000) > 1000
+    assert estimate_size({"a": ["b" * 1000]}) > estimate_size(["b" * 1000])
+    assert estimate_size(None) == sys.getsizeof(None)
+
+
+def test_lru() -> None:
+    data = dict.fromkeys("abcde", 1)
+    evictor = Evictor("allkeys-lru", samples=100)
+    evictor.reset(data)
+    for key in "edcba":
+        evictor.touch(key)
+
+    assert evictor.pick(data, ()) == "e"
+    assert evictor.pick(data, {"e"}) == "d"
+    evictor.touch("e")
+    assert evictor.pick(data, ()) == "d"
+
+
+def test_lfu() -> None:
+    data = dict.fromkeys("abc", 1)
+    evictor = Evictor("allkeys-lfu", samples=100)
+    evictor.reset(data)
+    for _ in range(100):
+        evictor.touch("a")
+        evictor.touch("c")
+    evictor.touch("b")
+
+    assert evictor.pick(data, ()) == "b"
+
+
+def test_pick_skips_deleted_keys() -> None:
+    evictor = Evictor("allkeys-lru", samples=100)
+    data = dict.fromkeys("abc", 1)
+    evictor.reset(data)
+    for key in "def":
+        evictor.add(key, data)
+        data[key] = 1
+
+    assert evictor.pick({"f": 1}, ()) == "f"
+    assert evictor.pick({"f": 1}, {"f"}) is None
+
+
+def test_deleted_keys_are_compacted() -> None:
+    evictor = Evictor("allkeys-lru", samples=5)
+    evictor.reset({})
+    # keys are set and deleted right away, `pick` is never called
+    for i in range(1000):
+        evictor.add(str(i), {})
+        evictor.remove(str(i))
+
+    assert len(evictor._keys) <= 5 + 1  # pyright: ignore[reportPrivateUsage]
+
+
+def test_measure() -> None:
+    evictor = Evictor("allkeys-lru", samples=5)
+    evictor.reset({})
+    assert evictor.key_size == 0
+
+    evictor.measure("a", "b" * 1000)
+    assert evictor.key_size > 1000
+
+
+def test_invalid_samples() -> None:
+    with pytest.raises(ValueError, match="positive"):
+        _ = Evictor("allkeys-lru", samples=0)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import collections.abc as c
+import typing as t
+
+import pytest
+import typing_extensions as te
+
+from nbdb.sharded import ShardedStorage
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from faker import Faker
+    from pytest_mock import MockerFixture
+
+STORAGE_FACTORY_RETURN_TYPE: te.TypeAlias = t.Callable[
+    [], c.Awaitable[ShardedStorage]
+]
+
+
+@pytest.fixture
+async def storage_factory(
+    tmp_path: Path,
+) -> c.AsyncIterator[STORAGE_FACTORY_RETURN_TYPE]:
+    storages: list[ShardedStorage] = []
+
+    async def factory(
+        path: Path | None = None,
+        *args: t.Any,
+        **kwargs: t.Any,
+    ) -> ShardedStorage:
+        kwargs.setdefault("shards", 4)
+        kwargs.setdefault("write_interval", False)
+        storage = await ShardedStorage.init(path or tmp_path, *args, **kwargs)
+        storages.append(storage)
+        return storage
+
+    yield factory
+
+    for storage in storages:
+        await storage.close()
+
+
+@pytest.fixture
+async def storage(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> ShardedStorage:
+    return await storage_factory()
+
+
+async def test_simple_storage(storage: ShardedStorage, faker: Faker) -> None:
+    data = {faker.pystr(): faker.pyint() for _ in range(50)}
+    await storage.set_many(data)
+
+    for key, value in data.items():
+        assert await storage.get(key) == value
+    assert await storage.get_many([*data, "missing"]) == data
+    # keys are spread between all shards
+    assert all(shard.pending_changes for shard in storage.shards)
+
+
+async def test_delete(storage: ShardedStorage, faker: Faker) -> None:
+    keys = [faker.pystr() for _ in range(10)]
+    await storage.set_many(dict.fromkeys(keys, 1))
+
+    with pytest.raises(KeyError):
+        await storage.set_many({keys[0]: None, "missing": None})
+    assert keys[0] in storage
+
+    assert await storage.delete_many([*keys[1:], "missing"]) == 9
+    await storage.set(keys[0], None)
+    assert await storage.get_many(keys) == {}
+
+
+async def test_reserved_key(storage: ShardedStorage) -> None:
+    data = {f"key{i}": i for i in range(10)}
+
+    with pytest.raises(ValueError, match="reserved"):
+        await storage.set_many({**data, "#nbdb:version": 1})
+    assert await storage.get_many(data) == {}
+
+
+async def test_write_only_changed_shards(
+    storage: ShardedStorage, mocker: MockerFixture
+) -> None:
+    await storage.set("key", "value")
+    spies = [mocker.spy(shard, "write") for shard in storage.shards]
+
+    await storage.write()
+
+    assert [spy.call_count for spy in spies].count(1) == 1
+    assert storage.pending_changes == 0
+
+
+async def test_reopen(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = await storage_factory()
+    data = {faker.pystr(): faker.pystr() for _ in range(20)}
+    await storage.set_many(data)
+    await storage.write()
+    await storage.set(next(iter(data)), "from aof")
+    await storage.close()
+
+    storage2 = await storage_factory()
+    assert await storage2.get_many(data) == {
+        **data,
+        next(iter(data)): "from aof",
+    }
+
+    with pytest.raises(ValueError, match="has 4 shards"):
+        _ = await storage_factory(shards=2)  # pyright: ignore[reportCallIssue, reportUnknownVariableType]
+
+
+async def test_operations(storage: ShardedStorage) -> None:
+    assert await storage.incr("counter", 5) == 5
+    assert await storage.decr("counter") == 4
+    assert await storage.append_to_list("list", 1, 2) == 2
+    await storage.merge_dict("dict", {"a": 1})
+
+    assert await storage.get_many(["counter", "list", "dict"]) == {
+        "counter": 4,
+        "list": [1, 2],
+        "dict": {"a": 1},
+    }
+
+
+async def test_compare_and_set(storage: ShardedStorage) -> None:
+    assert await storage.compare_and_set("a", 0, 1)
+    value, version = await storage.get_with_version("a")
+    assert (value, version) == (1, storage.version("a"))
+
+    assert not await storage.compare_and_set("a", 0, 2)
+    assert await storage.compare_and_set("a", version, 2)
+    assert await storage.get("a") == 2
+
+
+async def test_ttl(storage: ShardedStorage) -> None:
+    await storage.set_many({f"key{i}": i for i in range(10)}, ttl=60)
+    assert all(t.cast(float, storage.ttl(f"key{i}")) > 59 for i in range(10))
+
+    assert await storage.expire("key0", None)
+    assert storage.ttl("key0") is None
@@ -4,12 +4,15 @@ import asyncio
 import collections.abc as c
 import json
 import textwrap
+import threading
 import typing as t
 
+import aiofile
 import pytest
 import typing_extensions as te
 
-from nbdb.storage import SERIALIZABLE_TYPE, Storage
+from nbdb.codec import HEADER_MAX_SIZE, LazyValue, get_codec
+from nbdb.storage import ConflictError, SERIALIZABLE_TYPE, Storage
 
 if t.TYPE_CHECKING:
     from pathlib import Path
@@ -18,6 +21,8 @@ if t.TYPE_CHECKING:
     from pytest_mock import MockType, MockerFixture
 
 STORAGE_FACTORY_RETURN_TYPE: te.TypeAlias = t.Callable[[], c.Awaitable[Storage]]
+# saved before `mock_write_loop` replaces it
+REAL_WRITE_LOOP = Storage._write_loop  # pyright: ignore[reportPrivateUsage]
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -25,10 +30,18 @@ def mock_write_loop(session_mocker: MockerFixture) -> MockType:
     return session_mocker.patch("nbdb.storage.Storage._write_loop")
 
 
+@pytest.fixture
+def real_write_loop(mocker: MockerFixture) -> None:
+    """Use real `_write_loop` in this test."""
+    _ = mocker.patch.object(Storage, "_write_loop", REAL_WRITE_LOOP)
+
+
 @pytest.fixture
 async def storage_factory(
     tmp_path_factory: pytest.TempPathFactory, faker: Faker
-) -> STORAGE_FACTORY_RETURN_TYPE:
+) -> c.AsyncIterator[STORAGE_FACTORY_RETURN_TYPE]:
+    storages: list[Storage] = []
+
     async def factory(
         path: Path | None = None,
         *args: t.Any,
@@ -36,9 +49,14 @@ async def storage_factory(
     ) -> Storage:
         if path is None:
             path = tmp_path_factory.mktemp("data") / (faker.pystr() + ".json")
-        return await Storage.init(path, *args, **kwargs)
+        storage = await Storage.init(path, *args, **kwargs)
+        storages.append(storage)
+        return storage
 
-    return factory
+    yield factory
+
+    for storage in storages:
+        await storage.close()
 
 
 @pytest.fixture
@@ -119,13 +137,17 @@ async def test_failure_during_write(
     assert await storage2.get("abc") == "abc"
 
 
+@pytest.mark.parametrize("fsync", ["always", "everysec", "no"])
 async def test_aof(
-    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker, fsync: str
 ) -> None:
     key, value = faker.pystr(), faker.pystr()
     key2, value2 = faker.pystr(), faker.pystr()
 
-    storage1 = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    storage1 = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, fsync=fsync),  # pyright: ignore[reportCallIssue]
+    )
     await storage1.set(key, value)
     await storage1.set(key2, value2)
 
@@ -137,6 +159,113 @@ async def test_aof(
     assert await storage2.get(key2) == value2
 
 
+async def test_aof_is_kept_open(storage: Storage) -> None:
+    await storage.set("abc", 123)
+    aof = storage._aof_file  # pyright: ignore[reportPrivateUsage]
+    assert aof is not None
+
+    await storage.set("abc", 456)
+    assert storage._aof_file is aof  # pyright: ignore[reportPrivateUsage]
+
+
+async def test_aof_group_commit(
+    storage: Storage, faker: Faker, mocker: MockerFixture
+) -> None:
+    await storage.set(faker.pystr(), faker.pystr())  # open AOF
+    assert storage._aof_file is not None  # pyright: ignore[reportPrivateUsage]
+    spy = mocker.spy(storage._aof_file, "write")  # pyright: ignore[reportPrivateUsage]
+
+    data = {faker.pystr(): faker.pystr() for _ in range(100)}
+    _ = await asyncio.gather(
+        *(storage.set(key, value) for key, value in data.items())
+    )
+
+    assert spy.call_count == 1
+    with storage._aof_path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        lines = f.read().splitlines()
+    assert [json.loads(line) for line in lines[-100:]] == [
+        {key: value} for key, value in data.items()
+    ]
+
+
+async def test_aof_writer_cancelled(storage: Storage, faker: Faker) -> None:
+    task = asyncio.create_task(storage.set(faker.pystr(), faker.pystr()))
+    # let `set` queue its record and the writer start writing it
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert storage._aof_writer_task is not None  # pyright: ignore[reportPrivateUsage]
+    _ = storage._aof_writer_task.cancel()  # pyright: ignore[reportPrivateUsage]
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.parametrize(("fsync", "synced"), [("always", True), ("no", False)])
+async def test_aof_fsync_policy(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+    fsync: str,
+    synced: bool,  # noqa: FBT001
+) -> None:
+    storage = t.cast(Storage, await storage_factory(fsync=fsync))  # pyright: ignore[reportCallIssue]
+    await storage.set(faker.pystr(), faker.pystr())  # open AOF
+    assert storage._aof_file is not None  # pyright: ignore[reportPrivateUsage]
+    spy = mocker.spy(storage._aof_file, "flush")  # pyright: ignore[reportPrivateUsage]
+
+    await storage.set(faker.pystr(), faker.pystr())
+
+    assert spy.called is synced
+    assert storage._aof_unsynced is not synced  # pyright: ignore[reportPrivateUsage]
+
+
+async def test_aof_fsync_everysec(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    # don't wait for a whole second; must be patched before the fsync loop
+    # starts its first sleep
+    original_sleep = asyncio.sleep
+
+    async def fast_sleep(_: float) -> None:
+        await original_sleep(0)
+
+    _ = mocker.patch("nbdb.storage.asyncio.sleep", side_effect=fast_sleep)
+    flush = mocker.spy(aiofile.BinaryFileWrapper, "flush")
+    flush_text = mocker.spy(aiofile.TextFileWrapper, "flush")
+
+    storage = t.cast(Storage, await storage_factory(fsync="everysec"))  # pyright: ignore[reportCallIssue]
+    assert storage._fsync_loop_task is not None  # pyright: ignore[reportPrivateUsage]
+
+    await storage.set(faker.pystr(), faker.pystr())
+    assert flush.call_count + flush_text.call_count == 0
+
+    # syncing itself is done in a thread, so give it some real time
+    for _ in range(100):
+        if not storage._aof_unsynced:  # pyright: ignore[reportPrivateUsage]
+            break
+        await original_sleep(0.01)
+    assert not storage._aof_unsynced  # pyright: ignore[reportPrivateUsage]
+
+    assert flush.call_count + flush_text.call_count == 1
+
+
+async def test_close_stops_fsync_loop(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(Storage, await storage_factory(fsync="everysec"))  # pyright: ignore[reportCallIssue]
+    await storage.set(faker.pystr(), faker.pystr())
+    assert storage._aof_unsynced  # pyright: ignore[reportPrivateUsage]
+
+    await storage.close()
+
+    assert storage._fsync_loop_task is not None  # pyright: ignore[reportPrivateUsage]
+    assert storage._fsync_loop_task.done()  # pyright: ignore[reportPrivateUsage]
+    assert not storage._aof_unsynced  # pyright: ignore[reportPrivateUsage]
+
+
 async def test_aof_failure(storage: Storage, mocker: MockerFixture) -> None:
     # disable aof
     _ = mocker.patch.object(storage, "_append_command", side_effect=IOError)
@@ -185,11 +314,13 @@ async def test_write_in_background(
 
     await storage.set(key, value)
     await asyncio.sleep(0.1)
+    assert storage._write_loop_task is not None  # pyright: ignore[reportPrivateUsage]
     _ = storage._write_loop_task.cancel()  # pyright: ignore[reportPrivateUsage]
 
     storage2 = t.cast(Storage, await storage_factory(storage._path))  # pyright: ignore[reportCallIssue, reportPrivateUsage]
     assert await storage2.get(key) == value
 
+    assert storage2._write_loop_task is not None  # pyright: ignore[reportPrivateUsage]
     _ = storage._write_loop_task.cancel()  # pyright: ignore[reportPrivateUsage]
     _ = storage2._write_loop_task.cancel()  # pyright: ignore[reportPrivateUsage]
     # restart `_write_loop` mock
@@ -219,7 +350,8 @@ async def test_storage_indent(
             f"""\
                 {'{'}
                 {v}"{key}": "{value}",
-                {v}"{key2}": "{value2}"
+                {v}"{key2}": "{value2}",
+                {v}"#nbdb:version": 2
                 {'}'}
             """
         ).removesuffix("\n")
@@ -241,5 +373,1148 @@ async def test_storage_no_indent(
 
     with storage._path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
         assert f.read() == textwrap.dedent(
-            "{" + f'"{key}": "{value}", "{key2}": "{value2}"' + "}"
+            "{"
+            f'"{key}": "{value}", "{key2}": "{value2}", '
+            '"#nbdb:version": 2'
+            "}"
+        )
+
+
+async def test_set_many(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    data = {faker.pystr(): faker.pystr() for _ in range(10)}
+
+    await storage.set_many(data)
+
+    assert await storage.get_many(data) == data
+    with storage._aof_path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        assert f.read() == "\n" + json.dumps(data)
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(data) == data
+
+
+async def test_set_many_delete_missing_key(
+    storage: Storage, faker: Faker
+) -> None:
+    key, missing = faker.pystr(), faker.pystr()
+
+    with pytest.raises(KeyError):
+        await storage.set_many({key: faker.pystr(), missing: None})
+
+    assert await storage.get_many([key, missing]) == {}
+
+
+async def test_delete_many(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    data = {faker.pystr(): faker.pystr() for _ in range(10)}
+    await storage.set_many(data)
+    to_delete = [*list(data)[:5], faker.pystr()]
+
+    assert await storage.delete_many(to_delete) == 5
+
+    remaining = {key: data[key] for key in list(data)[5:]}
+    assert await storage.get_many(data) == remaining
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(data) == remaining
+
+
+async def test_changes_tracking(storage: Storage, faker: Faker) -> None:
+    assert storage.pending_changes == 0
+
+    await storage.set(faker.pystr(), faker.pystr())
+    await storage.set_many({faker.pystr(): faker.pystr() for _ in range(3)})
+    assert storage.pending_changes == 4
+
+    await storage.write()
+    assert storage.pending_changes == 0
+    assert storage.last_write_changes == 4
+
+    await storage.write()
+    assert storage.last_write_changes == 0
+
+
+@pytest.mark.usefixtures("real_write_loop")
+async def test_write_loop_skips_without_changes(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    write = mocker.patch.object(Storage, "write")
+
+    storage = t.cast(Storage, await storage_factory(write_interval=0.01))  # pyright: ignore[reportCallIssue]
+    await asyncio.sleep(0.05)
+    assert not write.called
+
+    await storage.set(faker.pystr(), faker.pystr())
+    await asyncio.sleep(0.05)
+    assert write.called
+
+
+@pytest.mark.usefixtures("real_write_loop")
+async def test_write_loop_save_points(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    _ = mocker.patch("nbdb.storage._WRITE_LOOP_TICK", 0.01)
+    write = mocker.patch.object(Storage, "write")
+
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, save_points=[(0, 3)]),  # pyright: ignore[reportCallIssue]
+    )
+    await asyncio.sleep(0.02)  # let the loop start
+    await storage.set_many({faker.pystr(): faker.pystr() for _ in range(2)})
+    await asyncio.sleep(0.05)
+    assert not write.called
+
+    await storage.set(faker.pystr(), faker.pystr())
+    await asyncio.sleep(0.05)
+    assert write.called
+
+
+@pytest.mark.usefixtures("real_write_loop")
+async def test_write_loop_aof_max_size(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    _ = mocker.patch("nbdb.storage._WRITE_LOOP_TICK", 0.01)
+    write = mocker.patch.object(Storage, "write")
+
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, aof_max_size=1024),  # pyright: ignore[reportCallIssue]
+    )
+    await asyncio.sleep(0.02)  # let the loop start
+    await storage.set(faker.pystr(), faker.pystr())
+    await asyncio.sleep(0.05)
+    assert not write.called
+
+    await storage.set(faker.pystr(), "a" * 1024)
+    await asyncio.sleep(0.05)
+    assert write.called
+
+
+async def test_invalid_save_point(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    with pytest.raises(ValueError, match="Invalid save point"):
+        _ = t.cast(Storage, await storage_factory(save_points=[(60, 0)]))  # pyright: ignore[reportCallIssue]
+
+
+async def test_write_in_thread_does_not_block_changes(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    key, value = faker.pystr(), faker.pystr()
+    key2, value2 = faker.pystr(), faker.pystr()
+    await storage.set(key, value)
+
+    started, release = threading.Event(), threading.Event()
+    codec = storage._codec  # pyright: ignore[reportPrivateUsage]
+    serialize = codec.encode_snapshot
+
+    def slow_serialize(
+        data: dict[str, SERIALIZABLE_TYPE],
+    ) -> c.Iterator[bytes]:
+        started.set()
+        _ = release.wait(5)
+        yield from serialize(data)
+
+    _ = mocker.patch.object(
+        codec, "encode_snapshot", side_effect=slow_serialize
+    )
+    write = asyncio.create_task(storage.write())
+    assert await asyncio.to_thread(started.wait, 5)
+
+    # the loop is not blocked, and the change goes to a fresh AOF segment
+    await storage.set(key2, value2)
+    assert storage._old_aof_path.exists()  # pyright: ignore[reportPrivateUsage]
+    with storage._aof_path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        assert f.read() == "\n" + json.dumps({key2: value2})
+
+    release.set()
+    await write
+    assert not storage._old_aof_path.exists()  # pyright: ignore[reportPrivateUsage]
+    assert storage.pending_changes == 1
+    with storage._path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        assert json.load(f) == {
+            key: value,
+            "#nbdb:version": 1,
+        }
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many([key, key2]) == {key: value, key2: value2}
+
+
+async def test_failed_writes_keep_aof_segments(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    data = {faker.pystr(): faker.pystr() for _ in range(3)}
+    _ = mocker.patch.object(
+        storage._codec,  # pyright: ignore[reportPrivateUsage]
+        "encode_snapshot",
+        side_effect=OSError,
+    )
+
+    for key, value in data.items():
+        await storage.set(key, value)
+        with pytest.raises(OSError):  # noqa: PT011
+            await storage.write()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(data) == data
+
+
+@pytest.mark.parametrize("indent", [None, 0, 2, "\t"])
+async def test_streamed_write_matches_json_dumps(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+    indent: int | str | None,
+) -> None:
+    _ = mocker.patch("nbdb.codec._WRITE_BUFFER_SIZE", 16)
+    storage = t.cast(
+        Storage,
+        await storage_factory(indent=indent, write_interval=False),  # pyright: ignore[reportCallIssue]
+    )
+    data = {
+        faker.pystr(): t.cast(SERIALIZABLE_TYPE, json.loads(faker.json()))
+        for _ in range(10)
+    }
+    data["ключ"] = {"nested": ["значення", 1, {"a": None}], "empty": {}}
+    await storage.set_many(data)
+
+    write = mocker.spy(aiofile.BinaryFileWrapper, "write")
+    await storage.write()
+
+    assert write.call_count > 1
+    with storage._path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        assert f.read() == json.dumps(
+            {**data, "#nbdb:version": 1}, indent=indent, ensure_ascii=False
         )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+@pytest.mark.parametrize("indent", [None, 2])
+async def test_incremental_read(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+    tmp_path: Path,
+    chunk_size: int,
+    indent: int | None,
+) -> None:
+    _ = mocker.patch("nbdb.storage._READ_CHUNK_SIZE", chunk_size)
+    data: dict[str, SERIALIZABLE_TYPE] = {
+        faker.pystr(): t.cast(SERIALIZABLE_TYPE, json.loads(faker.json()))
+        for _ in range(10)
+    }
+    data["число"] = 1234567890
+    data["ключ"] = t.cast(SERIALIZABLE_TYPE, ["значення", -1.5e10, True, None])
+    path = tmp_path / "db.json"
+    _ = path.write_text(
+        json.dumps(data, indent=indent, ensure_ascii=False), encoding="utf-8"
+    )
+
+    storage = t.cast(Storage, await storage_factory(path))  # pyright: ignore[reportCallIssue]
+
+    assert storage._data == data  # pyright: ignore[reportPrivateUsage]
+    stats = storage.last_read_stats
+    assert stats.keys == len(data)
+    assert stats.bytes == path.stat().st_size
+    assert stats.bytes_per_second > 0
+
+
+@pytest.mark.parametrize("number", ["1.5", "-2.5e-10", "-2.5e+3", "10"])
+async def test_incremental_read_cut_number(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path, number: str
+) -> None:
+    path = tmp_path / "db.json"
+    for cut in range(1, len(number)):
+        # the first read (of a possible header) ends in the middle of the number
+        pad = "a" * (HEADER_MAX_SIZE - len('{"pad": "", "x": ') - cut)
+        _ = path.write_text(f'{{"pad": "{pad}", "x": {number}}}')
+
+        storage = t.cast(Storage, await storage_factory(path))  # pyright: ignore[reportCallIssue]
+
+        assert storage._data == {"pad": pad, "x": json.loads(number)}  # pyright: ignore[reportPrivateUsage]
+
+
+@pytest.mark.parametrize("content", ["", "  \n", "{}", " { } "])
+async def test_incremental_read_empty(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path, content: str
+) -> None:
+    path = tmp_path / "db.json"
+    _ = path.write_text(content)
+
+    storage = t.cast(Storage, await storage_factory(path))  # pyright: ignore[reportCallIssue]
+
+    assert storage._data == {}  # pyright: ignore[reportPrivateUsage]
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["[]", "{", '{"a": 1', '{"a" 1}', "{1: 2}", '{"a": 1,}', '{"a": }'],
+)
+async def test_incremental_read_invalid(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path, content: str
+) -> None:
+    path = tmp_path / "db.json"
+    _ = path.write_text(content)
+
+    with pytest.raises(json.JSONDecodeError):
+        _ = t.cast(Storage, await storage_factory(path))  # pyright: ignore[reportCallIssue]
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [
+        "json",
+        "orjson",
+        "msgpack",
+        "indexed",
+        "indexed:msgpack",
+        "gzip",
+        "lzma:msgpack",
+        "zlib:indexed",
+    ],
+)
+async def test_codec(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker, codec: str
+) -> None:
+    library = codec.rpartition(":")[2]
+    if library in {"orjson", "msgpack"}:
+        _ = pytest.importorskip(library)
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, codec=codec),  # pyright: ignore[reportCallIssue]
+    )
+    data = {
+        faker.pystr(): t.cast(SERIALIZABLE_TYPE, json.loads(faker.json()))
+        for _ in range(10)
+    }
+    await storage.set_many(data)
+    await storage.write()
+    key = faker.pystr()
+    value: SERIALIZABLE_TYPE = {"nested": ["ключ", 1, None]}
+    await storage.set(key, value)
+
+    header = get_codec(codec).header
+    for path in (storage._path, storage._aof_path):  # pyright: ignore[reportPrivateUsage]
+        assert path.read_bytes().startswith(header)
+
+    # codec is picked by the file header
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many([*data, key]) == {**data, key: value}
+
+
+async def test_codec_switch(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    _ = pytest.importorskip("msgpack")
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    data = {faker.pystr(): faker.pystr() for _ in range(3)}
+    await storage.set_many(data)
+    await storage.close()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(
+            storage._path,  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+            write_interval=False,
+            codec="msgpack",
+        ),
+    )
+    assert await storage2.get_many(data) == data
+    # AOF was rewritten, so new records can be appended to it
+    assert storage2._aof_path.read_bytes().startswith(b"#nbdb:msgpack\n")  # pyright: ignore[reportPrivateUsage]
+
+    key, value = faker.pystr(), faker.pystr()
+    await storage2.set(key, value)
+    await storage2.close()
+
+    storage3 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage3.get_many([*data, key]) == {**data, key: value}
+
+
+async def test_unknown_codec(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, tmp_path: Path
+) -> None:
+    with pytest.raises(ValueError, match="Unknown codec"):
+        _ = t.cast(Storage, await storage_factory(codec="abc"))  # pyright: ignore[reportCallIssue]
+
+    path = tmp_path / "db.json"
+    _ = path.write_bytes(b"#nbdb:abc\n{}")
+    with pytest.raises(ValueError, match="Unknown codec"):
+        _ = t.cast(Storage, await storage_factory(path))  # pyright: ignore[reportCallIssue]
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack"])
+async def test_rewrite_aof(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker, codec: str
+) -> None:
+    _ = pytest.importorskip(codec)
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, codec=codec),  # pyright: ignore[reportCallIssue]
+    )
+    key, key2 = faker.pystr(), faker.pystr()
+    await storage.set(key2, "deleted from db file")
+    await storage.write()
+    for i in range(100):
+        await storage.set(key, i)
+    await storage.set(key2, None)
+    size = storage._aof_size()  # pyright: ignore[reportPrivateUsage]
+
+    await storage.rewrite_aof()
+
+    assert storage._aof_size() < size  # pyright: ignore[reportPrivateUsage]
+    assert not storage._new_aof_path.exists()  # pyright: ignore[reportPrivateUsage]
+    await storage.set(faker.pystr(), "appended after rewrite")
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert storage2._data == storage._data  # pyright: ignore[reportPrivateUsage]
+    assert await storage2.get(key) == 99
+    assert key2 not in storage2._data  # pyright: ignore[reportPrivateUsage]
+
+
+async def test_rewrite_aof_does_not_block_changes(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    key, key2 = faker.pystr(), faker.pystr()
+    for i in range(10):
+        await storage.set(key, i)
+
+    started, release = threading.Event(), threading.Event()
+    encode = storage._encode_compacted  # pyright: ignore[reportPrivateUsage]
+
+    def slow_encode(
+        latest: dict[str, SERIALIZABLE_TYPE],
+        versions: dict[str, int],
+        deadlines: dict[str, int | None],
+        ops: dict[str, list[list[SERIALIZABLE_TYPE]]],
+        version: int,
+    ) -> bytes:
+        started.set()
+        _ = release.wait(5)
+        return encode(latest, versions, deadlines, ops, version)
+
+    _ = mocker.patch.object(
+        storage, "_encode_compacted", side_effect=slow_encode
+    )
+    rewrite = asyncio.create_task(storage.rewrite_aof())
+    assert await asyncio.to_thread(started.wait, 5)
+
+    await storage.set(key, "during rewrite")
+    await storage.set(key2, "during rewrite")
+    release.set()
+    await rewrite
+
+    with storage._aof_path.open("r") as f:  # pyright: ignore[reportPrivateUsage]
+        records = [json.loads(line) for line in f.read().splitlines() if line]
+    assert records == [
+        {key: 9, "#nbdb:version": 10},
+        {"#nbdb:version": 10},
+        {key: "during rewrite"},
+        {key2: "during rewrite"},
+    ]
+
+
+@pytest.mark.usefixtures("real_write_loop")
+async def test_write_loop_aof_rewrite(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    _ = mocker.patch("nbdb.storage._WRITE_LOOP_TICK", 0.01)
+    write = mocker.patch.object(Storage, "write")
+    rewrite = mocker.patch.object(Storage, "rewrite_aof")
+
+    storage = t.cast(
+        Storage,
+        await storage_factory(
+            write_interval=False,  # pyright: ignore[reportCallIssue]
+            aof_rewrite_percentage=100,  # pyright: ignore[reportCallIssue]
+            aof_rewrite_min_size=1024,  # pyright: ignore[reportCallIssue]
+        ),
+    )
+    await asyncio.sleep(0.02)  # let the loop start
+    await storage.set(faker.pystr(), faker.pystr())
+    await asyncio.sleep(0.05)
+    assert not rewrite.called
+
+    await storage.set(faker.pystr(), "a" * 1024)
+    await asyncio.sleep(0.05)
+    assert rewrite.called
+    assert not write.called
+
+
+async def test_indexed_snapshot_is_lazy(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+    faker: Faker,
+    mocker: MockerFixture,
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, codec="indexed"),  # pyright: ignore[reportCallIssue]
+    )
+    data = {faker.pystr(): {"nested": faker.pystr()} for _ in range(10)}
+    await storage.set_many(data)
+    await storage.write()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(
+            storage._path,  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+            write_interval=False,
+            codec="indexed",
+        ),
+    )
+    values = storage2._data  # pyright: ignore[reportPrivateUsage]
+    assert all(isinstance(value, LazyValue) for value in values.values())
+
+    key = next(iter(data))
+    assert await storage2.get(key) == data[key]
+    assert values[key] == data[key]  # decoded only once
+    assert sum(isinstance(value, LazyValue) for value in values.values()) == 9
+
+    # lazy values are copied to the new db file without decoding
+    spy = mocker.spy(LazyValue, "decode")
+    await storage2.write()
+    spy.assert_not_called()
+    storage3 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage3.get_many(data) == data
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack", "indexed"])
+async def test_lazy_values(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker, codec: str
+) -> None:
+    if codec == "msgpack":
+        _ = pytest.importorskip(codec)
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, codec=codec),  # pyright: ignore[reportCallIssue]
+    )
+    data = {faker.pystr(): {"list": [faker.pystr()] * 10} for _ in range(10)}
+    await storage.set_many(data)
+    await storage.write()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(
+            storage._path,  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+            write_interval=False,
+            codec=codec,
+            lazy_values=True,
+        ),
+    )
+    stats = storage2.memory_stats
+    assert stats.keys == stats.lazy_values == 10
+    assert stats.lazy_bytes > 0
+
+    key = next(iter(data))
+    assert await storage2.get(key) == data[key]
+    assert await storage2.get_many(data) == data
+    # values stay encoded, decoded ones are only cached
+    stats = storage2.memory_stats
+    assert stats.lazy_values == 10
+    assert stats.cache.items == 10
+    assert stats.cache.hits == 1
+
+    await storage2.set(key, "changed")
+    assert await storage2.get(key) == "changed"
+    assert storage2.memory_stats.lazy_values == 9
+
+    await storage2.write()
+    storage3 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage3.get_many(data) == {**data, key: "changed"}
+
+
+async def test_delta_checkpoints(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, max_deltas=3),  # pyright: ignore[reportCallIssue]
+    )
+    path = storage._path  # pyright: ignore[reportPrivateUsage]
+    data = {faker.pystr(): faker.pystr() for _ in range(50)}
+    await storage.set_many(data)
+    await storage.write()  # the first write is always full
+    base = path.read_bytes()
+
+    key, deleted = list(data)[:2]
+    await storage.set(key, "changed")
+    await storage.write()
+    await storage.set(deleted, None)
+    await storage.write()
+
+    assert path.read_bytes() == base
+    deltas = sorted(path.parent.glob(path.name + ".delta.*"))
+    assert len(deltas) == 2
+    assert json.loads(deltas[1].read_bytes()) == {
+        deleted: None,
+        "#nbdb:version": 3,
+    }
+
+    expected = {**data, key: "changed"}
+    del expected[deleted]
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(path, write_interval=False, max_deltas=3),  # pyright: ignore[reportCallIssue]
+    )
+    assert await storage2.get_many(data) == expected
+
+    # the third delta is the last one, the next write folds them
+    await storage2.set(key, "changed again")
+    await storage2.write()
+    await storage2.set(key, "folded")
+    await storage2.write()
+    assert not list(path.parent.glob(path.name + ".delta.*"))
+    folded = json.loads(path.read_bytes())
+    assert folded.pop("#nbdb:version") == 5
+    assert folded == {**expected, key: "folded"}
+
+
+async def test_failure_during_fold(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, mocker: MockerFixture
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, max_deltas=5),  # pyright: ignore[reportCallIssue]
+    )
+    _ = mocker.patch.object(storage, "_append_command")  # disable aof
+    await storage.set("a", 1)
+    await storage.write()
+    await storage.set("a", 2)
+    await storage.write()
+
+    _ = mocker.patch.object(
+        storage._codec,  # pyright: ignore[reportPrivateUsage]
+        "encode_snapshot",
+        side_effect=OSError,
+    )
+    with pytest.raises(OSError):  # noqa: PT011
+        await storage.write(full=True)
+
+    # the old db file and folded deltas are used
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get("a") == 2
+
+
+async def test_coalesce_window(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, mocker: MockerFixture
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, coalesce_window=0.01),  # pyright: ignore[reportCallIssue]
+    )
+    write = mocker.spy(aiofile.BinaryFileWrapper, "write")
+
+    _ = await asyncio.gather(
+        *(storage.set("counter", i) for i in range(100)),
+        storage.set("other", "value"),
+    )
+
+    # the header and a single record with the last values
+    assert write.call_count == 2
+    aof = storage._aof_path.read_text()  # pyright: ignore[reportPrivateUsage]
+    # versions of all 101 changes are kept, and of every key separately
+    assert json.loads(aof) == {
+        "counter": 99,
+        "other": "value",
+        "#nbdb:version": 101,
+        "#nbdb:versions": {"counter": 100},
+    }
+
+    await storage.close()
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert (storage2.version("counter"), storage2.version("other")) == (
+        100,
+        101,
+    )
+
+
+async def test_close_flushes_coalesced_changes(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, coalesce_window=60),  # pyright: ignore[reportCallIssue]
+    )
+    change = asyncio.create_task(storage.set("a", 1))
+    await asyncio.sleep(0)
+
+    await storage.close()
+    await change
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get("a") == 1
+
+
+async def test_operations(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    await storage.set("list", ["a"])
+    await storage.set("dict", {"a": 1})
+
+    assert await storage.incr("counter") == 1
+    assert await storage.incr("counter", 10) == 11
+    assert await storage.decr("counter") == 10
+    assert await storage.append_to_list("list", "b", "c") == 3
+    assert await storage.append_to_list("new list", 1) == 1
+    await storage.merge_dict("dict", {"b": 2})
+
+    with pytest.raises(TypeError, match="not an integer"):
+        _ = await storage.incr("list")
+    with pytest.raises(TypeError, match="not a list"):
+        _ = await storage.append_to_list("dict", 1)
+    with pytest.raises(TypeError, match="not a mapping"):
+        await storage.merge_dict("counter", {})
+
+    expected: dict[str, SERIALIZABLE_TYPE] = {
+        "counter": 10,
+        "list": ["a", "b", "c"],
+        "new list": [1],
+        "dict": {"a": 1, "b": 2},
+    }
+    assert await storage.get_many(expected) == expected
+    # only operations are written, not the whole values
+    aof = storage._aof_path.read_text()  # pyright: ignore[reportPrivateUsage]
+    assert '["append", "list", ["b", "c"]]' in aof
+    assert '"a"]' not in aof.split("\n")[-1]
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(expected) == expected
+
+
+async def test_rewrite_aof_with_operations(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    await storage.set_many({"in db": 10, "deleted": 1})
+    await storage.write()
+
+    for _ in range(5):
+        _ = await storage.incr("in db")
+        _ = await storage.incr("in aof")
+    await storage.set("deleted", None)
+    _ = await storage.incr("deleted")
+    await storage.rewrite_aof()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(["in db", "in aof", "deleted"]) == {
+        "in db": 15,
+        "in aof": 5,
+        "deleted": 1,
+    }
+
+
+async def test_paths(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    document: SERIALIZABLE_TYPE = {
+        "a": {"b": [1, 2]},
+        "c/d": "e",
+        "big": "x" * 100,
+    }
+    await storage.set("doc", document)
+
+    await storage.set_path("doc", "/a/b/0", {"new": None})
+    await storage.set_path("doc", "/a/b/-", 3)
+    await storage.set_path("doc", "/c~1d", "escaped")
+    await storage.delete_path("doc", "/a/b/1")
+
+    expected: SERIALIZABLE_TYPE = {
+        "a": {"b": [{"new": None}, 3]},
+        "c/d": "escaped",
+        "big": "x" * 100,
+    }
+    assert await storage.get("doc") == expected
+    # the original value is copied, not changed in place
+    assert document == {"a": {"b": [1, 2]}, "c/d": "e", "big": "x" * 100}
+    # only paths are written to AOF
+    assert storage._aof_path.read_text().count("x" * 100) == 1  # pyright: ignore[reportPrivateUsage]
+
+    with pytest.raises(KeyError):
+        await storage.set_path("doc", "/missing/path", 1)
+    with pytest.raises(KeyError):
+        await storage.delete_path("missing", "/a")
+    with pytest.raises(TypeError):
+        await storage.set_path("doc", "/big/0", 1)
+    with pytest.raises(ValueError, match="Invalid list index"):
+        await storage.set_path("doc", "/a/b/01", 1)
+    with pytest.raises(ValueError, match="must start with '/'"):
+        await storage.set_path("doc", "a", 1)
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get("doc") == expected
+
+
+async def test_transaction(storage: Storage) -> None:
+    await storage.set_many({"a": 1, "b": 2})
+
+    async with storage.transaction() as tx:
+        tx.set("a", 10)
+        tx.set("c", 30)
+        tx.delete("b")
+        tx.delete("missing")
+        # nothing is applied until the end
+        assert await storage.get("a") == 1
+    assert await storage.get_many(["a", "b", "c"]) == {"a": 10, "c": 30}
+    assert storage._aof_path.read_text().splitlines()[-1] == (  # pyright: ignore[reportPrivateUsage]
+        '{"a": 10, "c": 30, "b": null}'
+    )
+
+    with pytest.raises(RuntimeError):  # noqa: PT012
+        async with storage.transaction() as tx:
+            tx.set("a", 100)
+            raise RuntimeError
+    assert await storage.get("a") == 10
+
+
+async def test_transaction_watch(storage: Storage) -> None:
+    await storage.set("balance", 100)
+
+    with pytest.raises(ConflictError, match="balance"):  # noqa: PT012
+        async with storage.transaction(watch=["balance", "missing"]) as tx:
+            tx.set("balance", 90)
+            tx.set("log", "withdrawn")
+            await storage.set("balance", 50)  # changed by somebody else
+    assert await storage.get_many(["balance", "log"]) == {"balance": 50}
+
+    async with storage.transaction(watch=["balance", "missing"]) as tx:
+        tx.set("balance", 40)
+        await storage.set("other", 1)
+    assert await storage.get("balance") == 40
+
+
+async def test_compare_and_set(storage: Storage) -> None:
+    assert storage.version("counter") == 0
+    assert await storage.compare_and_set("counter", 0, 0)
+    assert not await storage.compare_and_set("counter", 0, 0)
+
+    async def increment() -> None:
+        while True:
+            value, version = await storage.get_with_version("counter")
+            await asyncio.sleep(0)  # let others change it meanwhile
+            if await storage.compare_and_set(
+                "counter", version, t.cast(int, value) + 1
+            ):
+                return
+
+    _ = await asyncio.gather(*(increment() for _ in range(10)))
+    assert await storage.get("counter") == 10
+
+    with pytest.raises(KeyError):
+        _ = await storage.get_with_version("missing")
+    with pytest.raises(ValueError, match="reserved"):
+        await storage.set("#nbdb:versions", 1)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"coalesce_window": 0.01},
+        {"max_deltas": 3},
+        {"codec": "indexed", "lazy_values": True},
+    ],
+)
+async def test_versions_survive_restart(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, kwargs: dict[str, t.Any]
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, **kwargs),  # pyright: ignore[reportCallIssue]
+    )
+    await storage.set_many({"a": 1, "b": 2, "c": 3})
+    await storage.write()
+    await storage.write()  # a delta, if they are enabled
+    await storage.set("a", 10)
+    _ = await storage.incr("b")
+    await storage.set("c", None)
+    await storage.rewrite_aof()
+    await storage.set_many({"a": 20, "d": 4})
+    await storage.close()
+    versions = {key: storage.version(key) for key in "abcd"}
+    assert len(set(versions.values())) == 3  # "a" and "d" are changed together
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert {key: storage2.version(key) for key in "abcd"} == versions
+    await storage2.set("b", 30)
+    assert storage2.version("b") > max(versions.values())
+
+
+async def test_versions_after_write(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    await storage.set("a", 1)
+    await storage.set("b", 2)
+    await storage.write()
+    await storage.close()
+
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    # only the last version is stored, so it is given to all keys
+    assert (storage2.version("a"), storage2.version("b")) == (2, 2)
+    assert not await storage2.compare_and_set("a", 1, 10)
+    assert await storage2.compare_and_set("a", 2, 10)
+    assert storage2.version("a") == 3
+    assert storage2.version("missing") == 0
+
+
+async def test_ttl(storage: Storage) -> None:
+    await storage.set("a", 1, ttl=0.2)
+    await storage.set_many({"b": 2, "c": 3}, ttl=60)
+    assert 0 < t.cast(float, storage.ttl("a")) <= 0.2
+    assert await storage.get("a") == 1
+
+    # operations keep TTL, but set without it removes TTL
+    assert await storage.incr("b") == 3
+    await storage.set("c", 4)
+    assert t.cast(float, storage.ttl("b")) > 59
+    assert storage.ttl("c") is None
+
+    assert await storage.expire("c", 60)
+    assert await storage.expire("b", None)
+    assert storage.ttl("b") is None
+    assert not await storage.expire("missing", 1)
+
+    await asyncio.sleep(0.25)
+    assert "a" not in storage
+    with pytest.raises(KeyError):
+        _ = await storage.get("a")
+    with pytest.raises(KeyError):
+        _ = storage.ttl("a")
+    assert await storage.get_many(["a", "b", "c"]) == {"b": 3, "c": 4}
+
+
+async def test_expire_in_background(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    await storage.set("kept", 1)
+    await storage.set_many({f"key{i}": i for i in range(10)}, ttl=0.01)
+
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if storage.memory_stats.keys == 1:
+            break
+    assert storage.memory_stats.keys == 1
+    await storage.close()
+
+    # expiry is written to AOF, so replay doesn't depend on time
+    last = storage._aof_path.read_text().splitlines()[-1]  # pyright: ignore[reportPrivateUsage]
+    assert json.loads(last) == {f"key{i}": None for i in range(10)}
+
+
+async def test_expiry_task_runs_only_with_deadlines(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(Storage, await storage_factory(write_interval=False))  # pyright: ignore[reportCallIssue]
+    await storage.set("kept", 1)
+    assert storage._expire_loop_task is None  # pyright: ignore[reportPrivateUsage]
+
+    await storage.set("late", 1, ttl=60)
+    await asyncio.sleep(0)  # the task now sleeps until the deadline
+    # an earlier deadline wakes it up
+    await storage.set("early", 1, ttl=0.01)
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if "early" not in storage._data:  # pyright: ignore[reportPrivateUsage]
+            break
+    assert "early" not in storage._data  # pyright: ignore[reportPrivateUsage]
+
+    # the task stops, when there are no deadlines left
+    _ = await storage.expire("late", 0.01)
+    task = storage._expire_loop_task  # pyright: ignore[reportPrivateUsage]
+    assert task is not None
+    await asyncio.wait_for(task, 1)
+    assert list(storage._data) == ["kept"]  # pyright: ignore[reportPrivateUsage]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"coalesce_window": 0.01},
+        {"max_deltas": 3},
+        {"codec": "indexed"},
+    ],
+)
+async def test_ttl_survives_restart(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, kwargs: dict[str, t.Any]
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, **kwargs),  # pyright: ignore[reportCallIssue]
+    )
+    await storage.set_many({"a": 1, "b": 2, "c": 3}, ttl=60)
+    await storage.set("short", 1, ttl=0.05)
+    await storage.write()
+    await storage.set("b", 20)
+    _ = await storage.incr("c")
+    assert await storage.expire("a", 30)
+    await storage.write()  # a delta, if they are enabled
+    await storage.set("d", 4, ttl=60)
+    await storage.rewrite_aof()
+    await storage.close()
+
+    await asyncio.sleep(0.1)
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many(["a", "b", "c", "d", "short"]) == {
+        "a": 1,
+        "b": 20,
+        "c": 4,
+        "d": 4,
+    }
+    assert 29 < t.cast(float, storage2.ttl("a")) <= 30
+    assert storage2.ttl("b") is None
+    assert 59 < t.cast(float, storage2.ttl("c")) <= 60
+    assert 59 < t.cast(float, storage2.ttl("d")) <= 60
+
+
+async def test_max_keys(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE, faker: Faker
+) -> None:
+    kwargs: dict[str, t.Any] = {
+        "write_interval": False,
+        "max_keys": 10,
+        "eviction_samples": 100,
+    }
+    storage = await storage_factory(**kwargs)
+    keys = [faker.pystr() for _ in range(10)]
+    for key in keys:
+        await storage.set(key, 1)
+    _ = await storage.get_many(keys[1:])
+
+    await storage.set("new", 1)
+    assert keys[0] not in storage
+    stats = storage.memory_stats
+    assert (stats.keys, stats.evicted_keys) == (10, 1)
+
+    # eviction is in AOF, so replay evicts the same key
+    await storage.close()
+    storage2 = t.cast(
+        Storage,
+        await storage_factory(storage._path, write_interval=False, max_keys=10),  # pyright: ignore[reportCallIssue, reportPrivateUsage]
+    )
+    assert await storage2.get_many([*keys, "new"]) == dict.fromkeys(
+        [*keys[1:], "new"], 1
+    )
+
+
+async def test_max_memory(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    storage = t.cast(
+        Storage,
+        await storage_factory(write_interval=False, max_memory=100_000),  # pyright: ignore[reportCallIssue]
+    )
+    for i in range(100):
+        await storage.set(f"key{i}", "x" * 10_000)
+
+    stats = storage.memory_stats
+    assert stats.keys < 10
+    assert stats.keys + stats.evicted_keys == 100
+    assert stats.estimated_bytes <= 100_000
+    assert await storage.get("key99") == "x" * 10_000
+
+
+async def test_volatile_ttl(
+    storage_factory: STORAGE_FACTORY_RETURN_TYPE,
+) -> None:
+    kwargs: dict[str, t.Any] = {
+        "write_interval": False,
+        "max_keys": 3,
+        "eviction_policy": "volatile-ttl",
+    }
+    storage = await storage_factory(**kwargs)
+    await storage.set("permanent", 1)
+    await storage.set("later", 1, ttl=60)
+    await storage.set("sooner", 1, ttl=30)
+
+    await storage.set("new", 1)
+    assert await storage.get_many(["permanent", "later", "sooner", "new"]) == {
+        "permanent": 1,
+        "later": 1,
+        "new": 1,
+    }
+
+    # only keys with TTL can be evicted
+    await storage.set("later", 2)
+    await storage.set("another", 1)
+    assert storage.memory_stats.keys == 4